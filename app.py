@@ -1,18 +1,181 @@
+import os
+import sys
+import time
+import signal
 import logging
-from gmail_app import process_gmail_attachments
-from drive_app import process_drive_files
-from logging_utils import log_error_to_sheets
+import argparse
+from config import configure_logging, load_environment
+from metrics import registry, start_metrics_server, dump_metrics
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+load_environment()
 
-if __name__ == '__main__':
+# Seconds between polls when running as a daemon
+daemon_interval = float(os.getenv('DAEMON_INTERVAL', '30'))
+
+# Hand emailed invoices straight to the pipeline instead of re-downloading them from Drive
+gmail_handoff = os.getenv('GMAIL_HANDOFF', '0') == '1'
+
+# Modules each command needs; they are imported only when the command runs, so e.g. the Gmail
+# step never loads the OCR and LLM clients. benchmarks/startup_benchmark.py measures these.
+COMMAND_MODULES = {
+    'all': ('gmail_app', 'drive_app'),
+    'gmail': ('gmail_app', 'drive_app') if gmail_handoff else ('gmail_app',),
+    'drive': ('drive_app',),
+    'single-file': ('drive_app',),
+    'reprocess-failed': ('drive_app',),
+    'daemon': ('gmail_app', 'drive_app'),
+}
+
+
+def log_error_to_sheets(function_name, error_message):
+    from logging_utils import log_error_to_sheets as log_error
+    log_error(function_name, error_message)
+
+
+def timed(job, func, *args, **kwargs):
+    started = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        registry.observe('run_seconds', time.time() - started, job=job)
+
+
+def process_gmail(incremental=None):
+    from gmail_app import process_gmail_attachments
+    if not gmail_handoff:
+        return process_gmail_attachments(incremental=incremental)
+
+    from drive_app import start_invoice_pipeline
+    pipeline = start_invoice_pipeline()
+    try:
+        return process_gmail_attachments(incremental=incremental, handoff=pipeline.submit)
+    finally:
+        pipeline.close()
+
+
+def process_drive():
+    from drive_app import process_drive_files
+    return process_drive_files()
+
+
+def run_once():
     logging.info("Starting Gmail and Drive processing...")
     try:
-        process_gmail_attachments()
+        timed('gmail', process_gmail)
         logging.info("All Emails Processed.")
-        process_drive_files()
+        timed('drive', process_drive)
         logging.info("All Files Processed.")
-        
+
     except Exception as e:
         logging.error(f"Error in processing: {e}")
-        log_error_to_sheets("app.py", str(e))
\ No newline at end of file
+        log_error_to_sheets("app.py", str(e))
+
+    finally:
+        dump_metrics()
+
+
+def run_daemon(interval):
+    # Incremental Gmail sync every interval, so new invoices are picked up without rescanning
+    logging.info(f"Starting daemon, polling every {interval} seconds...")
+    while True:
+        started = time.time()
+        try:
+            uploaded = timed('gmail', process_gmail, incremental=True)
+            if uploaded:
+                logging.info(f"{uploaded} new attachments uploaded.")
+            timed('drive', process_drive)
+
+        except Exception as e:
+            logging.error(f"Error in daemon cycle: {e}")
+            log_error_to_sheets("app.py (daemon)", str(e))
+
+        dump_metrics()
+        time.sleep(max(0, interval - (time.time() - started)))
+
+
+def run_command(job, func, *args):
+    try:
+        return timed(job, func, *args)
+    finally:
+        dump_metrics()
+
+
+def command_all(args):
+    run_once()
+
+
+def command_gmail(args):
+    uploaded = run_command('gmail', process_gmail, args.incremental)
+    logging.info(f"{uploaded or 0} attachments uploaded.")
+
+
+def command_drive(args):
+    run_command('drive', process_drive)
+
+
+def command_single_file(args):
+    from drive_app import process_single_file
+    run_command('single-file', process_single_file, args.file_id)
+
+
+def command_reprocess_failed(args):
+    from drive_app import reprocess_failed_files
+    run_command('reprocess-failed', reprocess_failed_files)
+
+
+def command_daemon(args):
+    run_daemon(args.interval)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Invoice automation: Gmail attachments to Drive, Drive invoices to Sheets.")
+    parser.add_argument('--log-level', help="logging level (default: LOG_LEVEL or INFO)")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    commands.add_parser('all', help="process Gmail, then Drive, once (the default)").set_defaults(handler=command_all)
+
+    gmail = commands.add_parser('gmail', help="upload new Gmail attachments to Drive")
+    gmail.add_argument('--incremental', action=argparse.BooleanOptionalAction, default=None,
+                       help="only look at mail added since the last run (default: GMAIL_INCREMENTAL_SYNC)")
+    gmail.set_defaults(handler=command_gmail)
+
+    commands.add_parser('drive', help="extract every invoice in the Drive input folders").set_defaults(handler=command_drive)
+
+    single_file = commands.add_parser('single-file', help="extract one Drive file, wherever it is")
+    single_file.add_argument('file_id')
+    single_file.set_defaults(handler=command_single_file)
+
+    commands.add_parser('reprocess-failed', help="extract the invoices in the failed folder again").set_defaults(handler=command_reprocess_failed)
+
+    daemon = commands.add_parser('daemon', help="poll Gmail and Drive until stopped")
+    daemon.add_argument('--interval', type=float, default=daemon_interval, help="seconds between polls (default: DAEMON_INTERVAL)")
+    daemon.set_defaults(handler=command_daemon)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args.command, args.handler = 'all', command_all
+    return args
+
+
+def exit_on_sigterm(signum, frame):
+    # SIGTERM (daemon or container stop) skips atexit; exiting through SystemExit runs the
+    # finally blocks and atexit handlers that flush buffered sheet rows and error logs
+    raise SystemExit(128 + signum)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    configure_logging(args.log_level)
+    if 'drive_app' in COMMAND_MODULES[args.command]:
+        from output_artifacts import check_output_mode
+        try:
+            check_output_mode()
+        except ValueError as e:
+            return f"Configuration error: {e}"
+    start_metrics_server()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import time
+import logging
+from collections import Counter
+from rate_limit import acquire_all, backoff_delay, classify_error, google_operation_class, is_idempotent, rate_limit_max_retries
+from metrics import span
+
+# Google's batch endpoint accepts at most 100 calls per HTTP request
+MAX_BATCH_SIZE = 100
+
+
+def _execute_chunks(service, requests, batch_size, results):
+    for start in range(0, len(requests), batch_size):
+        chunk = requests[start:start + batch_size]
+        keys = {str(index): key for index, (key, _) in enumerate(chunk)}
+
+        def callback(request_id, response, exception, keys=keys):
+            results[keys[request_id]] = (response, exception)
+
+        batch = service.new_batch_http_request(callback=callback)
+        for index, (_, request) in enumerate(chunk):
+            batch.add(request, request_id=str(index))
+
+        # Every call in the batch counts against its API's quota
+        acquire_all(Counter(google_operation_class(request.uri, request.method) for _, request in chunk).items())
+
+        try:
+            with span('call', 'batch', api='google', calls=len(chunk)):
+                batch.execute()
+        except Exception as e:
+            logging.error(f"Batch request of {len(chunk)} calls failed: {e}")
+            for key in keys.values():
+                results.setdefault(key, (None, e))
+
+
+def execute_batch(service, requests, batch_size=MAX_BATCH_SIZE):
+    """
+    Execute (key, request) pairs through BatchHttpRequest, batch_size calls per round trip.
+
+    Returns a dict of key -> (response, exception). A failing call only sets the
+    exception for its own key, so one bad item never fails the rest of the batch.
+    Calls that were rate limited, and idempotent calls that hit a transient error, are
+    sent again in a later batch after the usual backoff.
+    """
+    results = {}
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+
+    pending = list(requests)
+    for attempt in range(rate_limit_max_retries + 1):
+        for key, _ in pending:
+            results.pop(key, None)
+        _execute_chunks(service, pending, batch_size, results)
+
+        retry = []
+        retry_after = None
+        for key, request in pending:
+            error = results.get(key, (None, None))[1]
+            if error is None:
+                continue
+            retryable, error_retry_after, rate_limited = classify_error(error)
+            if retryable and (rate_limited or is_idempotent(request.method)):
+                retry.append((key, request))
+                if error_retry_after is not None:
+                    retry_after = max(retry_after or 0, error_retry_after)
+
+        if not retry or attempt == rate_limit_max_retries:
+            break
+        delay = backoff_delay(attempt, retry_after)
+        logging.warning(f"{len(retry)} batched calls were rate limited or failed transiently, retrying in {delay:.1f}s.")
+        time.sleep(delay)
+        pending = retry
+
+    return results
@@ -0,0 +1,681 @@
+"""
+In-process fakes of the Gmail, Drive, Sheets, Form Recognizer and OpenAI APIs.
+
+Each backend applies a configurable latency, injected error rate and server-side quotas
+(token buckets that answer 429 with Retry-After instead of waiting), and counts every
+call so a benchmark can report API calls per invoice.
+"""
+import re
+import json
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import itertools
+import threading
+from types import SimpleNamespace
+from collections import Counter
+
+from rate_limit import call_with_limits, google_operation_class, is_idempotent
+from synthetic_invoices import analyze_result_dict
+
+
+class FakeHttpResponse(dict):
+    # httplib2.Response is a dict of lower-case headers with .status and .reason
+    def __init__(self, status, headers=None):
+        super().__init__(headers or {})
+        self['status'] = str(status)
+        self.status = status
+        self.reason = 'Fake'
+
+
+class FakeApiError(Exception):
+    """
+    Error shaped like the client libraries' HTTP errors: .status_code and .response.headers
+    as in OpenAI and Azure, .resp and .content as in googleapiclient's HttpError.
+    """
+    def __init__(self, status, retry_after=None, reason='backendError'):
+        super().__init__(f"{status} {reason}")
+        headers = {'retry-after': f"{retry_after:.3f}"} if retry_after is not None else {}
+        self.status_code = status
+        self.response = SimpleNamespace(headers=headers)
+        self.resp = FakeHttpResponse(status, headers)
+        self.content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}]}}).encode('utf-8')
+
+
+class FakeQuota:
+    """
+    Server-side quota: a token bucket that rejects a call it cannot cover and says when to retry.
+    """
+    def __init__(self, per_second, burst=None):
+        self.rate = per_second
+        self.capacity = burst if burst is not None else max(1.0, per_second)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, cost=1):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            cost = min(cost, self.capacity)
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return None
+            return (cost - self._tokens) / self.rate
+
+
+class FakeBackend:
+    def __init__(self, latency=0.0, error_rate=0.0, quotas=None, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quotas = {name: FakeQuota(rate) for name, rate in (quotas or {}).items() if rate}
+        self.calls = Counter()
+        self.round_trips = 0
+        self.throttled = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _admit(self, operation, quota_class=None, cost=1, latency=None, batched=False):
+        # Returns (delay, error): how long the call takes and the error it fails with, if any
+        with self._lock:
+            self.calls[operation] += 1
+            if not batched:
+                self.round_trips += 1
+            base = self.latency if latency is None else latency
+            delay = base * self._random.uniform(0.5, 1.5)
+            failed = self._random.random() < self.error_rate
+
+        quota = self.quotas.get(quota_class)
+        retry_after = quota.take(cost) if quota else None
+        if retry_after is not None:
+            with self._lock:
+                self.throttled += 1
+            return delay, FakeApiError(429, retry_after, 'rateLimitExceeded')
+        if failed:
+            with self._lock:
+                self.errors += 1
+            return delay, FakeApiError(503)
+        return delay, None
+
+    def call(self, operation, quota_class=None, cost=1, latency=None, batched=False):
+        delay, error = self._admit(operation, quota_class, cost, latency, batched)
+        time.sleep(delay)
+        if error:
+            raise error
+
+
+# --- Google (Gmail, Drive, Sheets) ---
+
+GOOGLE_HOSTS = {
+    'gmail': 'https://gmail.googleapis.com/gmail/v1/',
+    'drive': 'https://www.googleapis.com/drive/v3/',
+    'sheets': 'https://sheets.googleapis.com/v4/',
+}
+READ_METHODS = ('get', 'list', 'get_media', 'getProfile', 'getStartPageToken')
+# Write methods that are not POSTs in the real APIs
+WRITE_METHODS = {'update': 'PATCH', 'delete': 'DELETE'}
+
+
+class FakeRequest:
+    """
+    Stand-in for googleapiclient's HttpRequest; execute() follows the same shared rate-limit
+    policy as the real requests built by google_auth.
+    """
+    def __init__(self, backend, api, operation, handler, kwargs):
+        self.backend = backend
+        self.operation = operation
+        self.handler = handler
+        self.kwargs = kwargs
+        name = operation.rsplit('.', 1)[-1]
+        self.method = 'GET' if name in READ_METHODS else WRITE_METHODS.get(name, 'POST')
+        self.uri = GOOGLE_HOSTS[api] + operation.replace('.', '/')
+        self.headers = {}
+        self.http = _FakeMediaHttp(self)
+        self._upload_offset = 0
+
+    def _quota_class(self):
+        return google_operation_class(self.uri, self.method)
+
+    def perform(self, batched=False):
+        # Calls inside a batch share the batch's round trip, so they add no latency of their own
+        self.backend.call(self.operation, self._quota_class(), latency=0 if batched else None, batched=batched)
+        return self.handler(**self.kwargs)
+
+    def execute(self, http=None, num_retries=0):
+        return call_with_limits(self.perform, [(self._quota_class(), 1)], description=f"{self.operation} request",
+                                idempotent=is_idempotent(self.method))
+
+    def _next_chunk(self):
+        # Resumable upload: one call per chunk, the file is created with the last one
+        media = self.kwargs['media_body']
+        size = media.size()
+        chunk = min(media.chunksize(), size - self._upload_offset)
+        if self._upload_offset + chunk < size:
+            self.backend.call(f"{self.operation}.chunk", self._quota_class())
+            media.getbytes(self._upload_offset, chunk)
+            self._upload_offset += chunk
+            return SimpleNamespace(resumable_progress=self._upload_offset, total_size=size), None
+        return None, self.perform()
+
+    def next_chunk(self, http=None, num_retries=0):
+        return call_with_limits(self._next_chunk, [(self._quota_class(), 1)], description=f"{self.operation} upload")
+
+
+class _FakeMediaHttp:
+    # MediaIoBaseDownload talks to request.http directly
+    def __init__(self, request):
+        self.request_object = request
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        try:
+            content = self.request_object.perform()
+        except FakeApiError as e:
+            # The downloader turns a failed status into an HttpError itself
+            return e.resp, e.content
+        return FakeHttpResponse(200, {'content-length': str(len(content))}), content
+
+
+class FakeBatch:
+    def __init__(self, backend, callback=None):
+        self.backend = backend
+        self.callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self._requests.append((request_id or str(len(self._requests)), request, callback or self.callback))
+
+    def execute(self, http=None):
+        # One round trip carries every call; each call still counts against its quota
+        self.backend.call('google.batch')
+        for request_id, request, callback in self._requests:
+            try:
+                response, error = request.perform(batched=True), None
+            except Exception as e:
+                response, error = None, e
+            if callback:
+                callback(request_id, response, error)
+
+
+class FakeService:
+    def __init__(self, backend, api, path=()):
+        self._backend = backend
+        self._api = api
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def resource_or_method(**kwargs):
+            operation = '.'.join(self._path + (name,))
+            handler = getattr(self._backend, f"_{self._api}_{operation.replace('.', '_')}", None)
+            if handler is None:
+                return FakeService(self._backend, self._api, self._path + (name,))
+            return FakeRequest(self._backend, self._api, f"{self._api}.{operation}", handler, kwargs)
+        return resource_or_method
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self._backend, callback)
+
+
+class FakeGoogle(FakeBackend):
+    """
+    One mailbox, Drive and set of spreadsheets shared by the fake Gmail, Drive and Sheets services.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._ids = itertools.count(1)
+        self._state_lock = threading.RLock()
+        self.labels = [{'id': 'INBOX', 'name': 'INBOX', 'type': 'system'}]
+        self.messages = {}
+        self.attachments = {}
+        self.history = []
+        self.history_id = 1000
+        self.files = {}
+        self.changes = []
+        self.spreadsheets = {}
+        self.sheet_ids = {}
+
+    def service(self, api):
+        return FakeService(self, api)
+
+    def _new_id(self, prefix):
+        return f"{prefix}{next(self._ids):08d}"
+
+    # Test data
+
+    def add_message(self, sender, subject, attachments, inline_images=()):
+        """
+        Add an email with (filename, mimetype, bytes) attachments and return its id. Like real
+        mail, the body is a multipart/alternative (with any inline images in a multipart/related
+        next to the HTML) and the attachments follow it in the multipart/mixed payload.
+        """
+        with self._state_lock:
+            message_id = self._new_id('msg')
+            part_ids = iter(range(1, 1000))
+
+            def leaf(filename, mimetype, content, disposition):
+                attachment_id = self._new_id('att')
+                self.attachments[(message_id, attachment_id)] = base64.urlsafe_b64encode(content).decode('ascii')
+                headers = [{'name': 'Content-Type', 'value': f'{mimetype}; name="{filename}"'},
+                           {'name': 'Content-Disposition', 'value': f'{disposition}; filename="{filename}"'}]
+                if disposition == 'inline':
+                    headers.append({'name': 'Content-ID', 'value': f'<{attachment_id}@fake>'})
+                return {
+                    'partId': str(next(part_ids)),
+                    'mimeType': mimetype,
+                    'filename': filename,
+                    'headers': headers,
+                    'body': {'attachmentId': attachment_id, 'size': len(content)},
+                }
+
+            text = {'partId': '0.0', 'mimeType': 'text/plain', 'filename': '', 'body': {'size': 12, 'data': 'SGVsbG8gdGhlcmUh'}}
+            images = [leaf(*image, 'inline') for image in inline_images]
+            # The HTML shows each inline image by its Content-ID
+            markup = '<p>Hello there!</p>' + ''.join(
+                f'<img src="cid:{image["body"]["attachmentId"]}@fake">' for image in images)
+            html = {'partId': '0.1', 'mimeType': 'text/html', 'filename': '', 'body': {
+                'size': len(markup), 'data': base64.urlsafe_b64encode(markup.encode('utf-8')).decode('ascii')}}
+            if images:
+                html = {'partId': '0.1', 'mimeType': 'multipart/related', 'filename': '', 'body': {'size': 0},
+                        'parts': [html] + images}
+            body = {'partId': '0', 'mimeType': 'multipart/alternative', 'filename': '', 'body': {'size': 0}, 'parts': [text, html]}
+
+            self.messages[message_id] = {
+                'id': message_id,
+                'labelIds': ['INBOX'],
+                'payload': {
+                    'mimeType': 'multipart/mixed',
+                    'headers': [{'name': 'From', 'value': sender}, {'name': 'Subject', 'value': subject}],
+                    'parts': [body] + [leaf(*attachment, 'attachment') for attachment in attachments],
+                },
+            }
+            self.history_id += 1
+            self.history.append((self.history_id, message_id))
+            return message_id
+
+    def add_file(self, name, mimetype, content, parent):
+        with self._state_lock:
+            file_id = self._new_id('file')
+            self.files[file_id] = {
+                'id': file_id,
+                'name': name,
+                'mimeType': mimetype,
+                'parents': [parent],
+                'content': content,
+                'appProperties': {},
+                'trashed': False,
+                'webViewLink': f"https://drive.example/{file_id}",
+            }
+            self.changes.append(file_id)
+            return file_id
+
+    def sheet_rows(self, spreadsheet_id, sheet_title):
+        with self._state_lock:
+            return list(self.spreadsheets.get(spreadsheet_id, {}).get(sheet_title, []))
+
+    def files_in(self, folder_id):
+        with self._state_lock:
+            return [file for file in self.files.values() if folder_id in file['parents']]
+
+    # Gmail
+
+    def _gmail_users_labels_list(self, userId):
+        with self._state_lock:
+            return {'labels': [dict(label) for label in self.labels]}
+
+    def _gmail_users_labels_create(self, userId, body):
+        with self._state_lock:
+            label = dict(body, id=self._new_id('Label_'), type='user')
+            self.labels.append(label)
+            return label
+
+    def _gmail_users_getProfile(self, userId):
+        with self._state_lock:
+            return {'historyId': str(self.history_id)}
+
+    def _page(self, items, page_token, page_size):
+        start = int(page_token or 0)
+        end = start + page_size
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    def _gmail_users_history_list(self, userId, startHistoryId, historyTypes=None, maxResults=100, pageToken=None, **kwargs):
+        with self._state_lock:
+            entries = [
+                {'id': str(history_id), 'messagesAdded': [{'message': {'id': message_id}}]}
+                for history_id, message_id in self.history if history_id > int(startHistoryId)
+            ]
+        page, next_token = self._page(entries, pageToken, maxResults)
+        response = {'history': page, 'historyId': str(self.history_id)}
+        if next_token:
+            response['nextPageToken'] = next_token
+        return response
+
+    def _gmail_users_messages_list(self, userId, q='', maxResults=100, pageToken=None, **kwargs):
+        with self._state_lock:
+            processed = next((label['id'] for label in self.labels if label['name'] == 'processed'), None)
+            ids = [
+                message_id for message_id, message in self.messages.items()
+                if not ('-label:processed' in q and processed in message['labelIds'])
+            ]
+        page, next_token = self._page(ids, pageToken, maxResults)
+        response = {'messages': [{'id': message_id} for message_id in page]}
+        if next_token:
+            response['nextPageToken'] = next_token
+        return response
+
+    def _gmail_users_messages_get(self, userId, id, **kwargs):
+        with self._state_lock:
+            return json.loads(json.dumps(self.messages[id]))
+
+    def _gmail_users_messages_attachments_get(self, userId, messageId, id):
+        with self._state_lock:
+            data = self.attachments[(messageId, id)]
+        return {'attachmentId': id, 'size': len(data) * 3 // 4, 'data': data}
+
+    def _gmail_users_messages_batchModify(self, userId, body):
+        with self._state_lock:
+            for message_id in body['ids']:
+                labels = self.messages[message_id]['labelIds']
+                labels.extend(label for label in body.get('addLabelIds', []) if label not in labels)
+        return None
+
+    # Drive
+
+    def _file_view(self, file):
+        view = {key: value for key, value in file.items() if key != 'content'}
+        view['parents'] = list(file['parents'])
+        view['appProperties'] = dict(file['appProperties'])
+        return view
+
+    def _drive_files_get(self, fileId, fields=None, **kwargs):
+        with self._state_lock:
+            return self._file_view(self.files[fileId])
+
+    def _drive_files_get_media(self, fileId, **kwargs):
+        with self._state_lock:
+            return self.files[fileId]['content']
+
+    def _drive_files_list(self, q='', pageSize=100, pageToken=None, **kwargs):
+        folder = re.search(r"'([^']+)' in parents", q)
+        name = re.search(r"name = '((?:[^'\\]|\\.)*)'", q)
+        invoices_only = "mimeType contains 'image/'" in q
+        mimetype = None if invoices_only else re.search(r"mimeType = '([^']+)'", q)
+        with self._state_lock:
+            files = [
+                self._file_view(file) for file in self.files.values()
+                if (not folder or folder.group(1) in file['parents'])
+                and not file['trashed']
+                and (not name or file['name'] == re.sub(r"\\(.)", r"\1", name.group(1)))
+                and (not mimetype or file['mimeType'] == mimetype.group(1))
+                and (not invoices_only or file['mimeType'] == 'application/pdf' or file['mimeType'].startswith('image/'))
+            ]
+        page, next_token = self._page(files, pageToken, pageSize)
+        response = {'files': page}
+        if next_token:
+            response['nextPageToken'] = next_token
+        return response
+
+    def _drive_files_create(self, body, media_body=None, fields=None, **kwargs):
+        content = media_body.getbytes(0, media_body.size()) if media_body is not None else b''
+        mimetype = body.get('mimeType') or (media_body.mimetype() if media_body is not None else 'application/octet-stream')
+        file_id = self.add_file(body.get('name', 'Untitled'), mimetype, content, (body.get('parents') or ['root'])[0])
+        return self._drive_files_get(file_id)
+
+    def _drive_files_update(self, fileId, body=None, addParents=None, removeParents=None, fields=None, **kwargs):
+        with self._state_lock:
+            file = self.files[fileId]
+            if removeParents:
+                file['parents'] = [parent for parent in file['parents'] if parent not in removeParents.split(',')]
+            if addParents:
+                file['parents'].extend(addParents.split(','))
+            for key, value in ((body or {}).get('appProperties') or {}).items():
+                if value is None:
+                    file['appProperties'].pop(key, None)
+                else:
+                    file['appProperties'][key] = str(value)
+            self.changes.append(fileId)
+            return self._file_view(file)
+
+    def _drive_changes_getStartPageToken(self, **kwargs):
+        with self._state_lock:
+            return {'startPageToken': str(len(self.changes))}
+
+    def _drive_changes_list(self, pageToken, pageSize=100, **kwargs):
+        with self._state_lock:
+            start = int(pageToken)
+            file_ids = self.changes[start:start + pageSize]
+            changes = [{'fileId': file_id, 'file': self._file_view(self.files[file_id])} for file_id in file_ids]
+            end = start + len(file_ids)
+            response = {'changes': changes}
+            if end < len(self.changes):
+                response['nextPageToken'] = str(end)
+            else:
+                response['newStartPageToken'] = str(end)
+            return response
+
+    # Sheets
+
+    def _sheet(self, spreadsheet_id, title):
+        # Spreadsheets named in the configuration exist without being created first
+        return self.spreadsheets.setdefault(spreadsheet_id, {}).setdefault(title, [])
+
+    def _sheets_spreadsheets_create(self, body, **kwargs):
+        with self._state_lock:
+            title = body.get('properties', {}).get('title', 'Untitled')
+            spreadsheet_id = self.add_file(title, 'application/vnd.google-apps.spreadsheet', b'', 'root')
+            for sheet in body.get('sheets', [{'properties': {'title': 'Sheet1'}}]):
+                self._sheet(spreadsheet_id, sheet['properties']['title'])
+            return {'spreadsheetId': spreadsheet_id, 'properties': {'title': title}}
+
+    def _sheets_spreadsheets_batchUpdate(self, spreadsheetId, body, **kwargs):
+        # addSheet and updateCells, the requests the workbook output mode sends
+        with self._state_lock:
+            sheets = self.spreadsheets.setdefault(spreadsheetId, {})
+            sheet_titles = self.sheet_ids.setdefault(spreadsheetId, {})
+            replies = []
+            for request in body['requests']:
+                if 'addSheet' in request:
+                    properties = request['addSheet']['properties']
+                    if properties['title'] in sheets or properties.get('sheetId') in sheet_titles:
+                        raise FakeApiError(400, reason=f"A sheet with the name \"{properties['title']}\" already exists")
+                    sheet_titles[properties.get('sheetId', len(sheets))] = properties['title']
+                    sheets[properties['title']] = []
+                    replies.append({'addSheet': {'properties': properties}})
+                elif 'updateCells' in request:
+                    update = request['updateCells']
+                    rows = sheets[sheet_titles[update['start']['sheetId']]]
+                    start = update['start'].get('rowIndex', 0)
+                    for offset, row in enumerate(update['rows']):
+                        values = [next(iter(cell['userEnteredValue'].values())) for cell in row['values']]
+                        rows.extend([] for _ in range(start + offset + 1 - len(rows)))
+                        rows[start + offset] = values
+                    replies.append({})
+                else:
+                    raise FakeApiError(400, reason=f"Unsupported request {list(request)}")
+            return {'spreadsheetId': spreadsheetId, 'replies': replies}
+
+    def _sheets_spreadsheets_values_append(self, spreadsheetId, range, body, **kwargs):
+        with self._state_lock:
+            rows = self._sheet(spreadsheetId, range.split('!')[0])
+            rows.extend(body.get('values', []))
+            return {'spreadsheetId': spreadsheetId, 'updates': {'updatedRows': len(body.get('values', []))}}
+
+
+# --- Form Recognizer ---
+
+class FakeFormRecognizer(FakeBackend):
+    """
+    Fake of the async DocumentAnalysisClient. Analyses take analysis_seconds plus
+    page_seconds per page; throttled or failed submissions are retried the way the
+    SDK's retry policy would, adding calls and delay.
+    """
+    def __init__(self, invoices, analysis_seconds=2.0, page_seconds=0.2, poll_interval=1.0, sdk_retries=3, **kwargs):
+        super().__init__(**kwargs)
+        self.invoices = invoices
+        self.analysis_seconds = analysis_seconds
+        self.page_seconds = page_seconds
+        self.poll_interval = poll_interval
+        self.sdk_retries = sdk_retries
+
+    def client(self):
+        return _FakeAnalysisClient(self)
+
+    async def acall(self, operation, quota_class=None):
+        for attempt in range(self.sdk_retries + 1):
+            delay, error = self._admit(operation, quota_class)
+            await asyncio.sleep(delay)
+            if error is None:
+                return
+            if attempt == self.sdk_retries:
+                raise error
+            retry_after = error.response.headers.get('retry-after')
+            await asyncio.sleep(float(retry_after) if retry_after else 0.8 * 2 ** attempt)
+
+
+class _FakeAnalysisClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def begin_analyze_document(self, model_id, document, polling=None, pages=None, **kwargs):
+        await self.backend.acall('azure.analyze', 'azure')
+        invoice = self.backend.invoices.by_sha256.get(hashlib.sha256(document).hexdigest())
+        if invoice is None:
+            raise FakeApiError(400, reason='InvalidContent')
+        return _FakePoller(self.backend, invoice, pages)
+
+    async def close(self):
+        pass
+
+
+class _FakePoller:
+    def __init__(self, backend, invoice, pages):
+        self.backend = backend
+        self.invoice = invoice
+        self.pages = pages
+
+    async def result(self):
+        from azure.ai.formrecognizer import AnalyzeResult
+
+        data = analyze_result_dict(self.invoice, self.pages)
+        duration = self.backend.analysis_seconds + self.backend.page_seconds * len(data['pages'])
+        polls = max(1, int(duration / self.backend.poll_interval))
+        for _ in range(polls):
+            await asyncio.sleep(duration / polls)
+            await self.backend.acall('azure.poll')
+        return AnalyzeResult.from_dict(data)
+
+
+# --- OpenAI ---
+
+PACKED_DELIMITER = re.compile(r'^=== INVOICE (\d+) ===$', re.M)
+
+
+class FakeOpenAI(FakeBackend):
+    """
+    Fake OpenAI client answering extraction prompts with the rows of the synthetic invoices
+    found in the text, in the single or packed answer format. Also covers the Batch API.
+    """
+    def __init__(self, invoices, base_seconds=0.5, seconds_per_output_token=0.002, batch_seconds=5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.invoices = invoices
+        self.base_seconds = base_seconds
+        self.seconds_per_output_token = seconds_per_output_token
+        self.batch_seconds = batch_seconds
+        self.tokens = Counter()
+        self._files = {}
+        self._batches = {}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _answer(self, messages):
+        text = messages[0]['content']
+        if PACKED_DELIMITER.search(text):
+            sections = PACKED_DELIMITER.split(text)[1:]
+            return repr({
+                label: self.invoices.rows_in_text(section) or "no data"
+                for label, section in zip(sections[::2], sections[1::2])
+            })
+        rows = self.invoices.rows_in_text(text)
+        return repr(rows) if rows else "no data"
+
+    def _completion(self, messages):
+        answer = self._answer(messages)
+        prompt_tokens = sum(len(message['content']) for message in messages) // 4
+        completion_tokens = len(answer) // 4
+        return answer, prompt_tokens, completion_tokens
+
+    def _create_completion(self, model, messages, **kwargs):
+        answer, prompt_tokens, completion_tokens = self._completion(messages)
+        quota_error = None
+        for quota_class, cost in (('openai_requests', 1), ('openai_tokens', prompt_tokens + completion_tokens)):
+            quota = self.quotas.get(quota_class)
+            retry_after = quota.take(cost) if quota else None
+            if retry_after is not None:
+                quota_error = FakeApiError(429, retry_after, 'rate_limit_exceeded')
+
+        self.call('openai.chat.completions', latency=self.base_seconds + completion_tokens * self.seconds_per_output_token)
+        if quota_error:
+            with self._lock:
+                self.throttled += 1
+            raise quota_error
+
+        with self._lock:
+            self.tokens['prompt'] += prompt_tokens
+            self.tokens['completion'] += completion_tokens
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=answer))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+        )
+
+    def _create_file(self, file, purpose):
+        self.call('openai.files.create')
+        name, handle = file
+        file_id = f"file-{len(self._files) + 1}"
+        self._files[file_id] = handle.read().decode('utf-8')
+        return SimpleNamespace(id=file_id, filename=name, purpose=purpose)
+
+    def _file_content(self, file_id):
+        self.call('openai.files.content')
+        return SimpleNamespace(text=self._files[file_id])
+
+    def _create_batch(self, input_file_id, endpoint, completion_window, **kwargs):
+        self.call('openai.batches.create')
+        lines = []
+        for line in self._files[input_file_id].splitlines():
+            request = json.loads(line)
+            answer, prompt_tokens, completion_tokens = self._completion(request['body']['messages'])
+            with self._lock:
+                self.tokens['prompt'] += prompt_tokens
+                self.tokens['completion'] += completion_tokens
+            lines.append(json.dumps({
+                'custom_id': request['custom_id'],
+                'response': {'status_code': 200, 'body': {
+                    'choices': [{'message': {'role': 'assistant', 'content': answer}}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens},
+                }},
+                'error': None,
+            }))
+        batch_id = f"batch-{len(self._batches) + 1}"
+        output_file_id = f"file-{len(self._files) + 1}"
+        self._files[output_file_id] = "\n".join(lines)
+        self._batches[batch_id] = (time.time() + self.batch_seconds, output_file_id, len(lines))
+        return self._retrieve_batch(batch_id, count=False)
+
+    def _retrieve_batch(self, batch_id, count=True):
+        if count:
+            self.call('openai.batches.retrieve')
+        done_at, output_file_id, total = self._batches[batch_id]
+        done = time.time() >= done_at
+        return SimpleNamespace(
+            id=batch_id,
+            status='completed' if done else 'in_progress',
+            output_file_id=output_file_id if done else None,
+            error_file_id=None,
+            request_counts=SimpleNamespace(total=total, completed=total if done else 0, failed=0)
+        )
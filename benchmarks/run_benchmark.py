@@ -0,0 +1,261 @@
+"""
+Offline end-to-end benchmark of the invoice automation against in-process fakes.
+
+    python benchmarks/run_benchmark.py --invoices 200 --google-latency 0.05 --error-rate 0.01
+
+A synthetic inbox of N emails with one invoice each is drained by process_gmail_attachments,
+then process_drive_files extracts the uploads (with --handoff the Gmail run feeds the
+pipeline directly). --source drive skips Gmail and puts the invoices in the input folder.
+
+Reports invoices per minute, p50/p95 per-invoice latency (the elapsed time logged for each
+invoice), mean seconds per pipeline stage, API calls per invoice and peak RSS; --json writes the same numbers so runs can be
+compared. Exits non-zero when the main sheet does not hold exactly the expected rows. Settings of the application itself (LLM_MODE, OCR_MAX_IN_FLIGHT, ...) are read
+from the environment as usual.
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import resource
+import tempfile
+import contextlib
+from collections import Counter
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+INPUT_FOLDER = 'fake-input-folder'
+GMAIL_FOLDER = 'fake-gmail-folder'
+DRIVE_LOG_SHEET = 'fake-drive-log'
+MAIN_SHEET = 'fake-main-sheet'
+
+# Quota name -> (client-side limiter variable, factor from per-minute)
+CLIENT_QUOTA_ENV = {
+    'sheets_write': ('SHEETS_WRITES_PER_MINUTE', 1),
+    'sheets_read': ('SHEETS_READS_PER_MINUTE', 1),
+    'drive': ('DRIVE_REQUESTS_PER_MINUTE', 1),
+    'gmail': ('GMAIL_REQUESTS_PER_MINUTE', 1),
+    'azure': ('AZURE_TRANSACTIONS_PER_SECOND', 1 / 60),
+    'openai_requests': ('OPENAI_REQUESTS_PER_MINUTE', 1),
+    'openai_tokens': ('OPENAI_TOKENS_PER_MINUTE', 1),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--invoices', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=1, help='pages per invoice')
+    parser.add_argument('--items', type=int, default=5, help='line items per page')
+    parser.add_argument('--text-layer', type=float, default=0.0, help='share of invoices that are generated PDFs with a text layer')
+    parser.add_argument('--source', choices=('gmail', 'drive'), default='gmail')
+    parser.add_argument('--mail-noise', action='store_true',
+                        help='give every email a signature logo, a calendar invite and the invoice attached twice')
+    parser.add_argument('--handoff', action='store_true', help='hand Gmail attachments straight to the pipeline')
+    parser.add_argument('--google-latency', type=float, default=0.05, help='seconds per Gmail/Drive/Sheets call')
+    parser.add_argument('--azure-seconds', type=float, default=2.0, help='seconds per analysis')
+    parser.add_argument('--azure-page-seconds', type=float, default=0.2, help='extra analysis seconds per page')
+    parser.add_argument('--llm-seconds', type=float, default=0.5, help='base seconds per completion')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls failing with 503')
+    parser.add_argument('--quota', action='append', default=[], metavar='NAME=PER_MINUTE',
+                        help=f"server quota, also applied to the client limiter ({', '.join(CLIENT_QUOTA_ENV)})")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir):
+    # Must run before the application modules are imported, since they read settings at import time
+    defaults = {
+        'INPUT_DRIVE_FOLDER_ID': INPUT_FOLDER,
+        'GMAIL_ATTACHMENTS_FOLDER_ID': GMAIL_FOLDER,
+        'PROCESSED_FOLDER_ID': 'fake-processed-folder',
+        'FAILED_FOLDER_ID': 'fake-failed-folder',
+        'OUTPUT_DRIVE_FOLDER_ID': 'fake-output-folder',
+        'MAIN_OUTPUT_SHEET_ID': MAIN_SHEET,
+        'DRIVE_LOG_SPREADSHEET_ID': DRIVE_LOG_SHEET,
+        'GMAIL_LOG_SPREADSHEET_ID': 'fake-gmail-log',
+        'OPENAI_API': 'fake-key',
+        'OPENAI_MODEL': 'fake-model',
+        'AZURE_ENDPOINT': 'https://fake.cognitiveservices.azure.com/',
+        'AZURE_KEY': 'fake-key',
+        'OCR_CACHE_ENABLED': '0',
+        'LLM_CACHE_ENABLED': '0',
+        'LEASE_BACKEND': 'none',
+        # Synthetic PDFs are far smaller than real ones
+        'ATTACHMENT_MIN_BYTES': '256',
+        'JOB_LEDGER_PATH': os.path.join(workdir, 'job_ledger.sqlite3'),
+        'SYNC_STATE_PATH': os.path.join(workdir, 'sync_state.json'),
+    }
+    # Client-side limits are off unless a quota is given, so the code's own throughput shows
+    for env_name, _ in CLIENT_QUOTA_ENV.values():
+        defaults[env_name] = '0'
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+    for name, per_minute in server_quotas(args).items():
+        env_name, factor = CLIENT_QUOTA_ENV[name]
+        os.environ[env_name] = str(per_minute * factor)
+
+
+def server_quotas(args):
+    quotas = {}
+    for entry in args.quota:
+        name, _, per_minute = entry.partition('=')
+        if name not in CLIENT_QUOTA_ENV:
+            raise SystemExit(f"Unknown quota '{name}', expected one of {', '.join(CLIENT_QUOTA_ENV)}")
+        quotas[name] = float(per_minute)
+    return quotas
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def rows_match(report):
+    return report['rows_written'] == report['rows_written_correctly'] == report['rows_expected']
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix='invoice-benchmark-')
+    configure_environment(args, workdir)
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(workdir)
+
+    from synthetic_invoices import InvoiceSet
+    from fake_backends import FakeGoogle, FakeFormRecognizer, FakeOpenAI
+    import google_auth
+    import ocr_engine
+    import drive_app
+    import gmail_app
+    import metrics
+    from sheets_writer import flush_sheets_writer
+
+    quotas = {name: per_minute / 60 for name, per_minute in server_quotas(args).items()}
+    invoices = InvoiceSet(args.invoices, pages=args.pages, items=args.items, seed=args.seed, text_layer=args.text_layer)
+    google = FakeGoogle(latency=args.google_latency, error_rate=args.error_rate, quotas=quotas, seed=args.seed)
+    azure = FakeFormRecognizer(invoices, analysis_seconds=args.azure_seconds, page_seconds=args.azure_page_seconds,
+                               error_rate=args.error_rate, quotas=quotas, seed=args.seed + 1)
+    openai = FakeOpenAI(invoices, base_seconds=args.llm_seconds, error_rate=args.error_rate, quotas=quotas, seed=args.seed + 2)
+
+    for api, version in (('gmail', 'v1'), ('drive', 'v3'), ('sheets', 'v4')):
+        google_auth.register_service(api, version, google.service(api))
+    ocr_engine.set_ocr_engine(ocr_engine.OcrEngine(
+        ocr_engine.AZURE_ENDPOINT,
+        ocr_engine.AZURE_KEY,
+        max_in_flight=ocr_engine.ocr_max_in_flight,
+        initial_delay=ocr_engine.ocr_poll_initial_delay,
+        max_delay=ocr_engine.ocr_poll_max_delay,
+        client_factory=azure.client
+    ))
+    drive_app.set_openai_client(openai)
+
+    for invoice in invoices:
+        if args.source == 'gmail':
+            attachments = [(invoice.filename, 'application/pdf', invoice.pdf_bytes)]
+            inline_images = []
+            if args.mail_noise:
+                attachments += [('invite.ics', 'text/calendar', b'BEGIN:VCALENDAR\nEND:VCALENDAR\n' * 20),
+                                (f"copy of {invoice.filename}", 'application/pdf', invoice.pdf_bytes)]
+                inline_images.append(('logo.png', 'image/png', bytes(2048)))
+            google.add_message(f"billing@{invoice.vendor.split()[0].lower()}.example", f"Invoice {invoice.number}",
+                               attachments, inline_images)
+        else:
+            google.add_file(invoice.filename, 'application/pdf', invoice.pdf_bytes, INPUT_FOLDER)
+
+    phases = {}
+    output = io.StringIO()
+    started = time.time()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+        if args.source == 'gmail':
+            phase_start = time.time()
+            if args.handoff:
+                pipeline = drive_app.start_invoice_pipeline()
+                try:
+                    gmail_app.process_gmail_attachments(handoff=pipeline.submit)
+                finally:
+                    pipeline.close()
+            else:
+                gmail_app.process_gmail_attachments()
+            phases['gmail'] = time.time() - phase_start
+
+        phase_start = time.time()
+        drive_app.process_drive_files()
+        flush_sheets_writer()
+        phases['drive'] = time.time() - phase_start
+    elapsed = time.time() - started
+
+    successes = google.sheet_rows(DRIVE_LOG_SHEET, 'Invoices Successes')
+    failures = google.sheet_rows(DRIVE_LOG_SHEET, 'Invoices Failed')
+    latencies = [float(row[9]) for row in successes]
+
+    expected = {tuple(row) for invoice in invoices for row in invoice.expected_rows()}
+    written = [tuple(str(cell) for cell in row) for row in google.sheet_rows(MAIN_SHEET, 'Sheet1')]
+    backends = {'google': google, 'azure': azure, 'openai': openai}
+    calls = {name: sum(backend.calls.values()) for name, backend in backends.items()}
+    skipped = {counter['labels']['reason']: counter['value'] for counter in metrics.registry.snapshot()['counters'] if counter['name'] == 'gmail_attachments_skipped_total'}
+    text_layer = {counter['labels']['outcome']: counter['value'] for counter in metrics.registry.snapshot()['counters'] if counter['name'] == 'text_layer_total'}
+    stage_totals = [histogram for histogram in metrics.registry.snapshot()['histograms'] if histogram['name'] == 'invoice_total_stage_seconds']
+
+    report = {
+        'invoices': len(invoices),
+        'succeeded': len(successes),
+        'failed': len(failures),
+        'elapsed_seconds': round(elapsed, 2),
+        'phase_seconds': {name: round(seconds, 2) for name, seconds in phases.items()},
+        'invoices_per_minute': round(len(successes) / elapsed * 60, 1) if elapsed else None,
+        'latency_p50_seconds': percentile(latencies, 0.50),
+        'latency_p95_seconds': percentile(latencies, 0.95),
+        'stage_seconds_mean': {histogram['labels']['stage']: round(histogram['sum'] / histogram['count'], 2) for histogram in stage_totals},
+        'rows_expected': len(expected),
+        'rows_written_correctly': len(expected & set(written)),
+        'rows_written': len(written),
+        'api_calls': calls,
+        'api_calls_per_invoice': {name: round(count / len(invoices), 2) for name, count in calls.items()},
+        'http_round_trips_per_invoice': {name: round(backend.round_trips / len(invoices), 2) for name, backend in backends.items()},
+        'attachments_skipped': skipped,
+        'text_layer_outcomes': text_layer,
+        'throttled': {name: backend.throttled for name, backend in backends.items()},
+        'injected_errors': {name: backend.errors for name, backend in backends.items()},
+        'llm_tokens': dict(openai.tokens),
+        'calls_by_operation': dict(sum((backend.calls for backend in backends.values()), Counter()).most_common()),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'settings': {key: os.environ.get(key) for key in ('LLM_MODE', 'OCR_MAX_IN_FLIGHT', 'OCR_WORKERS', 'LLM_WORKERS', 'DRIVE_DISCOVERY', 'TEXT_LAYER_ENABLED', 'OUTPUT_MODE')},
+    }
+
+    for key in ('invoices', 'succeeded', 'failed', 'elapsed_seconds', 'invoices_per_minute',
+                'latency_p50_seconds', 'latency_p95_seconds', 'stage_seconds_mean', 'rows_written_correctly', 'rows_written', 'rows_expected',
+                'api_calls_per_invoice', 'http_round_trips_per_invoice', 'attachments_skipped', 'text_layer_outcomes', 'throttled', 'peak_rss_mb'):
+        print(f"{key:>30}: {report[key]}")
+    if not rows_match(report):
+        # Missing rows mean lost invoices, extra rows mean invoices written twice
+        print(f"ROW MISMATCH: {report['rows_written']} rows written ({report['rows_written_correctly']} correct), "
+              f"{report['rows_expected']} expected", file=sys.stderr)
+
+    # METRICS_FILE, if set, gets the application's own metrics as after a normal run
+    metrics.dump_metrics()
+    if json_path:
+        with open(json_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    sys.exit(0 if rows_match(main()) else 1)
@@ -0,0 +1,92 @@
+"""
+Cold-start import time of app.py per command, checked against a budget.
+
+    python benchmarks/startup_benchmark.py --runs 5
+
+Every run is a fresh interpreter that imports app and then the modules the command loads
+(app.COMMAND_MODULES), which is what a cron or container start pays before any work is
+done. Reports the median per command and exits non-zero when one is over its budget;
+--importtime lists the slowest imports of each command.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+from statistics import median
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Milliseconds from interpreter start-up to the command being ready to run
+STARTUP_BUDGET_MS = {
+    'all': 500,
+    'gmail': 400,
+    'drive': 500,
+    'single-file': 500,
+    'reprocess-failed': 500,
+    'daemon': 500,
+}
+
+MEASURE = """
+import time
+started = time.perf_counter()
+import importlib
+import app
+for module in app.COMMAND_MODULES[{command!r}]:
+    importlib.import_module(module)
+print(round((time.perf_counter() - started) * 1000, 1))
+"""
+
+
+def measure(command, importtime=False):
+    result = subprocess.run(
+        [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', MEASURE.format(command=command)],
+        cwd=REPO_DIR, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_output, count):
+    # Lines look like "import time: self [us] | cumulative | name", nested imports indented
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.strip() != 'app':
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--command', action='append', choices=sorted(STARTUP_BUDGET_MS), help='only these commands')
+    parser.add_argument('--importtime', action='store_true', help='list the slowest imports of each command')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args(argv)
+
+    report = {}
+    over_budget = []
+    for command in args.command or STARTUP_BUDGET_MS:
+        timings = [measure(command)[0] for _ in range(args.runs)]
+        budget = STARTUP_BUDGET_MS[command]
+        report[command] = {'median_ms': median(timings), 'max_ms': max(timings), 'budget_ms': budget}
+        status = 'ok' if median(timings) <= budget else 'OVER BUDGET'
+        if status != 'ok':
+            over_budget.append(command)
+        print(f"{command:>18}: {median(timings):7.1f} ms median, {max(timings):7.1f} ms max, budget {budget} ms  {status}")
+
+        if args.importtime:
+            for cumulative, name in slowest_imports(measure(command, importtime=True)[1], 8):
+                print(f"{'':>20}{cumulative / 1000:7.1f} ms  {name}")
+
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+import io
+import re
+import random
+import hashlib
+from datetime import date, timedelta
+
+PRODUCTS = ['Steel Bracket', 'Copper Wire', 'Printer Paper', 'LED Panel', 'Hydraulic Pump', 'Safety Gloves', 'Cable Tray', 'Toner Cartridge']
+UNITS = ['pcs', 'kg', 'box', 'm', 'set']
+VENDORS = ['Acme Supplies Pvt Ltd', 'Globex Industrial', 'Initech Traders', 'Umbrella Components', 'Stark Hardware Co']
+
+ITEM_PATTERN = re.compile(r'Part (INV-\d+)-(\d+)')
+
+TABLE_HEADER = ['Item', 'Qty', 'UOM', 'Rate', 'Amount']
+
+
+class SyntheticInvoice:
+    def __init__(self, number, invoice_date, vendor, items, pages, text_layer=False):
+        self.number = number
+        self.date = invoice_date
+        self.vendor = vendor
+        self.items = items
+        self.pages = pages
+        self.text_layer = text_layer
+        self.filename = f"{number}.pdf"
+        # A generated invoice carries its text; a scanned one is pages without any
+        self.pdf_bytes = _text_pdf(self) if text_layer else _blank_pdf(pages, number)
+        self.sha256 = hashlib.sha256(self.pdf_bytes).hexdigest()
+
+    @property
+    def total(self):
+        return sum(item['value'] for item in self.items)
+
+    def page_items(self, page_number):
+        # Items are spread evenly over the pages; the first page also carries the header block
+        per_page = max(1, -(-len(self.items) // self.pages))
+        return self.items[(page_number - 1) * per_page:page_number * per_page]
+
+    def expected_rows(self, items=None):
+        return [
+            [self.date, "Purchase", self.number, self.vendor, str(self.total), "Cr",
+             item['name'], str(item['quantity']), item['uom'], str(item['rate']), str(item['value'])]
+            for item in (self.items if items is None else items)
+        ]
+
+
+def _blank_pdf(pages, title):
+    # A real PDF so page counting and page-range splitting behave as in production
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    writer.add_metadata({'/Title': title})
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def _pdf_string(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+def _text_pdf(invoice):
+    # Same lines as analyze_result_dict, drawn in Helvetica with the table in columns
+    from pypdf import PdfWriter
+    from pypdf.generic import ContentStream, DictionaryObject, NameObject
+
+    font = DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+        NameObject('/Encoding'): NameObject('/WinAnsiEncoding'),
+    })
+    columns = (40, 300, 360, 410, 480)
+
+    writer = PdfWriter()
+    for page_number in range(1, invoice.pages + 1):
+        placed = []
+        y = 800
+
+        def line(*cells):
+            nonlocal y
+            for x, cell in zip(columns, cells):
+                placed.append((x, y, cell))
+            y -= 14
+
+        if page_number == 1:
+            line(invoice.vendor)
+            line("TAX INVOICE")
+            line(f"Invoice Number: {invoice.number}")
+            line(f"Date: {invoice.date}")
+            line(f"Vendor: {invoice.vendor}")
+            line("Bill To: Example Buyer Pvt Ltd")
+            y -= 14
+        items = invoice.page_items(page_number)
+        if items:
+            line(*TABLE_HEADER)
+            for item in items:
+                line(item['name'], str(item['quantity']), item['uom'], str(item['rate']), str(item['value']))
+        if page_number == invoice.pages:
+            y -= 14
+            line(f"Total: {invoice.total}")
+        line("Thank you for your business")
+
+        page = writer.add_blank_page(width=595, height=842)
+        page[NameObject('/Resources')] = DictionaryObject({NameObject('/Font'): DictionaryObject({NameObject('/F1'): font})})
+        operations = "\n".join(f"BT /F1 9 Tf {x} {y} Td {_pdf_string(text)} Tj ET" for x, y, text in placed)
+        content = ContentStream(None, None)
+        content.set_data(operations.encode('latin-1'))
+        page.replace_contents(content)
+
+    writer.add_metadata({'/Title': invoice.number})
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+class InvoiceSet:
+    """
+    Deterministic synthetic invoices, looked up by the fakes from document bytes or item names.
+    """
+    def __init__(self, count, pages=1, items=5, seed=0, text_layer=0.0):
+        # items is the number of line items per page; text_layer is the share of generated
+        # (rather than scanned) PDFs
+        rng = random.Random(seed)
+        self.invoices = []
+        for index in range(count):
+            number = f"INV-{index + 1:06d}"
+            line_items = []
+            for item_index in range(items * pages):
+                quantity = rng.randint(1, 50)
+                rate = rng.randint(10, 900)
+                line_items.append({
+                    'name': f"Part {number}-{item_index + 1:03d} {rng.choice(PRODUCTS)}",
+                    'quantity': quantity,
+                    'uom': rng.choice(UNITS),
+                    'rate': rate,
+                    'value': quantity * rate,
+                })
+            invoice_date = (date(2024, 1, 1) + timedelta(days=rng.randint(0, 365))).strftime('%d/%m/%Y')
+            generated = index < round(count * text_layer)
+            self.invoices.append(SyntheticInvoice(number, invoice_date, rng.choice(VENDORS), line_items, pages, generated))
+
+        self.by_sha256 = {invoice.sha256: invoice for invoice in self.invoices}
+        self.by_number = {invoice.number: invoice for invoice in self.invoices}
+
+    def __iter__(self):
+        return iter(self.invoices)
+
+    def __len__(self):
+        return len(self.invoices)
+
+    def rows_in_text(self, text):
+        """
+        The rows an accurate extraction of text would return: one per line item that appears in it.
+        """
+        rows = []
+        seen = set()
+        for number, item_number in ITEM_PATTERN.findall(text):
+            invoice = self.by_number.get(number)
+            if invoice is None or (number, item_number) in seen:
+                continue
+            seen.add((number, item_number))
+            rows.extend(invoice.expected_rows([invoice.items[int(item_number) - 1]]))
+        return rows
+
+
+def analyze_result_dict(invoice, pages=None):
+    """
+    Form Recognizer result (as accepted by AnalyzeResult.from_dict) for an invoice, limited to
+    a page range like "1-10" when given.
+    """
+    if pages:
+        first, _, last = pages.partition('-')
+        page_numbers = range(int(first), int(last or first) + 1)
+    else:
+        page_numbers = range(1, invoice.pages + 1)
+
+    content_lines = []
+    offset = 0
+
+    def add_line(text):
+        nonlocal offset
+        span = {'offset': offset, 'length': len(text)}
+        content_lines.append(text)
+        offset += len(text) + 1
+        return span
+
+    def region(page_number):
+        return [{'page_number': page_number, 'polygon': [{'x': 0, 'y': 0}, {'x': 1, 'y': 0}, {'x': 1, 'y': 1}, {'x': 0, 'y': 1}]}]
+
+    page_dicts = []
+    tables = []
+    key_value_pairs = []
+    for page_number in page_numbers:
+        lines = []
+
+        def line(text):
+            span = add_line(text)
+            lines.append({'content': text, 'polygon': [], 'spans': [span]})
+            return span
+
+        if page_number == 1:
+            line(invoice.vendor)
+            line("TAX INVOICE")
+            for key, value in (('Invoice Number', invoice.number), ('Date', invoice.date), ('Vendor', invoice.vendor)):
+                span = line(f"{key}: {value}")
+                key_span = {'offset': span['offset'], 'length': len(key) + 1}
+                value_span = {'offset': span['offset'] + len(key) + 2, 'length': len(value)}
+                key_value_pairs.append({
+                    'key': {'content': f"{key}:", 'bounding_regions': region(1), 'spans': [key_span]},
+                    'value': {'content': value, 'bounding_regions': region(1), 'spans': [value_span]},
+                    'confidence': 0.98,
+                })
+            line("Bill To: Example Buyer Pvt Ltd")
+
+        items = invoice.page_items(page_number)
+        if items:
+            table_rows = [TABLE_HEADER] + [
+                [item['name'], str(item['quantity']), item['uom'], str(item['rate']), str(item['value'])]
+                for item in items
+            ]
+            table_start = offset
+            cells = []
+            for row_index, row in enumerate(table_rows):
+                for column_index, cell in enumerate(row):
+                    span = line(cell)
+                    cells.append({
+                        'kind': 'columnHeader' if row_index == 0 else 'content',
+                        'row_index': row_index,
+                        'column_index': column_index,
+                        'row_span': 1,
+                        'column_span': 1,
+                        'content': cell,
+                        'bounding_regions': region(page_number),
+                        'spans': [span],
+                    })
+            tables.append({
+                'row_count': len(table_rows),
+                'column_count': len(TABLE_HEADER),
+                'cells': cells,
+                'bounding_regions': region(page_number),
+                'spans': [{'offset': table_start, 'length': offset - table_start}],
+            })
+
+        if page_number == invoice.pages:
+            line(f"Total: {invoice.total}")
+        # Repeated on every page, like a real letterhead footer
+        line("Thank you for your business")
+
+        page_dicts.append({
+            'page_number': page_number,
+            'angle': 0,
+            'width': 8.5,
+            'height': 11,
+            'unit': 'inch',
+            'lines': lines,
+            'words': [],
+            'selection_marks': [],
+            'spans': [],
+        })
+
+    return {
+        'api_version': '2023-07-31',
+        'model_id': 'prebuilt-document',
+        'content': "\n".join(content_lines),
+        'pages': page_dicts,
+        'tables': tables,
+        'key_value_pairs': key_value_pairs,
+        'paragraphs': [],
+        'styles': [],
+        'languages': [],
+        'documents': [],
+    }
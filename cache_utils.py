@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+class DiskCache:
+    """
+    Persistent key/value cache stored in a SQLite file.
+
+    Values are JSON-serialisable objects. Entries older than ttl_seconds are treated as
+    missing, and the least recently used entries are evicted once the stored values
+    exceed max_bytes.
+    """
+    def __init__(self, path, max_bytes, ttl_seconds=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+            'created REAL NOT NULL, accessed REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            value, created = row
+            if self.ttl_seconds and now - created > self.ttl_seconds:
+                self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self._conn.commit()
+                return None
+
+            self._conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+
+        return json.loads(value)
+
+    def set(self, key, value):
+        data = json.dumps(value, default=str)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, data, len(data), now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self._conn.commit()
+
+    def _evict(self):
+        if self.ttl_seconds:
+            self._conn.execute('DELETE FROM entries WHERE created < ?', (time.time() - self.ttl_seconds,))
+
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in self._conn.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+            self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+        logging.info(f"Cache {self.path} evicted entries down to {total} bytes.")
+
+
+def open_cache(name, default_path, default_max_mb, default_ttl_days):
+    """
+    Build a DiskCache from <NAME>_CACHE_* environment variables, or None when disabled.
+    """
+    prefix = name.upper()
+    if os.getenv(f'{prefix}_CACHE_ENABLED', '1') != '1':
+        return None
+
+    path = os.getenv(f'{prefix}_CACHE_PATH', default_path)
+    max_bytes = int(float(os.getenv(f'{prefix}_CACHE_MAX_MB', str(default_max_mb))) * 1024 * 1024)
+    ttl_days = float(os.getenv(f'{prefix}_CACHE_TTL_DAYS', str(default_ttl_days)))
+
+    try:
+        return DiskCache(path, max_bytes, ttl_seconds=ttl_days * 86400 if ttl_days > 0 else None)
+    except Exception as e:
+        logging.error(f"Could not open {name} cache at {path}, continuing without it: {e}")
+        return None
+
+
+def cache_getter(name, default_path, default_max_mb, default_ttl_days):
+    """
+    Return a function that opens the cache (see open_cache) on first use and then keeps
+    returning it, so importing a module does not touch the disk.
+    """
+    lock = threading.Lock()
+    opened = []
+
+    def get_cache():
+        with lock:
+            if not opened:
+                opened.append(open_cache(name, default_path, default_max_mb, default_ttl_days))
+            return opened[0]
+    return get_cache
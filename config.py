@@ -0,0 +1,27 @@
+import os
+import logging
+import threading
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_lock = threading.Lock()
+_environment_loaded = False
+
+
+def load_environment():
+    """
+    Load .env into the environment once per process. Modules call this before reading
+    their settings, so whichever is imported first loads it and the rest do not re-read it.
+    """
+    global _environment_loaded
+    with _lock:
+        if not _environment_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _environment_loaded = True
+
+
+def configure_logging(level=None):
+    # Called once by the entry point (app.py); library modules only get loggers
+    load_environment()
+    logging.basicConfig(level=level or os.getenv('LOG_LEVEL', 'INFO').upper(), format=LOG_FORMAT)
@@ -5,36 +5,48 @@ import json
 import ast
 from datetime import datetime
 import time
+import re
+import hashlib
+import random
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 from subprocess import Popen, PIPE
-from dotenv import load_dotenv
+from config import load_environment
 
 from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
-from google_auth import create_google_service
+from google_auth import create_google_service, SCOPES
 from logging_utils import log_error_to_sheets
-
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.core.credentials import AzureKeyCredential
-from openai import OpenAI
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logging.getLogger('azure.core').setLevel(logging.WARNING)
-logging.getLogger('azure.ai.formrecognizer').setLevel(logging.WARNING)
-
-# Load environment variables
-load_dotenv()
-
-# Azure Form Recognizer details
-AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT")
-AZURE_KEY = os.getenv("AZURE_KEY")
+from pipeline import Stage, Pipeline, run_pipeline
+from sheets_writer import get_sheets_writer, flush_sheets_writer
+from batch_utils import execute_batch
+from sync_state import load_sync_state, save_sync_state
+from job_ledger import get_job_ledger, TERMINAL_STAGES
+from work_lease import get_lease_manager
+from cache_utils import cache_getter
+from ocr_format import format_for_llm, format_flat, format_text_layer
+from text_layer import read_text_layer, score_text_layer, TEXT_LAYER_MIN_SCORE
+from openai_batch import submit_batch, wait_for_batch, collect_batch_results
+from rate_limit import call_with_limits
+from output_artifacts import OUTPUT_MODE, write_workbook_tab, upload_table_file
+from metrics import Trace, registry, span, stage_span_for, use_trace, current_trace, propagate_trace, add_to_span, record_bytes, finish_trace
+
+load_environment()
 
 # OpenAI details
 OPENAI_API_KEY = os.getenv("OPENAI_API")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL")
 
-# Initialize Azure Form Recognizer client & OpenAI clients
-form_recognizer_client = DocumentAnalysisClient(AZURE_ENDPOINT, AzureKeyCredential(AZURE_KEY))
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Point OPENAI_BASE_URL at a local mock server to exercise the LLM modes offline
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+
+# The OpenAI client is built on first use (Azure Form Recognizer runs on the OCR engine, see ocr_engine.py)
+_openai_client = None
+_openai_lock = threading.Lock()
+
+# Output tokens reserved per request against the tokens-per-minute quota
+llm_expected_output_tokens = int(os.getenv('LLM_EXPECTED_OUTPUT_TOKENS', '1000'))
 
 main_output_sheet_id=os.getenv('MAIN_OUTPUT_SHEET_ID')
 output_folder_id = os.getenv('OUTPUT_DRIVE_FOLDER_ID')
@@ -44,84 +56,13 @@ failed_folder_id = os.getenv('FAILED_FOLDER_ID')
 
 drive_log_sheet_id = os.getenv('DRIVE_LOG_SPREADSHEET_ID')
 
-# Functions 
-   
-def process_file(drive_service, sheets_service, file_id, input_folder_id):
-    try:
-        start_time = time.time()
-        file_content = download_file_from_drive(drive_service, file_id)
-        extracted_text = extract_text_from_pdf(file_content)
-        optimized_content = optimize_content_with_chatgpt(extracted_text)
-        add_to_sheet = add_to_sheets(sheets_service, drive_service, optimized_content, file_id, input_folder_id, start_time)
-        logging.info(f"File {file_id} processed successfully.")
-        return add_to_sheet
-        
-    except Exception as e:
-        logging.error(f"Error processing file: {e}")
-        log_error_to_sheets("process_file in drive_app.py", str(e))
-        return str(e)
-    
-def download_file_from_drive(drive_service, file_id):
-    try:
-        request = drive_service.files().get_media(fileId=file_id)
-        file_content = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_content, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        file_content.seek(0)  # Reset pointer to the start
-        logging.info(f"File {file_id} downloaded successfully.")
-        return file_content
-    
-    except Exception as e:
-        logging.error(f"Error downloading file: {e}")
-        log_error_to_sheets("download_file_from_drive", str(e))
-        raise Exception(f"Error downloading file: {e}")
-
-def extract_text_from_pdf(file_content):
-    try:
-        # Start the document analysis
-        poller = form_recognizer_client.begin_analyze_document("prebuilt-document", file_content)
-
-        max_retries = 5  # You can adjust the retry count as needed
-        retry_count = 0
-        while retry_count < max_retries:
-            time.sleep(15)  # Sleep for 15 seconds before checking the status
-            try:
-                # Retrieve the result once the operation is complete
-                result = poller.result()
-                logging.info("Analysis started, result obtained successfully.")
-                break  # Break the loop if the result is successfully obtained
-            except Exception as e:
-                retry_count += 1
-                if retry_count < max_retries:
-                    logging.warning(f"Attempt {retry_count}/{max_retries} failed, retrying...")
-                else:
-                    logging.error(f"Failed to retrieve result after {max_retries} attempts. Error: {e}")
-                    raise Exception(f"Failed to get result after {max_retries} attempts: {e}")
-                if retry_count >= max_retries:
-                    raise Exception(f"Failed to get result after {max_retries} attempts: {e}")
-
-        # Retrieve the result once the operation is complete
-        result = poller.result()
-        
-        # Extract and format the content
-        extracted_content = "\n".join(
-            f"Page {page.page_number}: " + " ".join(line.content for line in page.lines)
-            for page in result.pages
-        )
+# Content-addressed cache of OCR results (OCR_CACHE_ENABLED / _PATH / _MAX_MB / _TTL_DAYS)
+get_ocr_cache = cache_getter('ocr', 'cache/ocr_cache.sqlite3', 500, 30)
 
-        logging.info("Text extraction from PDF completed successfully.")
-        return extracted_content
-        log_error_to_sheets("extract_text_from_pdf", str(e))
-        raise Exception(f"Error extracting text from PDF: {e}")
-    
-    except Exception as e:
-        raise Exception(f"Error extracting text from PDF: {e}")
+# Cache of LLM extractions keyed on text, prompt version and model (LLM_CACHE_*)
+get_llm_cache = cache_getter('llm', 'cache/llm_cache.sqlite3', 100, 90)
 
-def optimize_content_with_chatgpt(extracted_content):
-    try:
-        user_message = """
+INVOICE_PROMPT = """
         From above markdown text return the following data in table format
 
         Date    
@@ -157,27 +98,361 @@ def optimize_content_with_chatgpt(extracted_content):
 
         If no data can be fetched, just output "no data".
         """
-        response = openai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": extracted_content},
-                {"role": "user", "content": user_message}
-            ]
-        )
 
-        optimized_content = response.choices[0].message.content
-        input_tokens = response.usage.prompt_tokens
-        output_tokens = response.usage.completion_tokens
-        total_tokens = input_tokens + output_tokens
+# Appended to the prompt when several invoices share one request
+PACKED_PROMPT_SUFFIX = """
+        The text above contains several invoices, each starting with a line like "=== INVOICE 1 ===".
 
-        chatgpt_output = {
-            "optimized_content": optimized_content,
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens,
-            "total_tokens": total_tokens
-        }
+        Return a python dict mapping each invoice number (as a string, e.g. "1") to the python list of rows for that invoice, in the format above.
+
+        If no data can be fetched for an invoice, map its number to "no data". Include every invoice number.
+
+        PLEASE only output the python dict, no other text required at any cost.
+        """
+
+# Changes to the prompt text change its version, which invalidates cached extractions
+PROMPT_VERSION = hashlib.sha256(INVOICE_PROMPT.encode('utf-8')).hexdigest()[:16]
+
+# Pipeline sizing: worker threads per stage and the bound on each hand-off queue
+download_workers = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+ocr_workers = int(os.getenv('OCR_WORKERS', '32'))
+# The rate limiter holds LLM calls at the quota, so more workers no longer risk 429 failures
+llm_workers = int(os.getenv('LLM_WORKERS', '16'))
+sheets_workers = int(os.getenv('SHEETS_WORKERS', '2'))
+# Invoices the sheets stage finishes together, so their Drive moves share batch requests
+# (up to 100 calls each); it waits at most sheets_batch_wait seconds for a batch to fill
+sheets_batch_size = int(os.getenv('SHEETS_BATCH_SIZE', '20'))
+sheets_batch_wait = float(os.getenv('SHEETS_BATCH_WAIT', '1'))
+pipeline_queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', '10'))
+
+# How new input files are found: 'list' scans both folders, 'changes' reads the Drive changes feed
+drive_discovery = os.getenv('DRIVE_DISCOVERY', 'list')
+# In 'changes' mode, still rescan the folders this often to pick up files left behind by failures
+drive_full_scan_hours = float(os.getenv('DRIVE_FULL_SCAN_HOURS', '24'))
+
+# 'structured' keeps tables and key-value fields from the OCR result; 'flat' is the old one-line-per-page text
+ocr_output_format = os.getenv('OCR_OUTPUT_FORMAT', 'structured')
+# Read generated PDFs from their own text layer and only send scanned or poor-quality ones to Azure
+text_layer_enabled = os.getenv('TEXT_LAYER_ENABLED', '1') == '1'
+
+# Long documents are split into page ranges analysed concurrently, and LLM input longer than
+# llm_chunk_chars is split at page boundaries into concurrent requests
+ocr_chunk_pages = int(os.getenv('OCR_CHUNK_PAGES', '10'))
+llm_chunk_chars = int(os.getenv('LLM_CHUNK_CHARS', '24000'))
+llm_chunk_workers = int(os.getenv('LLM_CHUNK_WORKERS', '4'))
+
+INVOICE_HEADER = ["Date", "Voucher Type", "Invoice Number", "Ledger Name", "Ledger Amt", "Dr/Cr", "Item Name", "Quantity", "UOM", "Rate", "Value"]
+
+# 'single' sends one request per invoice, 'packed' puts up to llm_pack_size short invoices in one
+# request, 'batch' sends a Drive backlog as one OpenAI Batch job (the Gmail hand-off still packs)
+llm_mode = os.getenv('LLM_MODE', 'single')
+llm_pack_size = int(os.getenv('LLM_PACK_SIZE', '8'))
+llm_pack_max_chars = int(os.getenv('LLM_PACK_MAX_CHARS', str(llm_chunk_chars)))
+# Seconds the LLM stage waits for more invoices to fill a pack
+llm_pack_wait = float(os.getenv('LLM_PACK_WAIT', '2'))
+llm_batch_poll_seconds = float(os.getenv('LLM_BATCH_POLL_SECONDS', '60'))
+
+# Only PDFs and images are worth sending through OCR and the LLM
+INVOICE_MIME_QUERY = "(mimeType = 'application/pdf' or mimeType contains 'image/')"
+
+# Functions 
+
+def get_services():
+    # Shared clients from google_auth; each thread gets its own transport underneath
+    return create_google_service('drive', 'v3', SCOPES), create_google_service('sheets', 'v4', SCOPES)
+   
+def download_file_from_drive(drive_service, file_id):
+    try:
+        request = drive_service.files().get_media(fileId=file_id)
+        file_content = io.BytesIO()
+        downloader = MediaIoBaseDownload(file_content, request)
+        done = False
+        with span('call', 'drive.files.get_media', api='drive'):
+            while not done:
+                # Media downloads bypass HttpRequest.execute, so they take their quota here
+                _, done = call_with_limits(downloader.next_chunk, [('drive', 1)], description="Drive download")
+            record_bytes('drive', 'drive.files.get_media', 'in', file_content.tell())
+        file_content.seek(0)  # Reset pointer to the start
+        logging.info(f"File {file_id} downloaded successfully.")
+        return file_content
+    
+    except Exception as e:
+        logging.error(f"Error downloading file: {e}")
+        log_error_to_sheets("download_file_from_drive", str(e))
+        raise Exception(f"Error downloading file: {e}")
+
+def count_pdf_pages(file_bytes):
+    # None for images or unreadable PDFs, which are then analysed in one call
+    try:
+        from pypdf import PdfReader
+        return len(PdfReader(io.BytesIO(file_bytes)).pages)
+    except Exception:
+        return None
+
+def split_page_ranges(page_count, chunk_pages):
+    if not page_count or chunk_pages <= 0 or page_count <= chunk_pages:
+        return [None]
+    return [
+        f"{start}-{min(start + chunk_pages - 1, page_count)}"
+        for start in range(1, page_count + 1, chunk_pages)
+    ]
+
+def analyze_document(file_bytes, pages=None):
+    # Identical documents share a cache entry, keyed on the SHA-256 of their bytes (and page range)
+    # The Azure SDK is only imported once a document actually needs OCR
+    from ocr_engine import get_ocr_engine, OCR_MODEL_ID
+    from azure.ai.formrecognizer import AnalyzeResult
+
+    ocr_cache = get_ocr_cache()
+    cache_key = f"{OCR_MODEL_ID}:{hashlib.sha256(file_bytes).hexdigest()}"
+    if pages:
+        cache_key += f":{pages}"
+    if ocr_cache:
+        cached = ocr_cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"OCR cache hit for {cache_key}, skipping analysis.")
+            return AnalyzeResult.from_dict(cached)
+
+    # Analysis runs on the shared asyncio OCR engine, which polls adaptively instead of sleeping
+    with span('call', 'analyze_document', api='azure', pages=pages or 'all'):
+        record_bytes('azure', 'analyze_document', 'out', len(file_bytes))
+        if pages:
+            result = get_ocr_engine().analyze(file_bytes, pages=pages)
+        else:
+            result = get_ocr_engine().analyze(file_bytes)
+    logging.info(f"Analysis completed, result obtained successfully{f' for pages {pages}' if pages else ''}.")
+
+    if ocr_cache:
+        try:
+            ocr_cache.set(cache_key, result.to_dict())
+        except Exception as e:
+            logging.warning(f"Could not store OCR result in cache: {e}")
+
+    return result
+
+def extract_text_layer(file_bytes):
+    # Milliseconds locally instead of an Azure analysis; None when the text layer is missing or scores too low
+    with span('call', 'read_text_layer', api='local'):
+        page_texts = read_text_layer(file_bytes)
+        score = score_text_layer(page_texts)
+
+    if score < TEXT_LAYER_MIN_SCORE:
+        registry.increment('text_layer_total', outcome='azure')
+        logging.info(f"Text layer scored {score:.2f}, below {TEXT_LAYER_MIN_SCORE}; analysing with Azure.")
+        return None
+
+    registry.increment('text_layer_total', outcome='local')
+    logging.info(f"Using the PDF text layer ({len(page_texts)} pages, score {score:.2f}) instead of Azure.")
+    return format_text_layer(page_texts, ocr_output_format)
+
+def extract_text_from_pdf(file_content):
+    try:
+        file_bytes = file_content.getvalue()
+        if text_layer_enabled:
+            extracted_content = extract_text_layer(file_bytes)
+            if extracted_content is not None:
+                return extracted_content
+
+        page_ranges = split_page_ranges(count_pdf_pages(file_bytes), ocr_chunk_pages)
+
+        if len(page_ranges) == 1:
+            results = [analyze_document(file_bytes)]
+        else:
+            # Page ranges are analysed concurrently and kept in page order
+            logging.info(f"Analysing {len(page_ranges)} page ranges concurrently: {page_ranges}")
+            with ThreadPoolExecutor(max_workers=len(page_ranges)) as executor:
+                results = list(executor.map(propagate_trace(lambda pages: analyze_document(file_bytes, pages)), page_ranges))
+        
+        # Extract and format the content
+        extracted_content = "\n\n".join(format_for_llm(result, ocr_output_format) for result in results)
+        flat_length = sum(len(format_flat(result)) for result in results)
+
+        logging.info(f"Text extraction from PDF completed successfully ({len(extracted_content)} chars, flat layout would be {flat_length}).")
+        return extracted_content
+    
+    except Exception as e:
+        logging.error(f"Error extracting text from PDF: {e}")
+        log_error_to_sheets("extract_text_from_pdf", str(e))
+        raise Exception(f"Error extracting text from PDF: {e}")
+
+def parse_chatgpt_rows(optimized_content):
+    # Remove newline characters
+    data_string = optimized_content.replace('\n', '')
+
+    # Use ast.literal_eval to safely parse the string
+    data_list = ast.literal_eval(data_string)
+    
+    # Ensure the data is in a 2D list format
+    if not isinstance(data_list[0], list):
+        # If it's a 1D list, wrap it in another list
+        return [data_list]
+    elif isinstance(data_list, tuple):
+        # If it's a tuple, convert to list
+        return list(data_list)
+    else:
+        # If it's already a list of lists, use as-is
+        return data_list
+
+def extraction_messages(extracted_content, prompt=INVOICE_PROMPT):
+    return [
+        {"role": "system", "content": extracted_content},
+        {"role": "user", "content": prompt}
+    ]
+
+def build_chatgpt_output(optimized_content, input_tokens, output_tokens):
+    return {
+        "optimized_content": optimized_content,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens
+    }
+
+def get_openai_client():
+    """
+    Return the shared OpenAI client, built on first use; retries are left to the shared rate limiter.
+    """
+    global _openai_client
+    with _openai_lock:
+        if _openai_client is None:
+            from openai import OpenAI
+            _openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL or None, max_retries=0)
+        return _openai_client
+
+def set_openai_client(client):
+    """
+    Install a ready-made OpenAI client, e.g. an in-process fake for benchmarks.
+    """
+    global _openai_client
+    with _openai_lock:
+        _openai_client = client
+
+def create_chat_completion(messages):
+    # One request plus a rough token estimate (4 characters per token) against the shared quota
+    estimated_tokens = sum(len(message["content"]) for message in messages) // 4 + llm_expected_output_tokens
+    with span('call', 'chat.completions.create', api='openai'):
+        response = call_with_limits(
+            lambda: get_openai_client().chat.completions.create(model=OPENAI_MODEL, messages=messages),
+            [('openai_requests', 1), ('openai_tokens', estimated_tokens)],
+            description="OpenAI chat completion"
+        )
+        registry.increment('llm_tokens_total', response.usage.prompt_tokens, kind='prompt')
+        registry.increment('llm_tokens_total', response.usage.completion_tokens, kind='completion')
+        add_to_span(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+    return response
+
+def request_extraction(extracted_content):
+    response = create_chat_completion(extraction_messages(extracted_content))
+
+    return build_chatgpt_output(
+        response.choices[0].message.content,
+        response.usage.prompt_tokens,
+        response.usage.completion_tokens
+    )
+
+def split_content_for_llm(extracted_content, max_chars):
+    # Split at page headings ('## Page N' or the flat 'Page N:'); any leading fields
+    # section is repeated in every chunk so each one knows the vendor and invoice details
+    sections = re.split(r'(?m)^(?=(?:## )?Page \d+)', extracted_content)
+    preamble = "" if re.match(r'(?:## )?Page \d+', sections[0]) else sections.pop(0)
+
+    chunks = []
+    current = ""
+    for section in sections:
+        if current and len(current) + len(section) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += section
+    if current:
+        chunks.append(current)
+
+    return [preamble + chunk for chunk in chunks] or [extracted_content]
+
+def is_header_row(row):
+    return [str(cell).strip().lower() for cell in row[:3]] in (
+        [name.lower() for name in INVOICE_HEADER[:3]],
+        ["date", "voucher type", "invoice number"],
+    )
+
+def merge_chunk_rows(row_lists, overlap=3):
+    # Rows in page order, without repeated header rows or rows carried over from the
+    # end of the previous chunk
+    merged = []
+    previous_tail = []
+    for rows in row_lists:
+        kept = [row for row in rows if not is_header_row(row)]
+        while kept and kept[0] in previous_tail:
+            kept.pop(0)
+        merged.extend(kept)
+        if kept:
+            previous_tail = kept[-overlap:]
+    return merged
+
+def extract_in_chunks(chunks):
+    logging.info(f"Extracting {len(chunks)} chunks concurrently.")
+    with ThreadPoolExecutor(max_workers=min(llm_chunk_workers, len(chunks))) as executor:
+        outputs = list(executor.map(propagate_trace(request_extraction), chunks))
+
+    row_lists = []
+    for index, output in enumerate(outputs):
+        try:
+            row_lists.append(parse_chatgpt_rows(output["optimized_content"]))
+        except Exception:
+            # Pages without invoice data (terms, cover pages) answer "no data"
+            logging.info(f"Chunk {index + 1} returned no rows.")
+
+    input_tokens = sum(output["input_tokens"] for output in outputs)
+    output_tokens = sum(output["output_tokens"] for output in outputs)
+    merged_rows = merge_chunk_rows(row_lists)
+
+    return build_chatgpt_output(
+        repr(merged_rows) if merged_rows else outputs[0]["optimized_content"],
+        input_tokens,
+        output_tokens
+    )
+
+def llm_cache_key(extracted_content):
+    # Identical text, prompt and model give the same answer
+    return hashlib.sha256(
+        "\x00".join([extracted_content, PROMPT_VERSION, str(OPENAI_MODEL)]).encode('utf-8')
+    ).hexdigest()
+
+def cached_extraction(extracted_content):
+    llm_cache = get_llm_cache()
+    if not llm_cache:
+        return None
+    cached = llm_cache.get(llm_cache_key(extracted_content))
+    if cached is not None:
+        cached["cached"] = True
+        logging.info(f"LLM cache hit, reusing extraction with {cached['total_tokens']} recorded tokens.")
+    return cached
+
+def store_extraction(extracted_content, chatgpt_output):
+    # Only answers that parse into rows are worth replaying
+    llm_cache = get_llm_cache()
+    if llm_cache:
+        try:
+            parse_chatgpt_rows(chatgpt_output["optimized_content"])
+            llm_cache.set(llm_cache_key(extracted_content), chatgpt_output)
+        except Exception:
+            logging.info("LLM output did not parse into rows, not caching it.")
+
+def optimize_content_with_chatgpt(extracted_content):
+    try:
+        # Reuse an earlier answer for the same text, prompt and model
+        cached = cached_extraction(extracted_content)
+        if cached is not None:
+            return cached
+
+        # Long documents would overflow the context window as one prompt
+        chunks = split_content_for_llm(extracted_content, llm_chunk_chars) if len(extracted_content) > llm_chunk_chars else [extracted_content]
+        if len(chunks) > 1:
+            chatgpt_output = extract_in_chunks(chunks)
+        else:
+            chatgpt_output = request_extraction(extracted_content)
 
         logging.info(f"Content optimized successfully:{chatgpt_output}")
+        store_extraction(extracted_content, chatgpt_output)
+
         return chatgpt_output
     
     except Exception as e:
@@ -185,14 +460,179 @@ def optimize_content_with_chatgpt(extracted_content):
         log_error_to_sheets("optimize_content_with_chatgpt", str(e))
         raise Exception(f"Error optimizing content with ChatGPT: {e}")
 
-def add_to_sheets(sheets_service, drive_service, chatgpt_output, file_id, input_folder_id, start_time):
+def pack_invoices(contents):
+    # Invoices are labelled 1..n rather than by file id, which is shorter and harder to garble
+    return "\n\n".join(f"=== INVOICE {index + 1} ===\n{content}" for index, content in enumerate(contents))
 
+def request_packed_extraction(contents):
+    """
+    Extract several invoices in one request, returning one output per invoice in the same
+    order; None marks an invoice missing from the answer. Tokens are shared out by text length.
+    """
+    response = create_chat_completion(extraction_messages(pack_invoices(contents), INVOICE_PROMPT + PACKED_PROMPT_SUFFIX))
+
+    try:
+        answers = ast.literal_eval(response.choices[0].message.content.replace('\n', ''))
+        if not isinstance(answers, dict):
+            raise ValueError("packed answer is not a dict")
+    except (SyntaxError, ValueError) as e:
+        logging.warning(f"Packed LLM answer did not parse, extracting invoices one by one: {e}")
+        return [None] * len(contents)
+
+    total_chars = sum(len(content) for content in contents) or 1
+    outputs = []
+    for index, content in enumerate(contents):
+        answer = answers.get(str(index + 1), answers.get(index + 1))
+        if answer is None:
+            outputs.append(None)
+            continue
+        share = len(content) / total_chars
+        outputs.append(build_chatgpt_output(
+            answer if isinstance(answer, str) else repr(answer),
+            round(response.usage.prompt_tokens * share),
+            round(response.usage.completion_tokens * share)
+        ))
+    return outputs
+
+def group_into_packs(indexed_contents):
+    packs = []
+    current, current_chars = [], 0
+    for index, content in indexed_contents:
+        if current and (len(current) >= llm_pack_size or current_chars + len(content) > llm_pack_max_chars):
+            packs.append(current)
+            current, current_chars = [], 0
+        current.append((index, content))
+        current_chars += len(content)
+    if current:
+        packs.append(current)
+    return packs
+
+def optimize_contents_packed(contents):
+    """
+    Extract a list of invoice texts, packing short ones several to a request.
+
+    Returns one entry per text: its output, or the exception that stopped it. Invoices the
+    packed answer left out, and texts too long to pack, are extracted on their own.
+    """
+    outputs = [None] * len(contents)
+    packable = []
+    for index, content in enumerate(contents):
+        cached = cached_extraction(content)
+        if cached is not None:
+            outputs[index] = cached
+        elif len(content) <= llm_pack_max_chars:
+            packable.append((index, content))
+
+    for pack in group_into_packs(packable):
+        if len(pack) < 2:
+            continue
+        try:
+            packed_outputs = request_packed_extraction([content for _, content in pack])
+        except Exception as e:
+            logging.error(f"Packed extraction of {len(pack)} invoices failed, extracting them one by one: {e}")
+            continue
+        for (index, content), output in zip(pack, packed_outputs):
+            if output is not None:
+                outputs[index] = output
+                store_extraction(content, output)
+        logging.info(f"Extracted {sum(output is not None for output in packed_outputs)}/{len(pack)} invoices in one packed request.")
+
+    for index, content in enumerate(contents):
+        if outputs[index] is None:
+            try:
+                outputs[index] = optimize_content_with_chatgpt(content)
+            except Exception as e:
+                outputs[index] = e
+    return outputs
+
+def extract_with_batch_api(jobs):
+    """
+    Extract every job that still needs the LLM through one OpenAI Batch job and return the
+    jobs that have an output. The batch id is saved so a restarted run collects it instead
+    of submitting the backlog again.
+    """
+    openai_client = get_openai_client()
+    pending = {}
+    for job in jobs:
+        if 'chatgpt_output' in job:
+            continue
+        cached = cached_extraction(job['extracted_text'])
+        if cached is not None:
+            job['chatgpt_output'] = cached
+        else:
+            pending[job['file_id']] = job
+
+    results = {}
+    saved_batch_id = load_sync_state('openai_batch_id')
+    if saved_batch_id:
+        logging.info(f"Collecting OpenAI batch {saved_batch_id} from an earlier run.")
+        results.update(collect_batch_results(openai_client, wait_for_batch(openai_client, saved_batch_id, llm_batch_poll_seconds)))
+        save_sync_state('openai_batch_id', None)
+
+    # Long invoices are split into chunks, which the direct path already handles
+    requests = [
+        (file_id, {"model": OPENAI_MODEL, "messages": extraction_messages(job['extracted_text'])})
+        for file_id, job in pending.items()
+        if file_id not in results and len(job['extracted_text']) <= llm_chunk_chars
+    ]
+    if requests:
+        with stage_span_for([pending[file_id]['trace'] for file_id, _ in requests if 'trace' in pending[file_id]], 'llm'):
+            batch_id = submit_batch(openai_client, requests)
+            save_sync_state('openai_batch_id', batch_id)
+            results.update(collect_batch_results(openai_client, wait_for_batch(openai_client, batch_id, llm_batch_poll_seconds)))
+        save_sync_state('openai_batch_id', None)
+
+    ledger = get_job_ledger()
+    ready = []
+    for job in jobs:
+        file_id = job['file_id']
+        if file_id in pending:
+            body, error = results.get(file_id, (None, None))
+            try:
+                if body is not None:
+                    job['chatgpt_output'] = build_chatgpt_output(
+                        body['choices'][0]['message']['content'],
+                        body['usage']['prompt_tokens'],
+                        body['usage']['completion_tokens']
+                    )
+                    store_extraction(job['extracted_text'], job['chatgpt_output'])
+                else:
+                    # Failed, expired or never batched: extract directly
+                    if error:
+                        logging.warning(f"Batch extraction of file {file_id} failed, retrying directly: {error}")
+                    with use_trace(job.get('trace')), span('stage', 'llm'):
+                        job['chatgpt_output'] = optimize_content_with_chatgpt(job['extracted_text'])
+            except Exception as e:
+                handle_stage_error(job, 'llm', e)
+                continue
+            if ledger:
+                ledger.record_stage(file_id, 'extracted', chatgpt_output=job['chatgpt_output'])
+        ready.append(job)
+    return ready
+
+def output_url(output_id):
+    # Workbook tabs are stored as '<workbook id>#gid=<sheet id>'
+    if OUTPUT_MODE in ('csv', 'xlsx'):
+        return f"https://drive.google.com/file/d/{output_id}/view"
+    spreadsheet_id, _, sheet_id = output_id.partition('#gid=')
+    return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit" + (f"#gid={sheet_id}" if sheet_id else "")
+
+def write_invoice_outputs(sheets_service, drive_service, chatgpt_output, file_id, input_folder_id, start_time, file_metadata=None, ledger_entry=None):
+    """
+    Queue the invoice's main sheet rows and write its own output. Returns the written invoice
+    for finish_written_invoices, or "Invoice Processing Failed".
+    """
     try:       
-        # Get file metadata (file name and URL)
-        file_metadata = drive_service.files().get(
-            fileId=file_id,
-            fields='name, webViewLink'
-        ).execute()
+        # Side effects already recorded in the job ledger are not repeated on resume
+        ledger = get_job_ledger()
+        ledger_entry = ledger_entry or {}
+
+        # Get file metadata (file name and URL) unless the listing already provided it
+        if not file_metadata:
+            file_metadata = drive_service.files().get(
+                fileId=file_id,
+                fields='name, webViewLink'
+            ).execute()
 
         file_name = file_metadata.get('name')
         file_url = file_metadata.get('webViewLink')
@@ -210,185 +650,526 @@ def add_to_sheets(sheets_service, drive_service, chatgpt_output, file_id, input_
 
         logging.info(f"Improper List:{chatgpt_output}")
 
-        # Remove newline characters
-        data_string = chatgpt_output["optimized_content"].replace('\n', '')
-
-        # Use ast.literal_eval to safely parse the string
-        data_list = ast.literal_eval(data_string)
-        
-        # Ensure the data is in a 2D list format
-        if not isinstance(data_list[0], list):
-            # If it's a 1D list, wrap it in another list
-            data_new = [data_list]
-        elif isinstance(data_list, tuple):
-            # If it's a tuple, convert to list
-            data_new = list(data_list)
-        else:
-            # If it's already a list of lists, use as-is
-            data_new = data_list
+        data_new = parse_chatgpt_rows(chatgpt_output["optimized_content"])
         
         # Prepare the payload for Google Sheets
         payload = {"values": data_new}
         logging.info(f"Proper List: {payload}")
 
-        response = sheets_service.spreadsheets().values().append(
-            spreadsheetId=main_output_sheet_id,
-            range='Sheet1!A:K',
-            valueInputOption='RAW',
-            body=payload  
+        # Main sheet rows are written behind, batched with other invoices; the ledger
+        # only marks them written once they have actually reached the sheet
+        if not ledger_entry.get('main_rows_written'):
+            on_flushed = (lambda: ledger.update(file_id, main_rows_written=1)) if ledger else None
+            get_sheets_writer().append(main_output_sheet_id, 'Sheet1!A:K', data_new, on_flushed=on_flushed)
+            logging.info("Queued data for Main sheet.")
+        else:
+            logging.info("Main sheet rows already written, skipping.")
+
+        new_spreadsheet_id = ledger_entry.get('output_spreadsheet_id')
+        if not new_spreadsheet_id and OUTPUT_MODE == 'workbook':
+            # One batchUpdate adds the invoice as a tab of today's workbook, header included
+            new_spreadsheet_id = write_workbook_tab(sheets_service, drive_service, output_folder_id, file_name, [INVOICE_HEADER] + data_new, file_id)
+            logging.info("Added invoice tab to the daily workbook")
+            if ledger:
+                ledger.record_stage(file_id, 'written', output_spreadsheet_id=new_spreadsheet_id)
+        elif not new_spreadsheet_id and OUTPUT_MODE in ('csv', 'xlsx'):
+            # Built locally and uploaded straight into the output folder in one call
+            new_spreadsheet_id = upload_table_file(drive_service, output_folder_id, file_name, [INVOICE_HEADER] + data_new, OUTPUT_MODE)
+            logging.info(f"Uploaded {OUTPUT_MODE} output file")
+            if ledger:
+                ledger.record_stage(file_id, 'written', output_spreadsheet_id=new_spreadsheet_id)
+        elif not new_spreadsheet_id:
+            # Logic after main sheet appending is successful:
+            new_spreadsheet = sheets_service.spreadsheets().create(
+                body={
+                    'properties': {'title': file_name},
+                    'sheets': [{'properties': {'title': 'Sheet1'}}]
+                }
             ).execute()
 
-        # Check if the response indicates success (status code 200)
-        if response and response.get('updates', {}).get('updatedCells', 0) > 0:
-            logging.info("Successfully appended data to Main sheet.")
-
-        # Logic after main sheet appending is successful:
-        new_spreadsheet = sheets_service.spreadsheets().create(
-            body={
-                'properties': {'title': file_name},
-                'sheets': [{'properties': {'title': 'Sheet1'}}]
-            }
-        ).execute()
-
-        logging.info("Created new spreadsheet")
-
-        new_spreadsheet_id = new_spreadsheet['spreadsheetId']
-        new_spreadsheet_url = f"https://docs.google.com/spreadsheets/d/{new_spreadsheet_id}/edit"
-
-        # Append to new sheet
-
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=new_spreadsheet_id,
-            range='Sheet1!A:K',
-            valueInputOption='RAW',
-        body={'values': [["Date", "Voucher Type", "Invoice Number", "Ledger Name", "Ledger Amt", "Dr/Cr", "Item Name", "Quantity", "UOM", "Rate", "Value"]]} 
-        ).execute()  
-
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=new_spreadsheet_id,
-            range='Sheet1!A:K',
-            valueInputOption='RAW',
-        body=payload
-        ).execute()
+            logging.info("Created new spreadsheet")
 
-        logging.info("Updated new spreadsheet")
-                                                      
-        # Move output file
-        drive_service.files().update(
-            fileId=new_spreadsheet_id,
-            addParents=output_folder_id,
-            removeParents='root',
-            fields='id, parents'
-        ).execute()                       
+            new_spreadsheet_id = new_spreadsheet['spreadsheetId']
 
-        # Move input file
-        drive_service.files().update(
-            fileId=file_id,
-            addParents=processed_folder_id,
-            removeParents=input_folder_id,
-            fields='id, parents'
-        ).execute()
-
-        logging.info("Moved both files")
-
-        # Log details to the Drive log sheet
-        end_time = time.time() 
-        elapsed_time = end_time - start_time
-        log_data = [
-            [datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%d-%m-%Y %I:%M:%S %p'), file_name, file_id, file_url, new_spreadsheet_url, input_tokens, output_tokens, total_tokens, source, elapsed_time]
-        ]
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=drive_log_sheet_id,
-            range='Invoices Successes!A:J',
-            valueInputOption='RAW',
-            body={'values': log_data}
-        ).execute()
+            # Append header and rows to the new sheet in one call
+            sheets_service.spreadsheets().values().append(
+                spreadsheetId=new_spreadsheet_id,
+                range='Sheet1!A:K',
+                valueInputOption='RAW',
+            body={'values': [INVOICE_HEADER] + data_new}
+            ).execute()
 
-        logging.info("Logged Success in Google Sheets")
-        return "Invoice Processing Successful"
+            logging.info("Updated new spreadsheet")
+            if ledger:
+                ledger.record_stage(file_id, 'written', output_spreadsheet_id=new_spreadsheet_id)
+
+        return {
+            'file_id': file_id,
+            'input_folder_id': input_folder_id,
+            'output_id': new_spreadsheet_id,
+            'moved': ledger_entry.get('stage') == 'moved',
+            'start_time': start_time,
+            'trace': current_trace(),
+            'log_fields': [file_name, file_id, file_url, output_url(new_spreadsheet_id), input_tokens, output_tokens, total_tokens, source],
+        }
 
-    
     except (SyntaxError, ValueError) as e:
         logging.error(f"Error appending the content: {e}")
 
-        # Logic after main sheet appending failed:
-        drive_service.files().update(
-            fileId=file_id,
-            addParents=failed_folder_id,
-            removeParents=input_folder_id,
-            fields='id, parents'
-        ).execute()
+        # Logic after main sheet appending failed (a reprocessed file is already in the failed folder):
+        if input_folder_id != failed_folder_id:
+            drive_service.files().update(
+                fileId=file_id,
+                addParents=failed_folder_id,
+                removeParents=input_folder_id,
+                fields='id, parents'
+            ).execute()
+        if ledger:
+            ledger.record_stage(file_id, 'failed')
 
         # Log failure to the Drive log sheet
         end_time = time.time() 
         elapsed_time = end_time - start_time
         log_data = [
-            [datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%d-%m-%Y %I:%M:%S %p'), file_name, file_id, file_url, chatgpt_output["optimized_content"], input_tokens, output_tokens, total_tokens, source, elapsed_time]
+            [datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%d-%m-%Y %I:%M:%S %p'), file_name, file_id, file_url, chatgpt_output["optimized_content"], input_tokens, output_tokens, total_tokens, source, elapsed_time, stage_breakdown()]
         ]
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=drive_log_sheet_id,
-            range='Invoices Failed!A:J',
-            valueInputOption='RAW',
-            body={'values': log_data}
-        ).execute()
+        get_sheets_writer().append(drive_log_sheet_id, 'Invoices Failed!A:K', log_data)
 
         logging.info("Error-handling executed")
         return "Invoice Processing Failed"
     
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
-        log_error_to_sheets("add_to_sheets in drive_app.py", str(e))
+        log_error_to_sheets("write_invoice_outputs in drive_app.py", str(e))
         return "Invoice Processing Failed"
 
 
+def invoice_moves(drive_service, written):
+    # Only a per-invoice spreadsheet starts out in root, the other outputs are created in the output folder
+    moves = []
+    if OUTPUT_MODE == 'spreadsheet':
+        moves.append(((written['file_id'], 'output'), drive_service.files().update(
+            fileId=written['output_id'],
+            addParents=output_folder_id,
+            removeParents='root',
+            fields='id, parents'
+        )))
+    # A file processed again from the processed folder (single-file mode) stays where it is
+    if written['input_folder_id'] != processed_folder_id:
+        moves.append(((written['file_id'], 'input'), drive_service.files().update(
+            fileId=written['file_id'],
+            addParents=processed_folder_id,
+            removeParents=written['input_folder_id'],
+            fields='id, parents'
+        )))
+    return moves
+
+def finish_written_invoices(drive_service, invoices):
+    """
+    Move the output and input files of written invoices, with the moves of all of them
+    sharing batched round trips, then record and log each one. Returns {file_id: result}.
+    """
+    ledger = get_job_ledger()
+    moves = [move for invoice in invoices if not invoice['moved'] for move in invoice_moves(drive_service, invoice)]
+    if len(moves) > 1:
+        move_results = execute_batch(drive_service, moves)
+    else:
+        # A batch of one only adds the multipart overhead to a plain request
+        move_results = {}
+        for key, request in moves:
+            try:
+                move_results[key] = (request.execute(), None)
+            except Exception as e:
+                move_results[key] = (None, e)
+
+    results = {}
+    for invoice in invoices:
+        file_id = invoice['file_id']
+        if invoice['moved']:
+            logging.info(f"File {file_id} already moved and logged, nothing left to do.")
+            results[file_id] = "Invoice Processing Successful"
+            continue
+
+        move_errors = [f"{kind}: {error}" for (moved_file_id, kind), (_, error) in move_results.items() if moved_file_id == file_id and error]
+        if move_errors:
+            logging.error(f"Error moving files of {file_id}: {'; '.join(move_errors)}")
+            log_error_to_sheets("finish_written_invoices in drive_app.py", f"Error moving files: {'; '.join(move_errors)}")
+            results[file_id] = "Invoice Processing Failed"
+            continue
+
+        logging.info(f"Moved files of {file_id}")
+        if ledger:
+            ledger.record_stage(file_id, 'moved')
+
+        # Log details to the Drive log sheet
+        with use_trace(invoice['trace']):
+            elapsed_time = time.time() - invoice['start_time']
+            log_data = [
+                [datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%d-%m-%Y %I:%M:%S %p')] + invoice['log_fields'] + [elapsed_time, stage_breakdown()]
+            ]
+        get_sheets_writer().append(drive_log_sheet_id, 'Invoices Successes!A:K', log_data)
+        results[file_id] = "Invoice Processing Successful"
+
+    logging.info(f"Logged {sum(result == 'Invoice Processing Successful' for result in results.values())} successes in Google Sheets")
+    return results
+
+
+def stage_breakdown():
+    # Per-stage seconds of the invoice being written, e.g. "download=0.41s ocr=6.20s llm=3.05s sheets=0.80s"
+    trace = current_trace()
+    return trace.breakdown() if trace else ""
+
+
+# Pipeline stages: each takes the job dict of one invoice and returns it for the next stage
+
+def traced(stage_name):
+    """
+    Run a stage inside a span of the job's trace; the trace is finished once a stage sets job['outcome'].
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def run(job):
+            trace = job.setdefault('trace', Trace(job['file_id']))
+            with use_trace(trace):
+                with span('stage', stage_name):
+                    result = func(job)
+                if result is not None and 'outcome' in result:
+                    finish_trace(trace, result['outcome'])
+            return result
+        return run
+    return decorate
+
+@traced('download')
+def download_stage(job):
+    # With several workers sharing the input folders, only the lease holder processes a file
+    lease_manager = get_lease_manager()
+    if lease_manager:
+        if not lease_manager.claim(f"drive:{job['file_id']}"):
+            # The holder may still fail it, so the changes checkpoint must not move past it
+            job['lease_skipped'] = True
+            return None
+
+    ledger = get_job_ledger()
+    entry = ledger.get(job['file_id']) if ledger else None
+
+    # The lease is gone once another worker finishes, so check it did not already move the file.
+    # A resumed 'moved' job is already in the processed folder and only needs its main sheet rows.
+    if lease_manager and not (job.get('resume') and entry and entry['stage'] == 'moved'):
+        drive_service, _ = get_services()
+        parents = drive_service.files().get(fileId=job['file_id'], fields='parents').execute().get('parents', [])
+        if job['folder_id'] not in parents:
+            logging.info(f"File {job['file_id']} has left folder {job['folder_id']}, skipping.")
+            release_lease(job)
+            return None
+
+    job['start_time'] = time.time()
+
+    if entry and entry['stage'] in TERMINAL_STAGES and not job.get('resume'):
+        # A finished file is back in an input folder, so process it from scratch
+        ledger.reset(job['file_id'])
+        entry = None
+    job['ledger_entry'] = entry or {}
+
+    # Restart at the stage where an earlier run stopped
+    if entry and entry.get('chatgpt_output'):
+        job['chatgpt_output'] = entry['chatgpt_output']
+    if entry and entry.get('extracted_text'):
+        job['extracted_text'] = entry['extracted_text']
+        logging.info(f"Resuming file {job['file_id']} after the '{entry['stage']}' stage.")
+        return job
+
+    # Jobs handed over from Gmail ingestion already carry their bytes
+    if job.get('file_content') is None:
+        drive_service, _ = get_services()
+        job['file_content'] = download_file_from_drive(drive_service, job['file_id'])
+    if ledger:
+        ledger.record_stage(job['file_id'], 'downloaded', folder_id=job['folder_id'])
+    return job
+
+@traced('ocr')
+def ocr_stage(job):
+    if 'extracted_text' not in job:
+        job['extracted_text'] = extract_text_from_pdf(job.pop('file_content'))
+        ledger = get_job_ledger()
+        if ledger:
+            ledger.record_stage(job['file_id'], 'ocr', extracted_text=job['extracted_text'])
+    return job
+
+@traced('llm')
+def llm_stage(job):
+    if 'chatgpt_output' not in job:
+        job['chatgpt_output'] = optimize_content_with_chatgpt(job['extracted_text'])
+        ledger = get_job_ledger()
+        if ledger:
+            ledger.record_stage(job['file_id'], 'extracted', chatgpt_output=job['chatgpt_output'])
+    return job
+
+def llm_pack_stage(jobs):
+    # Batched variant of llm_stage: the jobs collected by the pipeline share packed requests
+    pending = [job for job in jobs if 'chatgpt_output' not in job]
+    with stage_span_for([job.setdefault('trace', Trace(job['file_id'])) for job in pending], 'llm'):
+        outputs = optimize_contents_packed([job['extracted_text'] for job in pending])
+
+    ledger = get_job_ledger()
+    failed = set()
+    for job, output in zip(pending, outputs):
+        if isinstance(output, Exception):
+            handle_stage_error(job, 'llm', output)
+            failed.add(job['file_id'])
+            continue
+        job['chatgpt_output'] = output
+        if ledger:
+            ledger.record_stage(job['file_id'], 'extracted', chatgpt_output=output)
+    return [None if job['file_id'] in failed else job for job in jobs]
+
+def sheets_stage(jobs):
+    # Batched: each invoice writes its own outputs, then the Drive moves of the whole batch
+    # share batched round trips
+    drive_service, sheets_service = get_services()
+    traces = [job.setdefault('trace', Trace(job['file_id'])) for job in jobs]
+    results = {}
+    with stage_span_for(traces, 'sheets'):
+        written = []
+        for job in jobs:
+            with use_trace(job['trace']):
+                result = write_invoice_outputs(sheets_service, drive_service, job['chatgpt_output'], job['file_id'], job['folder_id'], job['start_time'], job.get('file_metadata'), job.get('ledger_entry'))
+            if isinstance(result, dict):
+                written.append(result)
+            else:
+                results[job['file_id']] = result
+        results.update(finish_written_invoices(drive_service, written))
+
+    for job in jobs:
+        result = results[job['file_id']]
+        job['outcome'] = 'success' if result == "Invoice Processing Successful" else 'failed'
+        if job['outcome'] == 'success':
+            logging.info(f"File {job['file_id']} processed successfully.")
+        else:
+            logging.warning(f"File {job['file_id']} was not processed: {result}.")
+        print(result)
+        finish_trace(job['trace'], job['outcome'])
+        release_lease(job)
+    return jobs
+
+def release_lease(job):
+    lease_manager = get_lease_manager()
+    if lease_manager:
+        lease_manager.release(f"drive:{job['file_id']}")
+
+def handle_stage_error(job, stage_name, error):
+    logging.error(f"Error processing file {job['file_id']} in {stage_name} stage: {error}")
+    log_error_to_sheets(f"{stage_name}_stage in drive_app.py", str(error))
+    finish_trace(job.get('trace'), 'failed')
+    release_lease(job)
+
+def run_invoice_jobs(jobs):
+    # Run every invoice through the staged pipeline so many are in flight at once
+    if llm_mode == 'batch':
+        run_batch_api_pipeline(jobs)
+    else:
+        run_pipeline(jobs, build_invoice_stages(), queue_size=pipeline_queue_size, on_error=handle_stage_error)
+
+def build_invoice_stages():
+    if llm_mode == 'single':
+        llm = Stage('llm', llm_stage, llm_workers)
+    else:
+        llm = Stage('llm', llm_pack_stage, llm_workers, batch_size=llm_pack_size, batch_wait=llm_pack_wait)
+    return [
+        Stage('download', download_stage, download_workers),
+        Stage('ocr', ocr_stage, ocr_workers),
+        llm,
+        build_sheets_stage(),
+    ]
+
+def build_sheets_stage():
+    return Stage('sheets', sheets_stage, sheets_workers, batch_size=sheets_batch_size, batch_wait=sheets_batch_wait)
+
+def run_batch_api_pipeline(jobs):
+    # Download and OCR everything first, extract the whole backlog in one Batch job, then write
+    extracted = []
+    stages = build_invoice_stages()[:2] + [Stage('collect', lambda job: extracted.append(job))]
+    run_pipeline(jobs, stages, queue_size=pipeline_queue_size, on_error=handle_stage_error)
+
+    ready = extract_with_batch_api(extracted)
+    run_pipeline(ready, [build_sheets_stage()], queue_size=pipeline_queue_size, on_error=handle_stage_error)
+
+def start_invoice_pipeline():
+    """
+    Start the invoice pipeline for callers that submit jobs as they arrive; close it when done.
+    """
+    return Pipeline(build_invoice_stages(), queue_size=pipeline_queue_size, on_error=handle_stage_error).start()
+
+
+def is_invoice_mimetype(mimetype):
+    return mimetype == 'application/pdf' or mimetype.startswith('image/')
+
+def list_folder_files(drive_service, folder_id):
+    # Every page of invoice files in the folder; trashed and non-invoice files are filtered server-side
+    files = []
+    page_token = None
+    while True:
+        results = drive_service.files().list(
+            q=f"'{folder_id}' in parents and trashed = false and {INVOICE_MIME_QUERY}",
+            spaces='drive',
+            pageSize=1000,
+            pageToken=page_token,
+            fields='nextPageToken, files(id, name, mimeType, webViewLink)'
+        ).execute()
+        files.extend(results.get('files', []))
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+def list_changed_files(drive_service, page_token, input_folders):
+    # Invoice files added to or changed in the input folders since page_token,
+    # plus the token to resume from next time
+    changed = {}
+    while True:
+        response = drive_service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            includeRemoved=False,
+            pageSize=1000,
+            fields='nextPageToken, newStartPageToken, changes(fileId, file(id, name, mimeType, parents, trashed, webViewLink))'
+        ).execute()
+
+        for change in response.get('changes', []):
+            file = change.get('file')
+            if not file or file.get('trashed') or not is_invoice_mimetype(file.get('mimeType', '')):
+                continue
+            folder_id = next((parent for parent in file.get('parents', []) if parent in input_folders), None)
+            if folder_id:
+                changed[file['id']] = (folder_id, file)
+            else:
+                # The file has since left the input folders (e.g. already processed)
+                changed.pop(file['id'], None)
+
+        if 'newStartPageToken' in response:
+            return list(changed.values()), response['newStartPageToken']
+        page_token = response['nextPageToken']
+
+def discover_input_files(drive_service, input_folders):
+    """
+    Return (folder_id, file) pairs to process and a callback that saves the changes checkpoint.
+    """
+    if drive_discovery == 'changes':
+        page_token = load_sync_state('drive_changes_page_token')
+        last_full_scan = load_sync_state('drive_last_full_scan', 0)
+
+        if page_token and time.time() - last_full_scan < drive_full_scan_hours * 3600:
+            files, new_page_token = list_changed_files(drive_service, page_token, input_folders)
+            logging.info(f"Found {len(files)} new files in the Drive changes feed.")
+            return files, lambda: save_sync_state('drive_changes_page_token', new_page_token)
+
+        # No checkpoint yet (or a periodic rescan is due): take the token before scanning
+        # so changes made during the scan are seen by the next poll
+        new_page_token = drive_service.changes().getStartPageToken().execute()['startPageToken']
+
+        def save_checkpoint():
+            save_sync_state('drive_changes_page_token', new_page_token)
+            save_sync_state('drive_last_full_scan', time.time())
+    else:
+        save_checkpoint = lambda: None
+
+    # List files in both input folders
+    files = []
+    for folder_id in input_folders:
+        try:
+            folder_files = list_folder_files(drive_service, folder_id)
+            logging.info(f"Found {len(folder_files)} files in folder {folder_id}.")
+            files.extend((folder_id, file) for file in folder_files)
+
+        except Exception as e:
+            logging.error(f"Error processing files in folder {folder_id}: {e}")
+            log_error_to_sheets('process_drive_files', f"Error processing files in folder {folder_id}: {e}")
+            save_checkpoint = lambda: None
+
+    return files, save_checkpoint
+
 def process_drive_files():
     try:
-        SCOPES = [
-            'https://www.googleapis.com/auth/gmail.readonly',
-            'https://www.googleapis.com/auth/gmail.modify',
-            'https://www.googleapis.com/auth/drive.file',
-            'https://www.googleapis.com/auth/drive',
-            'https://www.googleapis.com/auth/spreadsheets'
-        ]
-
         drive_service = create_google_service('drive', 'v3', SCOPES)
-        sheets_service = create_google_service('sheets', 'v4', SCOPES)
 
         input_folder_id = os.getenv('INPUT_DRIVE_FOLDER_ID')
         gmail_input_folder_id = os.getenv('GMAIL_ATTACHMENTS_FOLDER_ID') 
+        input_folders = [input_folder_id, gmail_input_folder_id]
 
+        files, save_checkpoint = discover_input_files(drive_service, input_folders)
+
+        jobs = []
+        for folder_id, file in files:
+            logging.info(f"Queueing File ID: {file['id']}, Name: {file['name']}")
+            jobs.append({'file_id': file['id'], 'folder_id': folder_id, 'file_metadata': file})
+
+        # Also pick up invoices an earlier run left part-way through
+        ledger = get_job_ledger()
+        if ledger:
+            # Rows still in this process's write-behind buffer are not lost; send them first so
+            # only invoices whose main sheet rows really never landed are written again
+            rows_flushed = flush_sheets_writer()
+            queued = {job['file_id'] for job in jobs}
+            for pending in ledger.pending_jobs(include_unwritten=rows_flushed):
+                if pending['file_id'] not in queued:
+                    logging.info(f"Resuming unfinished File ID: {pending['file_id']}")
+                    jobs.append({'file_id': pending['file_id'], 'folder_id': pending['folder_id'], 'resume': True})
+
+        # Workers listing the same folders would otherwise all contend for the same first files
+        if get_lease_manager():
+            random.shuffle(jobs)
+
+        run_invoice_jobs(jobs)
+        if any(job.get('lease_skipped') for job in jobs):
+            logging.info("Some files were leased by other workers; keeping the Drive checkpoint.")
+        else:
+            save_checkpoint()
 
-        # List files in both input folders
-        input_folders = [input_folder_id, gmail_input_folder_id]
-        for folder_id in input_folders:
-            try:
-                results = drive_service.files().list(
-                    q=f"'{folder_id}' in parents",
-                    spaces='drive',
-                    fields='files(id, name, mimeType)'
-                ).execute()
+    except Exception as e:
+        logging.error(f"Drive processing error: {e}")
+        log_error_to_sheets('process_drive_files in drive_app.py', f"Drive processing error: {e}")
 
-                if 'files' not in results:
-                    logging.error(f"No files found in folder: {folder_id}")
-                    continue
+    finally:
+        # Buffered sheet rows must reach Sheets even when processing stops early
+        flush_sheets_writer()
 
-                logging.info(f"Found {len(results['files'])} files in folder {folder_id}.")
+def process_single_file(file_id):
+    """
+    Run one Drive file through the pipeline from scratch, wherever it currently is.
+    """
+    try:
+        drive_service = create_google_service('drive', 'v3', SCOPES)
+        file = drive_service.files().get(fileId=file_id, fields='id, name, mimeType, parents, webViewLink').execute()
+        folder_id = (file.get('parents') or [None])[0]
+        logging.info(f"Processing File ID: {file_id}, Name: {file['name']}")
+        run_invoice_jobs([{'file_id': file_id, 'folder_id': folder_id, 'file_metadata': file}])
 
-                for file in results['files']:
-                    logging.info(f"Processing File ID: {file['id']}, Name: {file['name']}")
+    except Exception as e:
+        logging.error(f"Error processing file {file_id}: {e}")
+        log_error_to_sheets('process_single_file in drive_app.py', str(e))
 
-                    # Process the file by passing the folder_id to process_file
-                    result = process_file(drive_service, sheets_service, file['id'], folder_id)
-                    print(result)
-            
-            except Exception as e:
-                logging.error(f"Error processing files in folder {folder_id}: {e}")
-                log_error_to_sheets('process_drive_files', f"Error processing files in folder {folder_id}: {e}")
+    finally:
+        flush_sheets_writer()
 
+def reprocess_failed_files():
+    """
+    Run every invoice in the failed folder through the pipeline again; successes move on to
+    the processed folder.
+    """
+    try:
+        drive_service = create_google_service('drive', 'v3', SCOPES)
+        files = list_folder_files(drive_service, failed_folder_id)
+        logging.info(f"Reprocessing {len(files)} files from the failed folder.")
+        run_invoice_jobs([
+            {'file_id': file['id'], 'folder_id': failed_folder_id, 'file_metadata': file}
+            for file in files
+        ])
 
     except Exception as e:
-        logging.error(f"Drive processing error: {e}")
-        log_error_to_sheets('process_drive_files in drive_app.py', f"Drive processing error: {e}")
+        logging.error(f"Error reprocessing failed files: {e}")
+        log_error_to_sheets('reprocess_failed_files in drive_app.py', str(e))
+
+    finally:
+        flush_sheets_writer()
 
 
 
@@ -1,35 +1,280 @@
 import os
-import logging
+import io
+import re
 import base64
+import hashlib
+import logging
+import mimetypes
 import pytz
 from datetime import datetime
-from googleapiclient.http import MediaFileUpload
-from google_auth import create_google_service
+from googleapiclient.http import MediaIoBaseUpload
+from google_auth import create_google_service, SCOPES
 from logging_utils import log_error_to_sheets
-from dotenv import load_dotenv  
+from sheets_writer import get_sheets_writer, flush_sheets_writer
+from batch_utils import execute_batch
+from sync_state import load_sync_state, save_sync_state
+from stream_utils import Base64DecodingStream
+from work_lease import get_lease_manager
+from metrics import registry
+from googleapiclient.errors import HttpError
+from config import load_environment
 
-# Load environment variables from .env
-load_dotenv()
+load_environment()
 
 gmail_log_sheet_id = os.getenv('GMAIL_LOG_SPREADSHEET_ID')
 gmail_attachments_folder_id = os.getenv('GMAIL_ATTACHMENTS_FOLDER_ID')
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Gmail allows at most 100 calls per batch but throttles large ones, so stay lower
+gmail_batch_size = int(os.getenv('GMAIL_BATCH_SIZE', '50'))
+gmail_attachment_batch_size = int(os.getenv('GMAIL_ATTACHMENT_BATCH_SIZE', '10'))
 
-def process_gmail_attachments():
-    try:
-        SCOPES = [
-            'https://www.googleapis.com/auth/gmail.readonly',
-            'https://www.googleapis.com/auth/gmail.modify',
-            'https://www.googleapis.com/auth/drive.file',
-            'https://www.googleapis.com/auth/drive',
-            'https://www.googleapis.com/auth/spreadsheets'
+# messages.batchModify accepts up to 1000 ids per call
+BATCH_MODIFY_LIMIT = 1000
+
+# Fetch only mail added since the saved historyId instead of searching the whole mailbox
+gmail_incremental_sync = os.getenv('GMAIL_INCREMENTAL_SYNC', '0') == '1'
+
+SKIPPED_SYSTEM_LABELS = {'SPAM', 'TRASH', 'DRAFT', 'SENT'}
+
+# Attachments larger than one chunk are sent as resumable uploads; must be a multiple of 256 KB
+upload_chunk_size = int(os.getenv('DRIVE_UPLOAD_CHUNK_SIZE', str(5 * 1024 * 1024)))
+
+def _env_list(name, default):
+    return {value.strip().lower() for value in os.getenv(name, default).split(',') if value.strip()}
+
+# Only attachments that can be invoices are uploaded; everything else would be paid for in OCR and LLM calls.
+# An empty list turns that check off.
+attachment_mime_types = _env_list('ATTACHMENT_MIME_TYPES', 'application/pdf,image/jpeg,image/png,image/tiff')
+attachment_extensions = _env_list('ATTACHMENT_EXTENSIONS', '.pdf,.jpg,.jpeg,.png,.tif,.tiff')
+# Smaller attachments are signature logos, tracking pixels and the like
+attachment_min_bytes = int(os.getenv('ATTACHMENT_MIN_BYTES', '4096'))
+# Images shown in the message body (logos, banners) rather than attached to it
+skip_inline_images = os.getenv('SKIP_INLINE_IMAGES', '1') == '1'
+# iOS Mail and Outlook also mark attached photos (e.g. phone-scanned invoices) as inline, so an
+# inline image is only skipped when the HTML body shows it or it is smaller than this
+inline_image_max_bytes = int(os.getenv('INLINE_IMAGE_MAX_BYTES', str(50 * 1024)))
+
+CID_REFERENCE = re.compile(r'cid:([^"\'\s>)]+)', re.IGNORECASE)
+
+def list_message_ids(gmail_service, query):
+    # Follow nextPageToken so backlogs larger than one page are not deferred
+    message_ids = []
+    page_token = None
+    while True:
+        response = gmail_service.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=500,
+            pageToken=page_token
+        ).execute()
+        message_ids.extend(message['id'] for message in response.get('messages', []))
+
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return message_ids
+
+def list_new_message_ids(gmail_service, start_history_id):
+    # Every page of messages added since start_history_id, oldest first and without repeats
+    message_ids = []
+    seen = set()
+    page_token = None
+    while True:
+        response = gmail_service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded'],
+            maxResults=500,
+            pageToken=page_token
+        ).execute()
+
+        for history in response.get('history', []):
+            for added in history.get('messagesAdded', []):
+                message_id = added['message']['id']
+                if message_id not in seen:
+                    seen.add(message_id)
+                    message_ids.append(message_id)
+
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return message_ids
+
+def fetch_messages(gmail_service, message_ids):
+    results = execute_batch(gmail_service, [
+        (message_id, gmail_service.users().messages().get(userId='me', id=message_id))
+        for message_id in message_ids
+    ], batch_size=gmail_batch_size)
+
+    messages = {}
+    for message_id, (msg, error) in results.items():
+        if error:
+            log_error_to_sheets("process_gmail_attachments (message fetch)", str(error))
+            logging.error(f"Error fetching email {message_id}: {error}")
+        else:
+            messages[message_id] = msg
+    return messages
+
+def fetch_attachments(gmail_service, items):
+    # items are (message_id, part) pairs; returns {(message_id, attachment_id): (attachment, error)}
+    return execute_batch(gmail_service, [
+        ((message_id, part['body']['attachmentId']), gmail_service.users().messages().attachments().get(
+            userId='me', messageId=message_id, id=part['body']['attachmentId']
+        ))
+        for message_id, part in items
+    ], batch_size=gmail_attachment_batch_size)
+
+def label_messages(gmail_service, message_ids, label_id):
+    # One batchModify call per 1000 emails instead of one modify call each
+    for start in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+        chunk = message_ids[start:start + BATCH_MODIFY_LIMIT]
+        try:
+            gmail_service.users().messages().batchModify(
+                userId='me',
+                body={'ids': chunk, 'addLabelIds': [label_id]}
+            ).execute()
+            logging.info(f"Labeled {len(chunk)} emails as 'processed'.")
+        except Exception as e:
+            log_error_to_sheets("process_gmail_attachments (labelling)", str(e))
+            logging.error(f"Error labelling {len(chunk)} emails: {e}")
+
+def attachment_mimetype(part):
+    # Mail clients often label PDFs as octet-stream; the file name is a better hint then
+    mimetype = part.get('mimeType')
+    if not mimetype or mimetype == 'application/octet-stream':
+        mimetype = mimetypes.guess_type(part['filename'])[0] or 'application/octet-stream'
+    return mimetype
+
+def walk_attachment_parts(part):
+    # Attachments can sit at any depth: multipart/mixed inside multipart/alternative,
+    # or inside a forwarded message/rfc822 part
+    if part.get('filename') and part.get('body', {}).get('attachmentId'):
+        yield part
+    for child in part.get('parts', []):
+        yield from walk_attachment_parts(child)
+
+def part_header(part, name):
+    return next((h['value'] for h in part.get('headers', []) if h['name'].lower() == name.lower()), '')
+
+def referenced_content_ids(part):
+    # Content-IDs the HTML body displays with <img src="cid:...">
+    content_ids = set()
+    if part.get('mimeType') == 'text/html' and part.get('body', {}).get('data'):
+        html = base64.urlsafe_b64decode(part['body']['data'] + '==').decode('utf-8', 'replace')
+        content_ids.update(content_id.lower() for content_id in CID_REFERENCE.findall(html))
+    for child in part.get('parts', []):
+        content_ids |= referenced_content_ids(child)
+    return content_ids
+
+def is_inline_image(part, shown_content_ids):
+    content_id = part_header(part, 'Content-ID').strip('<> ').lower()
+    if not (part_header(part, 'Content-Disposition').lower().startswith('inline') or content_id):
+        return False
+    return content_id in shown_content_ids or part.get('body', {}).get('size', 0) < inline_image_max_bytes
+
+def skip_reason(part, shown_content_ids=frozenset()):
+    """
+    Why an attachment part is not an invoice document, or None if it should be uploaded.
+    """
+    mimetype = attachment_mimetype(part).lower()
+    extension = os.path.splitext(part['filename'])[1].lower()
+    if skip_inline_images and mimetype.startswith('image/') and is_inline_image(part, shown_content_ids):
+        return 'inline_image'
+    if attachment_mime_types and mimetype not in attachment_mime_types:
+        return 'mime_type'
+    # Files without an extension are judged by their MIME type alone
+    if attachment_extensions and extension and extension not in attachment_extensions:
+        return 'extension'
+    if part.get('body', {}).get('size', attachment_min_bytes) < attachment_min_bytes:
+        return 'too_small'
+    return None
+
+def select_attachment_parts(message_id, payload):
+    parts = []
+    seen_ids = set()
+    shown_content_ids = referenced_content_ids(payload)
+    for part in walk_attachment_parts(payload):
+        reason = skip_reason(part, shown_content_ids)
+        if reason is None and part['body']['attachmentId'] in seen_ids:
+            reason = 'duplicate'
+        if reason:
+            logging.info(f"Skipping attachment {part['filename']} of email {message_id} ({reason}).")
+            registry.increment('gmail_attachments_skipped_total', reason=reason)
+            continue
+        seen_ids.add(part['body']['attachmentId'])
+        parts.append(part)
+    return parts
+
+def upload_attachment(drive_service, part, attachment, sender, subject):
+    # Decode the payload on the fly while uploading; nothing is written to disk
+    stream = Base64DecodingStream(attachment['data'])
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    resumable = size > upload_chunk_size
+
+    # Upload to Google Drive
+    file_metadata = {
+        'name': part['filename'],
+        'parents': [gmail_attachments_folder_id]
+    }
+    media = MediaIoBaseUpload(stream, mimetype=attachment_mimetype(part), chunksize=upload_chunk_size, resumable=resumable)
+    request = drive_service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id, webViewLink'
+    )
+
+    if resumable:
+        # Large files go up chunk by chunk, so only one chunk is decoded at a time
+        drive_file = None
+        while drive_file is None:
+            _, drive_file = request.next_chunk()
+    else:
+        drive_file = request.execute()
+
+    # Log details in Google Sheets
+    log_data = [
+        [
+            datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%d-%m-%Y %I:%M:%S %p'),
+            part['filename'],
+            drive_file['id'],
+            drive_file['webViewLink'],
+            sender,
+            subject,
         ]
-        
+    ]
+    get_sheets_writer().append(gmail_log_sheet_id, 'Gmail Logs!A:F', log_data)
+    logging.info(f"Processed attachment: {part['filename']}")
+    registry.increment('gmail_attachments_uploaded_total')
+    registry.increment('gmail_attachment_bytes_total', size)
+    return drive_file
+
+def handoff_job(part, attachment, drive_file):
+    # Invoice pipeline job for an uploaded attachment; the bytes travel with it so the
+    # pipeline does not download the Drive copy again
+    return {
+        'file_id': drive_file['id'],
+        'folder_id': gmail_attachments_folder_id,
+        'file_content': io.BytesIO(base64.urlsafe_b64decode(attachment['data'])),
+        'file_metadata': {'id': drive_file['id'], 'name': part['filename'], 'webViewLink': drive_file['webViewLink']},
+    }
+
+def process_gmail_attachments(incremental=None, handoff=None):
+    """
+    Upload new Gmail attachments to Drive and return how many were uploaded.
+
+    If handoff is given, it is called with an invoice pipeline job for every uploaded
+    attachment (see drive_app.start_invoice_pipeline); the Drive copy is then only
+    kept for archiving.
+    """
+    if incremental is None:
+        incremental = gmail_incremental_sync
+
+    processed_message_ids = []
+    label_id = None
+    uploaded_count = 0
+    try:
         # Initialize services
         gmail_service = create_google_service('gmail', 'v1', SCOPES)
         drive_service = create_google_service('drive', 'v3', SCOPES)
-        sheets_service = create_google_service('sheets', 'v4', SCOPES)
 
         # Ensure the 'processed' label exists
         label_name = "processed"
@@ -43,87 +288,133 @@ def process_gmail_attachments():
             label_id = created_label['id']
             logging.info(f"Created label '{label_name}' with ID: {label_id}")
 
-        # Fetch messages with attachments that are not labeled as 'processed'
-        messages = gmail_service.users().messages().list(
-            userId='me', 
-            q='has:attachment -label:processed',
-        ).execute().get('messages', [])
+        # Note the mailbox position before listing so mail arriving during the run is not skipped
+        mailbox_history_id = gmail_service.users().getProfile(userId='me').execute()['historyId']
+        start_history_id = load_sync_state('gmail_history_id') if incremental else None
+
+        message_ids = None
+        if start_history_id:
+            try:
+                message_ids = list_new_message_ids(gmail_service, start_history_id)
+                logging.info(f"Incremental sync from history {start_history_id}: {len(message_ids)} new messages.")
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logging.warning(f"History id {start_history_id} has expired, falling back to a full scan.")
 
-        if not messages:
+        if message_ids is None:
+            # Fetch every page of messages with attachments that are not labeled as 'processed'
+            message_ids = list_message_ids(gmail_service, 'has:attachment -label:processed')
+
+        if not message_ids:
             logging.info("No messages with attachments found.")
-            return
-
-        for message in messages:
-            msg = gmail_service.users().messages().get(userId='me', id=message['id']).execute()
-
-            headers = msg['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
-
-            # Process attachments
-            if 'parts' in msg['payload']:
-                for part in msg['payload']['parts']:
-                    if part.get('filename') and part.get('body', {}).get('attachmentId'):
-                        attachment_id = part['body']['attachmentId']
-                        attachment = gmail_service.users().messages().attachments().get(
-                            userId='me', messageId=message['id'], id=attachment_id
-                        ).execute()
-
-                        try:
-
-                            file_data = base64.urlsafe_b64decode(attachment['data'])
-                            file_path = os.path.join("/tmp", part['filename'])  # Temporary file path
-
-                            # Save attachment locally
-                            with open(file_path, 'wb') as temp_file:
-                                temp_file.write(file_data)
-
-                            # Upload to Google Drive
-                            file_metadata = {
-                                'name': part['filename'],
-                                'parents': [gmail_attachments_folder_id]
-                            }
-                            media = MediaFileUpload(file_path, mimetype='application/octet-stream')
-                            drive_file = drive_service.files().create(
-                                body=file_metadata,
-                                media_body=media,
-                                fields='id, webViewLink'
-                            ).execute()
-
-                            # Log details in Google Sheets
-                            log_data = [
-                                [
-                                    datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%d-%m-%Y %I:%M:%S %p'),
-                                    part['filename'],
-                                    drive_file['id'],
-                                    drive_file['webViewLink'],
-                                    sender,
-                                    subject,
-                                ]
-                            ]
-                            sheets_service.spreadsheets().values().append(
-                                spreadsheetId=gmail_log_sheet_id,
-                                range='Gmail Logs!A:F',
-                                valueInputOption='RAW',
-                                body={'values': log_data}
-                            ).execute()
-
-                            # Clean up local file
-                            os.remove(file_path)
-                            logging.info(f"Processed attachment: {part['filename']}")
-
-                        except Exception as e:
-                            log_error_to_sheets("process_gmail_attachments (attachment handling)", str(e))
-                            logging.error(f"Error processing attachment {part['filename']}: {e}")
-
-            # Add 'processed' label
-            gmail_service.users().messages().modify(
-                userId='me',
-                id=message['id'],
-                body={"addLabelIds": [label_id]}
-            ).execute()
-            logging.info(f"Email {message['id']} labeled as 'processed'.")
+        else:
+            logging.info(f"Found {len(message_ids)} messages to check for attachments.")
+
+        # Any failure keeps the checkpoint where it was, so the next run looks at these messages again
+        run_failed = False
+
+        lease_manager = get_lease_manager()
+        for start in range(0, len(message_ids), gmail_batch_size):
+            chunk = message_ids[start:start + gmail_batch_size]
+
+            # Other workers may be draining the same mailbox; skip emails they hold. The holder
+            # may still fail them, so the checkpoint must not move past them.
+            if lease_manager:
+                claimed = [message_id for message_id in chunk if lease_manager.claim(f"gmail:{message_id}")]
+                if len(claimed) < len(chunk):
+                    run_failed = True
+                chunk = claimed
+                if not chunk:
+                    continue
+
+            messages = fetch_messages(gmail_service, chunk)
+
+            # Collect the attachment parts of every email in this chunk
+            details = {}
+            items = []
+            for message_id in chunk:
+                msg = messages.get(message_id)
+                if msg is None:
+                    run_failed = True
+                    continue
+
+                # History also reports sent mail, drafts and mail without attachments; skip those
+                message_labels = set(msg.get('labelIds', []))
+                skipped_labels = message_labels & SKIPPED_SYSTEM_LABELS
+                if 'INBOX' in message_labels:
+                    # Mail sent to this mailbox itself is incoming as well
+                    skipped_labels.discard('SENT')
+                if label_id in message_labels or skipped_labels:
+                    continue
+                attachment_parts = select_attachment_parts(message_id, msg['payload'])
+                if not attachment_parts:
+                    # Nothing worth uploading; label it so full scans stop fetching it
+                    processed_message_ids.append(message_id)
+                    continue
+
+                headers = msg['payload']['headers']
+                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
+                sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
+                details[message_id] = (sender, subject)
+
+                items.extend((message_id, part) for part in attachment_parts)
+
+            # Emails whose attachments could not all be fetched stay unlabelled for the next run
+            failed_message_ids = set()
+            # The same document attached twice to one email is uploaded once
+            content_hashes = {message_id: set() for message_id in details}
+            for item_start in range(0, len(items), gmail_attachment_batch_size):
+                item_chunk = items[item_start:item_start + gmail_attachment_batch_size]
+                attachments = fetch_attachments(gmail_service, item_chunk)
+
+                for message_id, part in item_chunk:
+                    attachment, error = attachments[(message_id, part['body']['attachmentId'])]
+                    try:
+                        if error:
+                            failed_message_ids.add(message_id)
+                            run_failed = True
+                            raise error
+                        content_hash = hashlib.sha256(attachment['data'].encode('ascii')).hexdigest()
+                        if content_hash in content_hashes[message_id]:
+                            logging.info(f"Skipping attachment {part['filename']} of email {message_id} (duplicate content).")
+                            registry.increment('gmail_attachments_skipped_total', reason='duplicate')
+                            continue
+                        content_hashes[message_id].add(content_hash)
+                        sender, subject = details[message_id]
+                        drive_file = upload_attachment(drive_service, part, attachment, sender, subject)
+                        uploaded_count += 1
+                        if handoff:
+                            handoff(handoff_job(part, attachment, drive_file))
+
+                    except Exception as e:
+                        log_error_to_sheets("process_gmail_attachments (attachment handling)", str(e))
+                        logging.error(f"Error processing attachment {part['filename']}: {e}")
+
+            # Queue for the batched 'processed' label
+            processed_message_ids.extend(
+                message_id for message_id in details if message_id not in failed_message_ids
+            )
+            if len(processed_message_ids) >= BATCH_MODIFY_LIMIT:
+                label_messages(gmail_service, processed_message_ids, label_id)
+                processed_message_ids = []
+
+        if not run_failed:
+            save_sync_state('gmail_history_id', mailbox_history_id)
 
     except Exception as e:
         log_error_to_sheets("process_gmail_attachments", str(e))
-        logging.error(f"Gmail processing error: {e}")
\ No newline at end of file
+        logging.error(f"Gmail processing error: {e}")
+
+    finally:
+        # Label whatever was handled, and flush buffered log rows, even when processing stops early
+        if processed_message_ids and label_id:
+            label_messages(gmail_service, processed_message_ids, label_id)
+        flush_sheets_writer()
+
+        # Emails are labelled by now, so other workers will skip them
+        lease_manager = get_lease_manager()
+        if lease_manager:
+            lease_manager.release_all('gmail:')
+
+    return uploaded_count
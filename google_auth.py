@@ -1,36 +1,136 @@
 import os
 import logging
+import threading
+import httplib2
+import google_auth_httplib2
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+from config import load_environment
+from rate_limit import call_with_limits, google_operation_class, is_idempotent
+from metrics import span, record_bytes
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+load_environment()
 
-def create_google_service(service_name, version, scopes):
+SCOPES = [
+    'https://www.googleapis.com/auth/gmail.readonly',
+    'https://www.googleapis.com/auth/gmail.modify',
+    'https://www.googleapis.com/auth/drive.file',
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/spreadsheets'
+]
+
+TOKEN_PATH = 'token.json'
+HTTP_TIMEOUT = int(os.getenv('GOOGLE_HTTP_TIMEOUT', '120'))
+
+# Process-wide registry: one credential and one client per (service, version)
+_lock = threading.RLock()
+_credentials = None
+_services = {}
+_thread_local = threading.local()
+
+
+def get_credentials(scopes=SCOPES):
     """
-    Authenticate and create a Google API service client.
+    Return the shared credentials, loading, refreshing or authorising them once under a lock.
     """
-    try:
-        creds = None
-        token_path = 'token.json'
-
-        if os.path.exists(token_path):
-            creds = Credentials.from_authorized_user_file(token_path, scopes)
+    global _credentials
+    with _lock:
+        creds = _credentials
+        if creds is None and os.path.exists(TOKEN_PATH):
+            creds = Credentials.from_authorized_user_file(TOKEN_PATH, scopes)
 
         if not creds or not creds.valid:
+            # Imported here: refreshing and the browser flow are rare, and both pull in large packages
             if creds and creds.expired and creds.refresh_token:
+                from google.auth.transport.requests import Request
                 creds.refresh(Request())
             else:
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file('credentials.json', scopes)
                 creds = flow.run_local_server(port=0)
 
             # Save the credentials for the next run
-            with open(token_path, 'w') as token:
+            with open(TOKEN_PATH, 'w') as token:
                 token.write(creds.to_json())
 
-        return build(service_name, version, credentials=creds)
-    
+        _credentials = creds
+        return creds
+
+
+class RateLimitedHttpRequest(HttpRequest):
+    """
+    HttpRequest whose execute() waits for the shared quota of its API and operation class
+    and retries 429 responses, and 5xx responses of idempotent methods, so every Google
+    call follows one rate-limit policy.
+    """
+    def execute(self, http=None, num_retries=0):
+        operation = google_operation_class(self.uri, self.method)
+        api = operation.split('_')[0]
+        method_id = getattr(self, 'methodId', None) or operation
+        with span('call', method_id, api=api):
+            if self.body:
+                record_bytes(api, method_id, 'out', len(self.body))
+            return call_with_limits(
+                lambda: HttpRequest.execute(self, http=http, num_retries=num_retries),
+                [(operation, 1)],
+                description=f"{operation} {self.method} request",
+                idempotent=is_idempotent(self.method)
+            )
+
+    def next_chunk(self, http=None, num_retries=0):
+        # A failed chunk of a resumable upload is resumed by calling next_chunk again
+        operation = google_operation_class(self.uri, self.method)
+        with span('call', f"{getattr(self, 'methodId', None) or operation}.chunk", api=operation.split('_')[0]):
+            return call_with_limits(
+                lambda: HttpRequest.next_chunk(self, http=http, num_retries=num_retries),
+                [(operation, 1)],
+                description=f"{operation} upload chunk"
+            )
+
+
+def _thread_http():
+    # httplib2 connections are not thread-safe; each thread keeps its own and reuses it
+    if not hasattr(_thread_local, 'http'):
+        _thread_local.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+    return _thread_local.http
+
+
+def _build_request(http, *args, **kwargs):
+    authorized_http = google_auth_httplib2.AuthorizedHttp(get_credentials(), http=_thread_http())
+    return RateLimitedHttpRequest(authorized_http, *args, **kwargs)
+
+
+def register_service(service_name, version, service):
+    """
+    Install a ready-made client for (service_name, version), e.g. an in-process fake for benchmarks.
+    """
+    with _lock:
+        _services[(service_name, version)] = service
+
+
+def create_google_service(service_name, version, scopes=SCOPES):
+    """
+    Authenticate and return the shared Google API service client for (service_name, version).
+    """
+    try:
+        key = (service_name, version)
+        with _lock:
+            service = _services.get(key)
+            if service is None:
+                creds = get_credentials(scopes)
+                # Bundled discovery documents avoid a network fetch; requests go through
+                # _build_request so every thread uses its own transport.
+                service = build(
+                    service_name,
+                    version,
+                    http=google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT)),
+                    requestBuilder=_build_request,
+                    static_discovery=True
+                )
+                _services[key] = service
+            return service
+
     except Exception as e:
         logging.error(f"Error creating Google service: {e}")
-        raise
\ No newline at end of file
+        raise
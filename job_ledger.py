@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from config import load_environment
+
+load_environment()
+
+JOB_LEDGER_PATH = os.getenv('JOB_LEDGER_PATH', 'job_ledger.sqlite3')
+job_ledger_enabled = os.getenv('JOB_LEDGER_ENABLED', '1') == '1'
+# Unfinished jobs older than this are no longer resumed automatically
+job_ledger_resume_days = float(os.getenv('JOB_LEDGER_RESUME_DAYS', '7'))
+
+# An invoice passes through downloaded -> ocr -> extracted -> written -> moved;
+# 'failed' is terminal like 'moved'
+TERMINAL_STAGES = ('moved', 'failed')
+
+
+class JobLedger:
+    """
+    SQLite record of how far each Drive file got through the invoice pipeline.
+
+    Intermediate results (extracted text, LLM output) are stored with the stage, so a
+    resumed run restarts an invoice where it stopped instead of paying for OCR and the
+    LLM again, and side effects already performed are not repeated.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'file_id TEXT PRIMARY KEY, folder_id TEXT, stage TEXT, '
+            'extracted_text TEXT, chatgpt_output TEXT, output_spreadsheet_id TEXT, '
+            'main_rows_written INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)'
+        )
+        self._conn.commit()
+
+    def get(self, file_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE file_id = ?', (file_id,)).fetchone()
+        if row is None:
+            return None
+
+        entry = dict(row)
+        if entry['chatgpt_output']:
+            entry['chatgpt_output'] = json.loads(entry['chatgpt_output'])
+        return entry
+
+    def update(self, file_id, folder_id=None, **fields):
+        if 'chatgpt_output' in fields and fields['chatgpt_output'] is not None:
+            fields['chatgpt_output'] = json.dumps(fields['chatgpt_output'])
+        fields['updated'] = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO jobs (file_id, folder_id, updated) VALUES (?, ?, ?)',
+                (file_id, folder_id, fields['updated'])
+            )
+            if folder_id:
+                fields['folder_id'] = folder_id
+            assignments = ', '.join(f'{column} = ?' for column in fields)
+            self._conn.execute(
+                f'UPDATE jobs SET {assignments} WHERE file_id = ?',
+                (*fields.values(), file_id)
+            )
+            self._conn.commit()
+
+    def record_stage(self, file_id, stage, folder_id=None, **fields):
+        self.update(file_id, folder_id=folder_id, stage=stage, **fields)
+
+    def reset(self, file_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM jobs WHERE file_id = ?', (file_id,))
+            self._conn.commit()
+
+    def pending_jobs(self, max_age_days=job_ledger_resume_days, include_unwritten=True):
+        """
+        Jobs that stopped part-way: not finished, or (with include_unwritten) moved while
+        their main sheet rows never landed.
+        """
+        cutoff = time.time() - max_age_days * 86400
+        unfinished = "(stage IS NULL OR stage NOT IN ('moved', 'failed'))"
+        if include_unwritten:
+            unfinished += " OR (stage = 'moved' AND main_rows_written = 0)"
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT file_id, folder_id FROM jobs WHERE updated >= ? AND ({unfinished})",
+                (cutoff,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_job_ledger():
+    """
+    Return the shared ledger, or None when JOB_LEDGER_ENABLED is off or it cannot be opened.
+    """
+    global _ledger, job_ledger_enabled
+    with _ledger_lock:
+        if _ledger is None and job_ledger_enabled:
+            try:
+                _ledger = JobLedger(JOB_LEDGER_PATH)
+            except Exception as e:
+                logging.error(f"Could not open job ledger at {JOB_LEDGER_PATH}, continuing without it: {e}")
+                job_ledger_enabled = False
+        return _ledger
@@ -1,53 +1,128 @@
 import os
+import sys
+import queue
 import logging
+import threading
 import pytz
 import traceback
 from datetime import datetime
-from google_auth import create_google_service
-from dotenv import load_dotenv  
+from collections import OrderedDict
+from google_auth import create_google_service, SCOPES
+from metrics import registry
+from config import load_environment
 
-load_dotenv()
+load_environment()
+
+# Seconds between batched writes to the 'Code Errors' sheet
+error_log_flush_interval = float(os.getenv('ERROR_LOG_FLUSH_INTERVAL', '10'))
+
+LOCAL_ERROR_LOG = "local_error_log.txt"
+
+
+class SheetsErrorHandler(logging.Handler):
+    """
+    Logging handler that queues error records and writes them to the 'Code Errors' sheet
+    from a background thread, one append per flush interval.
+
+    Identical errors within an interval become a single row with a count. When Sheets
+    cannot be reached the rows are written to the local error log instead.
+    """
+    def __init__(self, spreadsheet_id, range_name='Code Errors!A:F', flush_interval=10.0):
+        super().__init__(level=logging.ERROR)
+        self.spreadsheet_id = spreadsheet_id
+        self.range_name = range_name
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sheets-error-log', daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            function_name = getattr(record, 'function_name', record.funcName)
+            if record.exc_info and record.exc_info[0]:
+                error_type = record.exc_info[0].__name__
+                stack_trace = "".join(traceback.format_exception(*record.exc_info))
+            else:
+                error_type = "Error"
+                stack_trace = "".join(traceback.format_stack(limit=10)[:-1])
+
+            timestamp = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%d-%m-%Y %I:%M:%S %p')
+            self._queue.put((timestamp, function_name, record.getMessage(), error_type, stack_trace))
+        except Exception:
+            self.handleError(record)
+
+    def _collect_rows(self):
+        # Collapse identical errors into one row, keeping the first timestamp and trace
+        grouped = OrderedDict()
+        while True:
+            try:
+                timestamp, function_name, message, error_type, stack_trace = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            key = (function_name, message, error_type)
+            if key in grouped:
+                grouped[key][5] += 1
+            else:
+                grouped[key] = [timestamp, function_name, message, error_type, stack_trace, 1]
+        return list(grouped.values())
+
+    def flush(self):
+        with self._flush_lock:
+            rows = self._collect_rows()
+            if not rows:
+                return
+
+            try:
+                if not self.spreadsheet_id:
+                    raise Exception("GMAIL_LOG_SPREADSHEET_ID is not set")
+
+                sheets_service = create_google_service('sheets', 'v4', SCOPES)
+                sheets_service.spreadsheets().values().append(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=self.range_name,
+                    valueInputOption="RAW",
+                    body={'values': rows}
+                ).execute()
+
+                logging.info(f"Logged {len(rows)} errors to Google Sheets.")
+                registry.increment('error_log_rows_total', len(rows))
+
+            except Exception as e:
+                # Handle errors during logging
+                logging.error(f"Error occurred while logging to Google Sheets: {e}")
+
+                with open(LOCAL_ERROR_LOG, "a") as log_file:
+                    log_file.write(f"{datetime.now()} - Error while logging to sheets: {e}\n")
+                    for timestamp, function_name, message, error_type, stack_trace, count in rows:
+                        log_file.write(f"{timestamp} - {function_name} - {error_type} (x{count}): {message}\n{stack_trace}\n")
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        super().close()
+
+
+# Errors bound for the sheet go through their own logger so ordinary logging.error calls stay local
+error_logger = logging.getLogger('invoice_automation.errors')
+error_logger.propagate = False
+error_logger.addHandler(SheetsErrorHandler(
+    os.getenv('GMAIL_LOG_SPREADSHEET_ID'),
+    flush_interval=error_log_flush_interval
+))
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def log_error_to_sheets(function_name, error_message):
-    try:
-        SCOPES = [
-            'https://www.googleapis.com/auth/gmail.readonly',
-            'https://www.googleapis.com/auth/gmail.modify',
-            'https://www.googleapis.com/auth/drive.file',
-            'https://www.googleapis.com/auth/drive',
-            'https://www.googleapis.com/auth/spreadsheets'
-        ]
-        
-        # Initialize services
-        sheets_service = create_google_service('sheets', 'v4', SCOPES)
-        
-
-        # Get additional error info
-        error_type = type(error_message).__name__  # Get the error type (e.g., TypeError, ValueError)
-        stack_trace = traceback.format_exc()  # Get the full stack trace of the exception
-
-        # Prepare data to log
-        log_sheet_id = os.getenv('GMAIL_LOG_SPREADSHEET_ID')
-        range_name = 'Code Errors!A:E'  # Adjust the range according to where you want the errors logged
-        values = [[datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%d-%m-%Y %I:%M:%S %p'), function_name, error_message, error_type, stack_trace]]
-        body = {'values': values}
-        
-        # Log error to the sheet
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=log_sheet_id,
-            range=range_name,
-            valueInputOption="RAW",
-            body=body
-        ).execute()
-
-        logging.info("Error logged to Google Sheets.")
-
-    except Exception as e:
-        # Handle errors during logging
-        logging.error(f"Error occurred while logging to Google Sheets: {e}")
-
-        # Optionally, log to a file or send a local notification
-        with open("local_error_log.txt", "a") as log_file:
-            log_file.write(f"{datetime.now()} - Error while logging to sheets: {e}\n")
\ No newline at end of file
+    # Callers are usually inside an except block, so the active exception gives the
+    # real error type and traceback rather than the type of the message string.
+    exc_info = sys.exc_info()
+    error_logger.error(
+        error_message,
+        exc_info=exc_info if exc_info[0] else None,
+        extra={'function_name': function_name}
+    )
@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import load_environment
+
+load_environment()
+
+# Port for the /metrics (Prometheus text) and /metrics.json endpoint; 0 keeps it off
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# File the metrics are dumped to after each run, as JSON (or Prometheus text for a .prom name)
+METRICS_FILE = os.getenv('METRICS_FILE', '')
+# Directory for one JSON trace file per invoice; empty keeps tracing in memory only
+TRACE_DIR = os.getenv('TRACE_DIR', '')
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and duration histograms, keyed by metric name and label values.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def increment(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(DURATION_BUCKETS)}
+            histogram['count'] += 1
+            histogram['sum'] += value
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), 'count': histogram['count'], 'sum': round(histogram['sum'], 6),
+                     'buckets': dict(zip(map(str, DURATION_BUCKETS), histogram['buckets']))}
+                    for (name, labels), histogram in sorted(self._histograms.items())
+                ],
+            }
+
+    def render_prometheus(self):
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{label_text(labels)} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+                        lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(f"{name}_sum{label_text(labels)} {histogram['sum']:.6f}")
+                    lines.append(f"{name}_count{label_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class Trace:
+    """
+    Timeline of one invoice: every stage and external call made on its behalf, in order.
+    """
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.started = time.time()
+        self.spans = []
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def _start(self, span):
+        with self._lock:
+            self._open[id(span)] = span
+
+    def _finish(self, span):
+        with self._lock:
+            self._open.pop(id(span), None)
+            self.spans.append(span)
+
+    def stage_seconds(self):
+        # Stages still running (e.g. the sheets stage writing this breakdown) count up to now
+        now = time.time()
+        totals = {}
+        with self._lock:
+            for span in self.spans + list(self._open.values()):
+                if span.kind == 'stage':
+                    duration = span.duration if span.duration is not None else now - span.started
+                    totals[span.name] = totals.get(span.name, 0.0) + duration
+        return totals
+
+    def breakdown(self):
+        return " ".join(f"{name}={seconds:.2f}s" for name, seconds in self.stage_seconds().items())
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.started)
+        return {
+            'file_id': self.file_id,
+            'started': self.started,
+            'stage_seconds': self.stage_seconds(),
+            'spans': [span.to_dict(self.started) for span in spans],
+        }
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{self.file_id}.json"), 'w') as trace_file:
+            json.dump(self.to_dict(), trace_file, indent=2, default=str)
+
+
+class Span:
+    def __init__(self, kind, name, attrs):
+        self.kind = kind
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self.duration = None
+        self.outcome = 'ok'
+
+    def to_dict(self, origin):
+        return {
+            'kind': self.kind,
+            'name': self.name,
+            'start': round(self.started - origin, 4),
+            'duration': round(self.duration, 4) if self.duration is not None else None,
+            'outcome': self.outcome,
+            **self.attrs,
+        }
+
+
+_local = threading.local()
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def current_span():
+    stack = getattr(_local, 'spans', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def use_trace(trace):
+    """
+    Make trace the current invoice's trace for this thread, so spans opened below attach to it.
+    """
+    previous = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def propagate_trace(func):
+    # For work handed to another thread (e.g. an executor) on behalf of the current invoice
+    trace = current_trace()
+
+    def run(*args, **kwargs):
+        with use_trace(trace):
+            return func(*args, **kwargs)
+    return run
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    """
+    Time a pipeline stage (kind 'stage') or external call (kind 'call', with an 'api' attribute).
+
+    The duration goes into the stage or call histogram with its outcome, and the span is
+    added to the current invoice's trace. Attributes set on the yielded span while it is
+    open (bytes, tokens, retries) are kept on the trace.
+    """
+    current = Span(kind, name, attrs)
+    trace = current_trace()
+    stack = getattr(_local, 'spans', None)
+    if stack is None:
+        stack = _local.spans = []
+    stack.append(current)
+    if trace:
+        trace._start(current)
+
+    try:
+        yield current
+    except BaseException:
+        current.outcome = 'error'
+        raise
+    finally:
+        current.duration = time.time() - current.started
+        stack.pop()
+        if kind == 'stage':
+            registry.observe('invoice_stage_seconds', current.duration, stage=name, outcome=current.outcome)
+        else:
+            registry.observe('external_call_seconds', current.duration, api=attrs.get('api', 'other'), operation=name, outcome=current.outcome)
+        if trace:
+            trace._finish(current)
+
+
+@contextmanager
+def stage_span_for(traces, name):
+    """
+    Time one stage run on behalf of several invoices at once (e.g. a packed LLM request),
+    recording it in each of their traces.
+    """
+    spans = [(trace, Span('stage', name, {'batch_size': len(traces)})) for trace in traces]
+    for trace, current in spans:
+        trace._start(current)
+
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        for trace, current in spans:
+            current.duration = time.time() - current.started
+            current.outcome = outcome
+            registry.observe('invoice_stage_seconds', current.duration, stage=name, outcome=outcome)
+            trace._finish(current)
+
+
+def add_to_span(**amounts):
+    """
+    Add numeric attributes (bytes, tokens, retries) to the innermost open span.
+    """
+    current = current_span()
+    if current is not None:
+        for key, amount in amounts.items():
+            current.attrs[key] = current.attrs.get(key, 0) + amount
+
+
+def record_bytes(api, operation, direction, amount):
+    registry.increment('external_call_bytes_total', amount, api=api, operation=operation, direction=direction)
+    add_to_span(**{f"bytes_{direction}": amount})
+
+
+def record_retry(operation, status=None):
+    registry.increment('api_retries_total', operation=operation, status=status or 'unknown')
+    add_to_span(retries=1)
+
+
+def finish_trace(trace, outcome):
+    registry.increment('invoices_total', outcome=outcome)
+    if trace is None:
+        return
+    for stage, seconds in trace.stage_seconds().items():
+        registry.observe('invoice_total_stage_seconds', seconds, stage=stage)
+    if TRACE_DIR:
+        try:
+            trace.write(TRACE_DIR)
+        except OSError as e:
+            logging.error(f"Could not write trace for {trace.file_id}: {e}")
+
+
+def dump_metrics(path=None):
+    path = path or METRICS_FILE
+    if not path:
+        return
+    try:
+        with open(path, 'w') as metrics_file:
+            if path.endswith('.prom'):
+                metrics_file.write(registry.render_prometheus())
+            else:
+                json.dump(registry.snapshot(), metrics_file, indent=2)
+    except OSError as e:
+        logging.error(f"Could not write metrics to {path}: {e}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = registry.render_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(registry.snapshot()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        payload = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=None):
+    """
+    Serve /metrics and /metrics.json from a background thread; returns None when the port is 0.
+    """
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f"Serving metrics on port {port}.")
+    return server
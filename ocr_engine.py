@@ -0,0 +1,145 @@
+import os
+import asyncio
+import logging
+import threading
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.polling.async_base_polling import AsyncLROBasePolling
+from config import load_environment
+from rate_limit import get_bucket
+
+load_environment()
+
+logging.getLogger('azure.core').setLevel(logging.WARNING)
+logging.getLogger('azure.ai.formrecognizer').setLevel(logging.WARNING)
+
+AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT")
+AZURE_KEY = os.getenv("AZURE_KEY")
+
+OCR_MODEL_ID = "prebuilt-document"
+
+# Concurrency and polling settings for the OCR engine
+ocr_max_in_flight = int(os.getenv('OCR_MAX_IN_FLIGHT', '32'))
+ocr_poll_initial_delay = float(os.getenv('OCR_POLL_INITIAL_DELAY', '1'))
+ocr_poll_max_delay = float(os.getenv('OCR_POLL_MAX_DELAY', '10'))
+ocr_timeout = float(os.getenv('OCR_TIMEOUT', '300'))
+
+
+def _retry_after_seconds(headers):
+    for name, scale in (('retry-after-ms', 0.001), ('x-ms-retry-after-ms', 0.001), ('retry-after', 1)):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                continue
+    return None
+
+
+class AdaptivePolling(AsyncLROBasePolling):
+    """
+    Polls the analyze operation starting at a short delay and doubling it up to a cap.
+    A Retry-After sent by the service takes precedence over the backoff and is honoured
+    in full, since polling sooner only gets throttled again.
+    """
+    def __init__(self, initial_delay, max_delay, **kwargs):
+        super().__init__(timeout=initial_delay, **kwargs)
+        self._next_delay = initial_delay
+        self._max_delay = max_delay
+
+    def _extract_delay(self):
+        retry_after = None
+        if self._pipeline_response is not None:
+            retry_after = _retry_after_seconds(self._pipeline_response.http_response.headers)
+
+        delay = self._next_delay
+        self._next_delay = min(self._next_delay * 2, self._max_delay)
+        if retry_after is not None:
+            return retry_after
+        return delay
+
+
+class OcrEngine:
+    """
+    Runs Form Recognizer analyses on a private asyncio loop in a background thread,
+    so any number of worker threads can share one client and keep many analyses in flight.
+    """
+    def __init__(self, endpoint, key, max_in_flight=32, initial_delay=1.0, max_delay=10.0, client_factory=None):
+        self.endpoint = endpoint
+        self.key = key
+        self.max_in_flight = max_in_flight
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self._client_factory = client_factory or self._default_client
+        self._client = None
+        self._semaphore = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='ocr-engine', daemon=True)
+        self._thread.start()
+
+    def _default_client(self):
+        return DocumentAnalysisClient(self.endpoint, AzureKeyCredential(self.key))
+
+    async def _analyze(self, file_bytes, **kwargs):
+        # Loop-bound objects are created lazily on the engine's own loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        if self._client is None:
+            self._client = self._client_factory()
+
+        async with self._semaphore:
+            # Analyses count against the resource's transactions per second; 429s on the
+            # calls themselves are retried by the SDK's retry policy, honouring Retry-After
+            bucket = get_bucket('azure')
+            if bucket:
+                wait = bucket.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+            polling = AdaptivePolling(self.initial_delay, self.max_delay)
+            poller = await self._client.begin_analyze_document(OCR_MODEL_ID, file_bytes, polling=polling, **kwargs)
+            return await poller.result()
+
+    def submit(self, file_bytes, **kwargs):
+        """
+        Start an analysis and return a concurrent.futures.Future for its AnalyzeResult.
+        """
+        return asyncio.run_coroutine_threadsafe(self._analyze(file_bytes, **kwargs), self._loop)
+
+    def analyze(self, file_bytes, timeout=None, **kwargs):
+        return self.submit(file_bytes, **kwargs).result(timeout if timeout is not None else ocr_timeout)
+
+    def close(self):
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result()
+            self._client = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def set_ocr_engine(engine):
+    """
+    Replace the shared engine, e.g. with one built on a fake client_factory for benchmarks.
+    """
+    global _engine
+    with _engine_lock:
+        _engine = engine
+
+
+def get_ocr_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = OcrEngine(
+                AZURE_ENDPOINT,
+                AZURE_KEY,
+                max_in_flight=ocr_max_in_flight,
+                initial_delay=ocr_poll_initial_delay,
+                max_delay=ocr_poll_max_delay
+            )
+            logging.info(f"OCR engine started with up to {ocr_max_in_flight} analyses in flight.")
+        return _engine
@@ -0,0 +1,139 @@
+import logging
+from collections import Counter
+
+# Lines repeated on at least this many pages are treated as page boilerplate
+BOILERPLATE_MIN_PAGES = 2
+
+
+def _clean(text):
+    return " ".join((text or "").split())
+
+
+def _in_spans(spans, table_ranges):
+    return any(start <= span.offset < end for span in spans for start, end in table_ranges)
+
+
+def _table_page(table):
+    regions = table.bounding_regions or []
+    return regions[0].page_number if regions else 1
+
+
+def format_table(table):
+    """
+    Render a document table as TSV, one line per row; spanned cells are left blank.
+    """
+    grid = [["" for _ in range(table.column_count)] for _ in range(table.row_count)]
+    for cell in table.cells:
+        grid[cell.row_index][cell.column_index] = _clean(cell.content)
+    return "\n".join("\t".join(row).rstrip("\t") for row in grid if any(row))
+
+
+def format_key_values(result):
+    lines = []
+    seen = set()
+    for pair in result.key_value_pairs or []:
+        if not pair.key or not pair.value:
+            continue
+        line = f"{_clean(pair.key.content).rstrip(':')}: {_clean(pair.value.content)}"
+        if line not in seen:
+            seen.add(line)
+            lines.append(line)
+    return lines
+
+
+def drop_repeated_lines(page_lines):
+    """
+    Keep boilerplate lines repeated across pages (letterheads, footers) only on the first
+    page they appear on; page_lines maps page number to that page's lines.
+    """
+    # Count each line once per page it appears on
+    occurrences = Counter(line for lines in page_lines.values() for line in set(lines))
+    seen_boilerplate = set()
+
+    kept = {}
+    for page_number, lines in page_lines.items():
+        kept[page_number] = []
+        for line in lines:
+            if occurrences[line] >= BOILERPLATE_MIN_PAGES:
+                if line in seen_boilerplate:
+                    continue
+                seen_boilerplate.add(line)
+            kept[page_number].append(line)
+    return kept
+
+
+def format_analysis_result(result):
+    """
+    Compact, structure-preserving text for the LLM: key-value fields first, then for
+    every page its free text lines followed by its tables as TSV. Lines that belong to a
+    table are only emitted inside the table, and boilerplate lines repeated across
+    pages (letterheads, footers) are kept only where they first appear.
+    """
+    tables = result.tables or []
+    table_ranges = [
+        (span.offset, span.offset + span.length)
+        for table in tables for span in (table.spans or [])
+    ]
+
+    page_lines = {}
+    for page in result.pages:
+        page_lines[page.page_number] = [
+            _clean(line.content) for line in page.lines
+            if line.content.strip() and not _in_spans(line.spans or [], table_ranges)
+        ]
+
+    page_lines = drop_repeated_lines(page_lines)
+
+    sections = []
+    fields = format_key_values(result)
+    if fields:
+        sections.append("## Fields\n" + "\n".join(fields))
+
+    table_number = 0
+    for page in result.pages:
+        lines = page_lines[page.page_number]
+        for table in tables:
+            if _table_page(table) == page.page_number:
+                table_number += 1
+                lines.append(f"### Table {table_number}\n{format_table(table)}")
+
+        sections.append(f"## Page {page.page_number}\n" + "\n".join(lines))
+
+    return "\n\n".join(sections)
+
+
+def format_flat(result):
+    # The original single-line-per-page layout, kept for comparison
+    return "\n".join(
+        f"Page {page.page_number}: " + " ".join(line.content for line in page.lines)
+        for page in result.pages
+    )
+
+
+def format_for_llm(result, style='structured'):
+    if style == 'flat':
+        return format_flat(result)
+
+    try:
+        return format_analysis_result(result)
+    except Exception as e:
+        logging.warning(f"Structured OCR formatting failed, using flat text: {e}")
+        return format_flat(result)
+
+
+def format_text_layer(page_texts, style='structured'):
+    """
+    Lay out text read from a PDF's own text layer like an OCR result, so the LLM input
+    looks the same whichever extractor produced it. Columns are already tab separated.
+    """
+    if style == 'flat':
+        return "\n".join(
+            f"Page {number}: " + " ".join(text.split())
+            for number, text in enumerate(page_texts, 1)
+        )
+
+    page_lines = drop_repeated_lines({
+        number: [line for line in text.splitlines() if line.strip()]
+        for number, text in enumerate(page_texts, 1)
+    })
+    return "\n\n".join(f"## Page {number}\n" + "\n".join(lines) for number, lines in page_lines.items())
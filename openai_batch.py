@@ -0,0 +1,77 @@
+import io
+import json
+import time
+import logging
+from metrics import span
+
+CHAT_COMPLETIONS_ENDPOINT = '/v1/chat/completions'
+FINAL_BATCH_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def submit_batch(client, requests, completion_window='24h'):
+    """
+    Upload (custom_id, body) chat completion requests as a JSONL file and start a Batch job.
+
+    Returns the batch id.
+    """
+    lines = [
+        json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': CHAT_COMPLETIONS_ENDPOINT, 'body': body})
+        for custom_id, body in requests
+    ]
+    with span('call', 'batches.create', api='openai', requests=len(requests)):
+        input_file = client.files.create(
+            file=('batch_input.jsonl', io.BytesIO('\n'.join(lines).encode('utf-8'))),
+            purpose='batch'
+        )
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=CHAT_COMPLETIONS_ENDPOINT,
+            completion_window=completion_window
+        )
+    logging.info(f"Submitted OpenAI batch {batch.id} with {len(requests)} requests.")
+    return batch.id
+
+
+def wait_for_batch(client, batch_id, poll_interval=60, timeout=None):
+    with span('call', 'batches.wait', api='openai'):
+        return _poll_batch(client, batch_id, poll_interval, timeout)
+
+
+def _poll_batch(client, batch_id, poll_interval, timeout):
+    started = time.time()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in FINAL_BATCH_STATUSES:
+            logging.info(f"OpenAI batch {batch_id} finished with status '{batch.status}'.")
+            return batch
+        if timeout is not None and time.time() - started > timeout:
+            raise TimeoutError(f"OpenAI batch {batch_id} still '{batch.status}' after {timeout} seconds")
+
+        counts = batch.request_counts
+        if counts:
+            logging.info(f"OpenAI batch {batch_id} is '{batch.status}': {counts.completed}/{counts.total} done.")
+        time.sleep(poll_interval)
+
+
+def _read_jsonl(client, file_id):
+    if not file_id:
+        return []
+    content = client.files.content(file_id).text
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def collect_batch_results(client, batch):
+    """
+    Return a dict of custom_id -> (response body, error) for a finished batch.
+
+    Requests that failed, or that never ran because the batch expired or was cancelled,
+    get an error; the caller decides whether to retry them.
+    """
+    results = {}
+    for record in _read_jsonl(client, batch.output_file_id) + _read_jsonl(client, getattr(batch, 'error_file_id', None)):
+        response = record.get('response') or {}
+        if record.get('error') or response.get('status_code', 200) >= 400:
+            results[record['custom_id']] = (None, Exception(record.get('error') or response.get('body')))
+        else:
+            results[record['custom_id']] = (response.get('body'), None)
+    return results
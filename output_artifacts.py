@@ -0,0 +1,164 @@
+import io
+import os
+import csv
+import hashlib
+import logging
+import threading
+import importlib.util
+from datetime import datetime
+import pytz
+from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+from sync_state import load_sync_state, save_sync_state
+from config import load_environment
+
+load_environment()
+
+# Where each invoice's own rows go: 'spreadsheet' creates a spreadsheet per invoice, 'workbook'
+# adds a tab per invoice to a workbook per day, 'csv' and 'xlsx' upload one file per invoice
+OUTPUT_MODE = os.getenv('OUTPUT_MODE', 'spreadsheet')
+# Title of the daily workbook; strftime codes are filled in with the current date
+OUTPUT_WORKBOOK_TITLE = os.getenv('OUTPUT_WORKBOOK_TITLE', 'Invoices %Y-%m-%d')
+
+OUTPUT_MODES = ('spreadsheet', 'workbook', 'csv', 'xlsx')
+
+SPREADSHEET_MIMETYPE = 'application/vnd.google-apps.spreadsheet'
+FILE_MIMETYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Sheet titles are limited to 100 characters
+MAX_TAB_TITLE = 100
+
+_workbook_lock = threading.Lock()
+_workbook = {}
+
+
+def check_output_mode():
+    """
+    Raise ValueError when OUTPUT_MODE is unknown or needs a package that is not installed,
+    so a bad setting stops the run at start-up instead of failing every invoice.
+    """
+    if OUTPUT_MODE not in OUTPUT_MODES:
+        raise ValueError(f"Unknown OUTPUT_MODE: {OUTPUT_MODE} (expected one of {', '.join(OUTPUT_MODES)})")
+    if OUTPUT_MODE == 'xlsx' and importlib.util.find_spec('openpyxl') is None:
+        raise ValueError("OUTPUT_MODE=xlsx needs the openpyxl package (pip install -r requirements.txt)")
+
+
+def daily_workbook_id(drive_service, folder_id):
+    """
+    Id of today's workbook in the output folder, created there on first use. The id is kept
+    in the sync state, and other workers sharing the folder find it by name.
+    """
+    title = datetime.now(pytz.timezone('Asia/Kolkata')).strftime(OUTPUT_WORKBOOK_TITLE)
+    with _workbook_lock:
+        if _workbook.get('title') == title:
+            return _workbook['id']
+
+        saved = load_sync_state('output_workbook') or {}
+        workbook_id = saved.get('id') if saved.get('title') == title else None
+        if not workbook_id:
+            escaped_title = title.replace("\\", "\\\\").replace("'", "\\'")
+            existing = drive_service.files().list(
+                q=f"name = '{escaped_title}' and '{folder_id}' in parents and mimeType = '{SPREADSHEET_MIMETYPE}' and trashed = false",
+                fields='files(id)',
+                pageSize=1
+            ).execute().get('files', [])
+            if existing:
+                workbook_id = existing[0]['id']
+            else:
+                # Created straight in the output folder, so it never has to be moved out of root
+                workbook_id = drive_service.files().create(
+                    body={'name': title, 'mimeType': SPREADSHEET_MIMETYPE, 'parents': [folder_id]},
+                    fields='id'
+                ).execute()['id']
+                logging.info(f"Created workbook '{title}' ({workbook_id}).")
+            save_sync_state('output_workbook', {'title': title, 'id': workbook_id})
+
+        _workbook.update(title=title, id=workbook_id)
+        return workbook_id
+
+
+def tab_sheet_id(file_id):
+    # Derived from the file id so a retried write targets the same tab
+    return int(hashlib.sha256(file_id.encode('utf-8')).hexdigest()[:7], 16)
+
+
+def _cell(value):
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': '' if value is None else str(value)}}
+
+
+def write_workbook_tab(sheets_service, drive_service, folder_id, title, rows, file_id):
+    """
+    Add the rows (header first) as a new tab of today's workbook in one batchUpdate and
+    return the tab's output id, '<workbook id>#gid=<sheet id>'.
+    """
+    workbook_id = daily_workbook_id(drive_service, folder_id)
+    sheet_id = tab_sheet_id(file_id)
+    tab_title = f"{title} ({file_id[:8]})"[-MAX_TAB_TITLE:]
+    column_count = max(len(row) for row in rows)
+
+    try:
+        sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=workbook_id,
+            body={'requests': [
+                {'addSheet': {'properties': {
+                    'sheetId': sheet_id,
+                    'title': tab_title,
+                    'gridProperties': {'rowCount': len(rows), 'columnCount': column_count},
+                }}},
+                {'updateCells': {
+                    'start': {'sheetId': sheet_id, 'rowIndex': 0, 'columnIndex': 0},
+                    'rows': [{'values': [_cell(value) for value in row]} for row in rows],
+                    'fields': 'userEnteredValue',
+                }},
+            ]}
+        ).execute()
+    except HttpError as e:
+        # A retry after a write whose response was lost finds its tab already there
+        if e.resp.status != 400 or 'already exists' not in str(e):
+            raise
+        logging.info(f"Tab '{tab_title}' already exists in workbook {workbook_id}.")
+
+    return f"{workbook_id}#gid={sheet_id}"
+
+
+def rows_to_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def rows_to_xlsx(rows):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise Exception("OUTPUT_MODE=xlsx needs the openpyxl package")
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Sheet1')
+    for row in rows:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def upload_table_file(drive_service, folder_id, title, rows, file_format):
+    """
+    Write the rows (header first) to a CSV or XLSX file and upload it into the output
+    folder in one call; returns the file id.
+    """
+    content = rows_to_xlsx(rows) if file_format == 'xlsx' else rows_to_csv(rows)
+    name = f"{os.path.splitext(title)[0]}.{file_format}"
+    uploaded = drive_service.files().create(
+        body={'name': name, 'parents': [folder_id]},
+        media_body=MediaIoBaseUpload(io.BytesIO(content), mimetype=FILE_MIMETYPES[file_format]),
+        fields='id'
+    ).execute()
+    return uploaded['id']
@@ -0,0 +1,162 @@
+import time
+import logging
+import queue
+import threading
+
+_STOP = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline: a function applied to each item by a pool of worker threads.
+
+    With batch_size > 1 the function instead receives a list of up to batch_size items,
+    collected for at most batch_wait seconds, and returns a list of results in the same
+    order (None entries are dropped). A single collector thread fills the batches and the
+    workers process them, so idle workers do not each take a few items and cut batches short.
+    """
+    def __init__(self, name, func, workers=1, batch_size=1, batch_wait=0.0):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.batch_wait = batch_wait
+
+
+class Pipeline:
+    """
+    Staged worker pipeline with bounded queues between stages.
+
+    Each item flows through the stages in order. A stage function receives the item
+    and returns the (possibly updated) item for the next stage, or None to drop it
+    quietly. If a stage raises, on_error(item, stage_name, exception) is called and
+    the item is dropped.
+    """
+    def __init__(self, stages, queue_size=10, on_error=None):
+        self.stages = stages
+        self.on_error = on_error
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        # Full batches waiting for a worker of a batched stage
+        self._batches = [queue.Queue(maxsize=1) for _ in stages]
+        self._threads = []
+        self._started = False
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            threads = []
+            if stage.batch_size > 1:
+                thread = threading.Thread(target=self._collector, args=(index,), name=f"{stage.name}-collect", daemon=True)
+                thread.start()
+                threads.append(thread)
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(index,),
+                    name=f"{stage.name}-{n}",
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+            self._threads.append(threads)
+        self._started = True
+        return self
+
+    def submit(self, item):
+        # Blocks when the first stage is saturated, which keeps memory bounded
+        self._queues[0].put(item)
+
+    def close(self):
+        # Drain stage by stage: a stage only receives its stop signals once every
+        # worker of the previous stage has finished handing items on.
+        for index, stage in enumerate(self.stages):
+            # A batched stage's collector passes the stop on to its workers
+            for _ in range(1 if stage.batch_size > 1 else stage.workers):
+                self._queues[index].put(_STOP)
+            for thread in self._threads[index]:
+                thread.join()
+
+    def _collect_batch(self, index, first):
+        # Gather more items until the batch is full or batch_wait has passed; a stop
+        # signal ends collection and is reported so the worker exits after this batch
+        stage = self.stages[index]
+        batch = [first]
+        deadline = time.monotonic() + stage.batch_wait
+        while len(batch) < stage.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queues[index].get(timeout=max(0.0, remaining)) if remaining > 0 else self._queues[index].get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _collector(self, index):
+        stage = self.stages[index]
+        stopping = False
+        while not stopping:
+            item = self._queues[index].get()
+            if item is _STOP:
+                break
+            batch, stopping = self._collect_batch(index, item)
+            self._batches[index].put(batch)
+        for _ in range(stage.workers):
+            self._batches[index].put(_STOP)
+
+    def _report_error(self, item, stage, error):
+        logging.error(f"Pipeline stage '{stage.name}' failed: {error}")
+        if self.on_error:
+            try:
+                self.on_error(item, stage.name, error)
+            except Exception as handler_error:
+                logging.error(f"Pipeline error handler failed: {handler_error}")
+
+    def _worker(self, index):
+        stage = self.stages[index]
+        next_queue = self._queues[index + 1] if index + 1 < len(self._queues) else None
+
+        source = self._batches[index] if stage.batch_size > 1 else self._queues[index]
+
+        while True:
+            item = source.get()
+            if item is _STOP:
+                break
+
+            if stage.batch_size > 1:
+                items = item
+                try:
+                    results = stage.func(items)
+                except Exception as e:
+                    for failed in items:
+                        self._report_error(failed, stage, e)
+                    continue
+            else:
+                try:
+                    results = [stage.func(item)]
+                except Exception as e:
+                    self._report_error(item, stage, e)
+                    continue
+
+            if next_queue is not None:
+                for result in results:
+                    if result is not None:
+                        next_queue.put(result)
+
+    def __enter__(self):
+        if not self._started:
+            self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def run_pipeline(items, stages, queue_size=10, on_error=None):
+    """
+    Push every item through the stages and wait until all of them are done.
+    """
+    with Pipeline(stages, queue_size=queue_size, on_error=on_error) as pipeline:
+        for item in items:
+            pipeline.submit(item)
@@ -0,0 +1,213 @@
+import os
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from config import load_environment
+from metrics import registry, record_retry
+
+load_environment()
+
+# Quotas per API and operation class, in the unit each provider publishes them in;
+# 0 disables a limit
+QUOTAS = {
+    'sheets_write': float(os.getenv('SHEETS_WRITES_PER_MINUTE', '60')) / 60,
+    'sheets_read': float(os.getenv('SHEETS_READS_PER_MINUTE', '60')) / 60,
+    'drive': float(os.getenv('DRIVE_REQUESTS_PER_MINUTE', '12000')) / 60,
+    'gmail': float(os.getenv('GMAIL_REQUESTS_PER_MINUTE', '3000')) / 60,
+    'azure': float(os.getenv('AZURE_TRANSACTIONS_PER_SECOND', '15')),
+    'openai_requests': float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '500')) / 60,
+    'openai_tokens': float(os.getenv('OPENAI_TOKENS_PER_MINUTE', '200000')) / 60,
+}
+
+# Retry policy for rate-limited and transiently failing calls
+rate_limit_max_retries = int(os.getenv('RATE_LIMIT_MAX_RETRIES', '6'))
+rate_limit_initial_backoff = float(os.getenv('RATE_LIMIT_INITIAL_BACKOFF', '1'))
+rate_limit_max_backoff = float(os.getenv('RATE_LIMIT_MAX_BACKOFF', '60'))
+rate_limit_jitter = float(os.getenv('RATE_LIMIT_JITTER', '0.25'))
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Drive and Gmail report quota exhaustion as 403 with one of these reasons
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+# Methods that are safe to repeat after a 5xx, when the first attempt may already have been
+# applied; Google's PATCH calls here only set fields (moves, properties), so they qualify
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'PATCH')
+# Client errors raised when no response arrived at all (APITimeoutError is an APIConnectionError);
+# matched by name so the OpenAI SDK is not imported here
+CONNECTION_ERROR_NAMES = ('APIConnectionError',)
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every thread calling one API operation class.
+
+    Callers reserve tokens and are told how long to wait for them, so reservations are
+    served in order and the bucket can run slightly into debt instead of starving large
+    requests. pause() holds every caller back after the service itself pushes back.
+    """
+    def __init__(self, name, rate, capacity=None):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        """
+        Take amount tokens and return the seconds the caller must wait before using them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Large requests are charged in full; the debt holds back the callers after them
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def acquire(self, amount=1):
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(name):
+    """
+    Return the shared bucket for a QUOTAS entry, or None when that limit is disabled.
+    """
+    with _buckets_lock:
+        if name not in _buckets:
+            rate = QUOTAS.get(name, 0)
+            _buckets[name] = TokenBucket(name, rate) if rate > 0 else None
+        return _buckets[name]
+
+
+def acquire_all(limits):
+    """
+    Wait until every (bucket name, amount) in limits can be spent; reservations are taken
+    together so one slow bucket does not make the others queue twice.
+    """
+    waits = {name: bucket.reserve(amount) for name, bucket, amount in ((name, get_bucket(name), amount) for name, amount in limits) if bucket}
+    wait = max(waits.values(), default=0)
+    if wait > 0:
+        registry.increment('rate_limit_wait_seconds_total', wait, bucket=max(waits, key=waits.get))
+        time.sleep(wait)
+
+
+def google_operation_class(uri, method):
+    if 'sheets.googleapis.com' in uri:
+        return 'sheets_read' if method == 'GET' else 'sheets_write'
+    if '/gmail/' in uri or 'gmail.googleapis.com' in uri:
+        return 'gmail'
+    return 'drive'
+
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error):
+    """
+    Return (retryable, retry_after_seconds, rate_limited) for an exception raised by a
+    Google, Azure or OpenAI client. Connection failures and timeouts are retryable.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)) or any(
+            cls.__name__ in CONNECTION_ERROR_NAMES for cls in type(error).__mro__):
+        return True, None, False
+
+    status = getattr(error, 'status_code', None)
+    headers = {}
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'headers', None) is not None:
+        headers = response.headers
+
+    # googleapiclient HttpError carries the httplib2 response, headers included, as .resp
+    resp = getattr(error, 'resp', None)
+    if resp is not None:
+        if status is None:
+            status = getattr(resp, 'status', None)
+        headers = resp
+
+    if status is None:
+        return False, None, False
+
+    if status == 403:
+        content = getattr(error, 'content', b'') or b''
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        if not any(reason in content for reason in RATE_LIMIT_REASONS):
+            return False, None, False
+        status = 429
+
+    # An exhausted OpenAI balance also answers 429 but will not recover by waiting
+    if status == 429 and 'insufficient_quota' in str(error):
+        return False, None, False
+
+    if status not in RETRYABLE_STATUSES:
+        return False, None, False
+
+    retry_after_ms = headers.get('retry-after-ms') or headers.get('x-ms-retry-after-ms')
+    retry_after = float(retry_after_ms) / 1000 if retry_after_ms else _parse_retry_after(headers.get('retry-after'))
+    return True, retry_after, status == 429
+
+
+def is_idempotent(method):
+    return method.upper() in IDEMPOTENT_METHODS
+
+
+def backoff_delay(attempt, retry_after=None):
+    # Retry-After wins over the exponential schedule; jitter only ever lengthens the wait
+    base = retry_after if retry_after is not None else min(rate_limit_initial_backoff * 2 ** attempt, rate_limit_max_backoff)
+    return base * (1 + random.uniform(0, rate_limit_jitter))
+
+
+def call_with_limits(func, limits=(), max_retries=None, description='call', idempotent=True):
+    """
+    Run func() after taking tokens from each (bucket name, amount) in limits, retrying
+    429/5xx responses with Retry-After or capped exponential backoff plus jitter. A 429
+    also pauses the first bucket so every thread backs off together.
+
+    Calls that are not idempotent (e.g. appends and creates) are only retried when rate
+    limited, since a 5xx may come back after the call took effect.
+    """
+    max_retries = rate_limit_max_retries if max_retries is None else max_retries
+    buckets = [(get_bucket(name), amount) for name, amount in limits]
+    buckets = [(bucket, amount) for bucket, amount in buckets if bucket]
+
+    attempt = 0
+    while True:
+        acquire_all(limits)
+        try:
+            return func()
+        except Exception as e:
+            retryable, retry_after, rate_limited = classify_error(e)
+            if not retryable or (not idempotent and not rate_limited) or attempt >= max_retries:
+                raise
+
+            delay = backoff_delay(attempt, retry_after)
+            record_retry(description, getattr(e, 'status_code', None) or getattr(getattr(e, 'resp', None), 'status', None))
+            if rate_limited and buckets:
+                buckets[0][0].pause(delay)
+            logging.warning(f"{description} failed ({e.__class__.__name__}), retry {attempt + 1}/{max_retries} in {delay:.1f}s.")
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,150 @@
+import os
+import json
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from google_auth import create_google_service, SCOPES
+from metrics import registry
+from config import load_environment
+
+load_environment()
+
+# Flush thresholds: buffered row count and seconds between timed flushes
+sheets_flush_rows = int(os.getenv('SHEETS_FLUSH_ROWS', '200'))
+sheets_flush_interval = float(os.getenv('SHEETS_FLUSH_INTERVAL', '5'))
+
+UNSENT_ROWS_FILE = "unsent_sheet_rows.jsonl"
+
+
+class BufferedSheetsWriter:
+    """
+    Write-behind buffer for Sheets appends.
+
+    Rows are collected per (spreadsheet, range) target and sent as one multi-row
+    append per target when the buffer reaches max_rows, every flush_interval seconds
+    and at shutdown. Rows keep the order in which they were appended. An optional
+    on_flushed callback runs once the rows it came with have reached the sheet.
+    """
+    def __init__(self, service_factory, max_rows=200, flush_interval=5.0):
+        self.service_factory = service_factory
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self._buffers = OrderedDict()
+        self._buffered_rows = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sheets-writer', daemon=True)
+        self._thread.start()
+
+    def _service(self):
+        return self.service_factory()
+
+    def append(self, spreadsheet_id, range_name, rows, on_flushed=None):
+        with self._lock:
+            buffer = self._buffers.setdefault((spreadsheet_id, range_name), ([], []))
+            buffer[0].extend(rows)
+            if on_flushed:
+                buffer[1].append(on_flushed)
+            self._buffered_rows += len(rows)
+            full = self._buffered_rows >= self.max_rows
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        # Flushes are serialised so a later batch can never overtake an earlier one
+        with self._flush_lock:
+            with self._lock:
+                pending = self._buffers
+                self._buffers = OrderedDict()
+                self._buffered_rows = 0
+
+            failed = OrderedDict()
+            for (spreadsheet_id, range_name), (rows, callbacks) in pending.items():
+                try:
+                    self._service().spreadsheets().values().append(
+                        spreadsheetId=spreadsheet_id,
+                        range=range_name,
+                        valueInputOption='RAW',
+                        insertDataOption='INSERT_ROWS',
+                        body={'values': rows}
+                    ).execute()
+                    logging.info(f"Flushed {len(rows)} rows to {range_name}.")
+                    registry.increment('sheets_rows_flushed_total', len(rows), range=range_name.split('!')[0])
+                except Exception as e:
+                    logging.error(f"Error flushing {len(rows)} rows to {range_name}: {e}")
+                    failed[(spreadsheet_id, range_name)] = (rows, callbacks)
+                    continue
+
+                for callback in callbacks:
+                    try:
+                        callback()
+                    except Exception as e:
+                        logging.error(f"Error in flush callback for {range_name}: {e}")
+
+            if failed:
+                # Put failed rows back in front of anything appended meanwhile
+                with self._lock:
+                    for target, (rows, callbacks) in self._buffers.items():
+                        failed_rows, failed_callbacks = failed.setdefault(target, ([], []))
+                        failed_rows.extend(rows)
+                        failed_callbacks.extend(callbacks)
+                    self._buffers = failed
+                    self._buffered_rows = sum(len(rows) for rows, _ in failed.values())
+
+            return not failed
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            if self._buffered_rows:
+                self.flush()
+
+    def close(self):
+        self._stop.set()
+        if self.flush():
+            return
+
+        # Last resort so rows are never silently lost
+        with self._lock:
+            pending = self._buffers
+            self._buffers = OrderedDict()
+            self._buffered_rows = 0
+        with open(UNSENT_ROWS_FILE, "a") as unsent_file:
+            for (spreadsheet_id, range_name), (rows, _) in pending.items():
+                unsent_file.write(json.dumps({
+                    'time': datetime.now().isoformat(),
+                    'spreadsheet_id': spreadsheet_id,
+                    'range': range_name,
+                    'rows': rows
+                }, default=str) + "\n")
+        logging.error(f"Could not flush buffered rows, saved them to {UNSENT_ROWS_FILE}.")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_sheets_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BufferedSheetsWriter(
+                lambda: create_google_service('sheets', 'v4', SCOPES),
+                max_rows=sheets_flush_rows,
+                flush_interval=sheets_flush_interval
+            )
+            atexit.register(_writer.close)
+        return _writer
+
+
+def flush_sheets_writer():
+    """
+    Flush buffered rows if the writer has been started; safe to call from finally blocks.
+    Returns False when some rows could not be sent and are still buffered.
+    """
+    if _writer is None:
+        return True
+    return _writer.flush()
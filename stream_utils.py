@@ -0,0 +1,62 @@
+import io
+import os
+import base64
+
+
+class Base64DecodingStream(io.RawIOBase):
+    """
+    Seekable, read-only file object over URL-safe base64 text.
+
+    Bytes are decoded on demand for each read, so an upload that reads in chunks
+    never holds more than one decoded chunk of the payload in memory.
+    """
+    def __init__(self, encoded):
+        self._data = encoded
+        tail = encoded[-2:]
+        self._chars = len(encoded) - (len(tail) - len(tail.rstrip('=' if isinstance(tail, str) else b'=')))
+        self._size = self._chars * 3 // 4
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._pos + offset
+        elif whence == os.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._pos = position
+        return self._pos
+
+    def readinto(self, buffer):
+        if self._pos >= self._size:
+            return 0
+
+        length = min(len(buffer), self._size - self._pos)
+
+        # Decode only the 4-character groups that cover the requested byte range
+        first_group = self._pos // 3
+        last_group = (self._pos + length - 1) // 3 + 1
+        encoded = self._data[first_group * 4:min(last_group * 4, self._chars)]
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode('ascii')
+        encoded += '=' * (-len(encoded) % 4)
+        decoded = base64.urlsafe_b64decode(encoded)
+
+        offset = self._pos - first_group * 3
+        piece = decoded[offset:offset + length]
+        buffer[:len(piece)] = piece
+        self._pos += len(piece)
+        return len(piece)
@@ -0,0 +1,40 @@
+import os
+import json
+import logging
+import threading
+from config import load_environment
+
+load_environment()
+
+# Checkpoints that let incremental syncs resume where the previous run stopped
+SYNC_STATE_PATH = os.getenv('SYNC_STATE_PATH', 'sync_state.json')
+
+_lock = threading.Lock()
+
+
+def _read_state():
+    if not os.path.exists(SYNC_STATE_PATH):
+        return {}
+    try:
+        with open(SYNC_STATE_PATH) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not read sync state from {SYNC_STATE_PATH}: {e}")
+        return {}
+
+
+def load_sync_state(key, default=None):
+    with _lock:
+        return _read_state().get(key, default)
+
+
+def save_sync_state(key, value):
+    with _lock:
+        state = _read_state()
+        state[key] = value
+
+        # Write to a temporary file first so a crash never leaves a half-written checkpoint
+        temp_path = f"{SYNC_STATE_PATH}.tmp"
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file, indent=2)
+        os.replace(temp_path, SYNC_STATE_PATH)
@@ -0,0 +1,43 @@
+import os
+import sys
+import base64
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gmail_app import select_attachment_parts
+
+
+def image_part(filename, size, content_id=None, disposition='inline'):
+    headers = [{'name': 'Content-Disposition', 'value': f'{disposition}; filename="{filename}"'}]
+    if content_id:
+        headers.append({'name': 'Content-ID', 'value': f'<{content_id}>'})
+    return {'mimeType': 'image/jpeg', 'filename': filename, 'headers': headers,
+            'body': {'attachmentId': f'att-{filename}', 'size': size}}
+
+
+def message(html, *parts):
+    data = base64.urlsafe_b64encode(html.encode('utf-8')).decode('ascii').rstrip('=')
+    return {'mimeType': 'multipart/mixed', 'parts': [
+        {'mimeType': 'text/html', 'filename': '', 'body': {'size': len(html), 'data': data}},
+        *parts,
+    ]}
+
+
+def selected(payload):
+    return [part['filename'] for part in select_attachment_parts('msg-1', payload)]
+
+
+def test_inline_photo_is_uploaded():
+    # iOS Mail sends an attached scan inline with a Content-ID the body never shows
+    payload = message('<p>Invoice attached</p>', image_part('scan.jpg', 900_000, content_id='scan@phone'))
+    assert selected(payload) == ['scan.jpg']
+
+
+def test_image_shown_in_body_is_skipped():
+    payload = message('<img src="cid:banner@vendor">', image_part('banner.jpg', 200_000, content_id='banner@vendor'))
+    assert selected(payload) == []
+
+
+def test_small_inline_image_is_skipped():
+    payload = message('<p>Thanks</p>', image_part('logo.jpg', 8_000, content_id='logo@vendor'))
+    assert selected(payload) == []
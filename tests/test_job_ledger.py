@@ -0,0 +1,35 @@
+import os
+import sys
+import json
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from job_ledger import JobLedger
+
+
+def test_pending_jobs(tmp_path):
+    ledger = JobLedger(str(tmp_path / 'ledger.sqlite3'))
+    ledger.record_stage('unfinished', 'ocr', folder_id='input')
+    ledger.record_stage('unwritten', 'moved', folder_id='input')
+    ledger.record_stage('done', 'moved', folder_id='input', main_rows_written=1)
+    ledger.record_stage('failed', 'failed', folder_id='input')
+
+    assert {job['file_id'] for job in ledger.pending_jobs()} == {'unfinished', 'unwritten'}
+    # While main sheet rows may still be buffered, moved invoices are not resumed
+    assert {job['file_id'] for job in ledger.pending_jobs(include_unwritten=False)} == {'unfinished'}
+
+
+def test_handoff_writes_main_rows_once(tmp_path):
+    # Handed-off invoices are moved before their buffered main sheet rows are flushed; the
+    # Drive run that follows must not take them for invoices whose rows were lost
+    report_path = tmp_path / 'report.json'
+    subprocess.run(
+        [sys.executable, os.path.join(REPO_DIR, 'benchmarks', 'run_benchmark.py'), '--invoices', '5', '--handoff',
+         '--azure-seconds', '0.05', '--azure-page-seconds', '0', '--llm-seconds', '0.01', '--google-latency', '0',
+         '--json', str(report_path)],
+        check=True, capture_output=True
+    )
+    report = json.loads(report_path.read_text())
+    assert report['rows_written'] == report['rows_expected'] == report['rows_written_correctly']
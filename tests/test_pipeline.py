@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import Stage, run_pipeline
+
+
+def test_batched_stage_fills_batches_with_many_workers():
+    batches = []
+    lock = threading.Lock()
+
+    def collect(items):
+        with lock:
+            batches.append(len(items))
+        time.sleep(0.05)
+        return items
+
+    results = []
+    run_pipeline(range(32), [Stage('pack', collect, workers=16, batch_size=8, batch_wait=1.0),
+                             Stage('out', results.append)])
+
+    assert sorted(results) == list(range(32))
+    assert batches == [8, 8, 8, 8]
+
+
+def test_batched_stage_reports_errors_per_item():
+    errors = []
+
+    def fail(items):
+        raise ValueError('bad batch')
+
+    run_pipeline(range(3), [Stage('pack', fail, workers=2, batch_size=3, batch_wait=1.0)],
+                 on_error=lambda item, stage_name, error: errors.append((item, stage_name)))
+
+    assert sorted(errors) == [(0, 'pack'), (1, 'pack'), (2, 'pack')]
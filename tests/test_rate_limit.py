@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import openai
+import pytest
+
+import rate_limit
+from rate_limit import call_with_limits, classify_error
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'backoff_delay', lambda attempt, retry_after=None: 0)
+
+
+def test_connection_errors_are_retryable():
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    assert classify_error(openai.APIConnectionError(request=request)) == (True, None, False)
+    assert classify_error(openai.APITimeoutError(request=request)) == (True, None, False)
+    assert classify_error(ConnectionResetError()) == (True, None, False)
+    assert classify_error(ValueError('bad output')) == (False, None, False)
+
+
+def flaky(errors):
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) <= errors:
+            raise TimeoutError('timed out')
+        return 'ok'
+    return func, calls
+
+
+def test_idempotent_call_retries_connection_errors():
+    func, calls = flaky(2)
+    assert call_with_limits(func, max_retries=3) == 'ok'
+    assert len(calls) == 3
+
+
+def test_non_idempotent_call_is_not_repeated():
+    func, calls = flaky(1)
+    with pytest.raises(TimeoutError):
+        call_with_limits(func, max_retries=3, idempotent=False)
+    assert len(calls) == 1
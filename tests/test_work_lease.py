@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from work_lease import SqliteLeaseStore, LeaseManager
+
+
+def lease_row(store, key):
+    return store._conn.execute('SELECT owner, expires FROM leases WHERE key = ?', (key,)).fetchone()
+
+
+def test_second_owner_is_refused(tmp_path):
+    path = str(tmp_path / 'leases.sqlite3')
+    first = SqliteLeaseStore(path, 'worker-1', ttl=60)
+    second = SqliteLeaseStore(path, 'worker-2', ttl=60)
+
+    assert first.claim('drive:file-1')
+    assert not second.claim('drive:file-1')
+    # The owner may claim again, and other keys are free
+    assert first.claim('drive:file-1')
+    assert second.claim('drive:file-2')
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    path = str(tmp_path / 'leases.sqlite3')
+    first = SqliteLeaseStore(path, 'worker-1', ttl=0.1)
+    second = SqliteLeaseStore(path, 'worker-2', ttl=60)
+
+    assert first.claim('drive:file-1')
+    time.sleep(0.2)
+    assert second.claim('drive:file-1')
+    assert lease_row(second, 'drive:file-1')[0] == 'worker-2'
+    assert not first.claim('drive:file-1')
+
+
+def test_release_frees_only_own_lease(tmp_path):
+    path = str(tmp_path / 'leases.sqlite3')
+    first = SqliteLeaseStore(path, 'worker-1', ttl=60)
+    second = SqliteLeaseStore(path, 'worker-2', ttl=60)
+
+    assert first.claim('drive:file-1')
+    second.release('drive:file-1')
+    assert not second.claim('drive:file-1')
+    first.release('drive:file-1')
+    assert second.claim('drive:file-1')
+
+
+def test_renew_extends_only_own_leases(tmp_path):
+    path = str(tmp_path / 'leases.sqlite3')
+    first = SqliteLeaseStore(path, 'worker-1', ttl=60)
+    second = SqliteLeaseStore(path, 'worker-2', ttl=60)
+
+    assert first.claim('drive:file-1')
+    expires = lease_row(first, 'drive:file-1')[1]
+    time.sleep(0.01)
+    second.renew(['drive:file-1'])
+    assert lease_row(first, 'drive:file-1') == ('worker-1', expires)
+    first.renew(['drive:file-1'])
+    assert lease_row(first, 'drive:file-1')[1] > expires
+
+
+def test_manager_heartbeat_keeps_lease_alive(tmp_path):
+    path = str(tmp_path / 'leases.sqlite3')
+    manager = LeaseManager(SqliteLeaseStore(path, 'worker-1', ttl=0.3), ttl=0.3)
+    other = SqliteLeaseStore(path, 'worker-2', ttl=60)
+    try:
+        assert manager.claim('drive:file-1')
+        # Well past the TTL, but the heartbeat renews every ttl / 3
+        time.sleep(0.6)
+        assert not other.claim('drive:file-1')
+
+        manager.release('drive:file-1')
+        assert other.claim('drive:file-1')
+        assert not manager.claim('drive:file-1')
+    finally:
+        manager._stop.set()
@@ -0,0 +1,69 @@
+import io
+import os
+import re
+import logging
+import unicodedata
+from config import load_environment
+
+load_environment()
+
+logging.getLogger('pypdf').setLevel(logging.ERROR)
+
+# Use the PDF's own text layer when it scores at least this (0-1); lower scores go to Azure
+TEXT_LAYER_MIN_SCORE = float(os.getenv('TEXT_LAYER_MIN_SCORE', '0.85'))
+# A page with fewer characters than this counts as having no text (e.g. a scanned page)
+TEXT_LAYER_MIN_PAGE_CHARS = int(os.getenv('TEXT_LAYER_MIN_PAGE_CHARS', '40'))
+
+# Glyphs a PDF without a usable font mapping extracts as, e.g. "(cid:72)"
+CID_PATTERN = re.compile(r'\(cid:\d+\)')
+COLUMN_GAP = re.compile(r' {2,}')
+READABLE_PUNCTUATION = set(".,:;-/()%&#@'\"+*=_[]<>|₹$€£!?")
+
+
+def read_text_layer(file_bytes):
+    """
+    Return the text of every page of a PDF, keeping the layout's columns as tabs, or None
+    when the bytes are not a readable PDF (images, encrypted or broken files).
+    """
+    from pypdf import PdfReader
+
+    try:
+        reader = PdfReader(io.BytesIO(file_bytes))
+        if reader.is_encrypted:
+            return None
+        return [_page_text(page) for page in reader.pages]
+    except Exception as e:
+        logging.info(f"No usable text layer: {e}")
+        return None
+
+
+def _page_text(page):
+    try:
+        text = page.extract_text(extraction_mode='layout')
+    except Exception:
+        # Layout mode gives up on some unusual fonts; the plain mode still gets the words
+        text = page.extract_text() or ""
+    lines = (COLUMN_GAP.sub("\t", line.strip()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def score_text_layer(page_texts):
+    """
+    Score extracted page texts from 0 to 1: the share of pages that have text at all,
+    times the share of characters that are readable rather than unmapped glyphs or noise.
+    """
+    if not page_texts:
+        return 0.0
+
+    coverage = sum(len(text) >= TEXT_LAYER_MIN_PAGE_CHARS for text in page_texts) / len(page_texts)
+
+    text = "".join(page_texts)
+    unmapped = sum(len(match) for match in CID_PATTERN.findall(text))
+    characters = [char for char in CID_PATTERN.sub("", text) if not char.isspace()]
+    if not characters:
+        return 0.0
+    readable = sum(char.isalnum() or char in READABLE_PUNCTUATION for char in characters
+                   if unicodedata.category(char) not in ('Co', 'Cc', 'Cs'))
+    quality = readable / (len(characters) + unmapped)
+
+    return coverage * quality
@@ -0,0 +1,202 @@
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from google_auth import create_google_service, SCOPES
+from config import load_environment
+
+load_environment()
+
+# 'none' (single worker), 'sqlite' (shared lock file) or 'drive' (appProperties on the file)
+LEASE_BACKEND = os.getenv('LEASE_BACKEND', 'none')
+LEASE_DB_PATH = os.getenv('LEASE_DB_PATH', 'leases.sqlite3')
+LEASE_TTL = float(os.getenv('LEASE_TTL', '300'))
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+
+# Pause before reading a Drive claim back, to catch a worker that claimed at the same moment
+DRIVE_CLAIM_SETTLE_SECONDS = float(os.getenv('DRIVE_CLAIM_SETTLE_SECONDS', '1'))
+
+
+class SqliteLeaseStore:
+    """
+    Leases kept in a SQLite file that every worker can reach (local disk or a shared mount).
+    """
+    def __init__(self, path, owner, ttl):
+        self.owner = owner
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def claim(self, key):
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, making check-and-set atomic across processes
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT owner, expires FROM leases WHERE key = ?', (key,)).fetchone()
+                if row is not None and row[0] != self.owner and row[1] > now:
+                    return False
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO leases (key, owner, expires) VALUES (?, ?, ?)',
+                    (key, self.owner, now + self.ttl)
+                )
+                return True
+            finally:
+                self._conn.execute('COMMIT')
+
+    def renew(self, keys):
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key in keys:
+                self._conn.execute('UPDATE leases SET expires = ? WHERE key = ? AND owner = ?', (expires, key, self.owner))
+
+    def release(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, self.owner))
+
+
+class DriveLeaseStore:
+    """
+    Leases stored as appProperties on the Drive file itself, so workers need nothing but Drive.
+
+    Drive has no compare-and-set, so a claim is written and then read back after a short
+    pause; the worker whose write survived owns the file. Keys other than 'drive:<file id>'
+    (e.g. Gmail messages) are not leased by this store.
+    """
+    def __init__(self, owner, ttl):
+        self.owner = owner
+        self.ttl = ttl
+        self._warned = False
+
+    def _file_id(self, key):
+        kind, _, file_id = key.partition(':')
+        if kind == 'drive':
+            return file_id
+        if not self._warned:
+            logging.warning(f"Drive leases cannot cover '{kind}' items; they are processed unleased.")
+            self._warned = True
+        return None
+
+    def _read_lease(self, drive_service, file_id):
+        file = drive_service.files().get(fileId=file_id, fields='appProperties').execute()
+        properties = file.get('appProperties', {})
+        return properties.get('lease_owner'), float(properties.get('lease_expires', 0))
+
+    def _write_lease(self, drive_service, file_id, owner, expires):
+        drive_service.files().update(
+            fileId=file_id,
+            body={'appProperties': {'lease_owner': owner, 'lease_expires': expires}},
+            fields='id'
+        ).execute()
+
+    def claim(self, key):
+        file_id = self._file_id(key)
+        if file_id is None:
+            return True
+
+        drive_service = create_google_service('drive', 'v3', SCOPES)
+        owner, expires = self._read_lease(drive_service, file_id)
+        if owner and owner != self.owner and expires > time.time():
+            return False
+
+        self._write_lease(drive_service, file_id, self.owner, str(time.time() + self.ttl))
+        time.sleep(DRIVE_CLAIM_SETTLE_SECONDS)
+        owner, _ = self._read_lease(drive_service, file_id)
+        return owner == self.owner
+
+    def renew(self, keys):
+        drive_service = create_google_service('drive', 'v3', SCOPES)
+        expires = str(time.time() + self.ttl)
+        for key in keys:
+            file_id = self._file_id(key)
+            if file_id:
+                self._write_lease(drive_service, file_id, self.owner, expires)
+
+    def release(self, key):
+        file_id = self._file_id(key)
+        if file_id:
+            # Setting appProperties to null removes them
+            drive_service = create_google_service('drive', 'v3', SCOPES)
+            self._write_lease(drive_service, file_id, None, None)
+
+
+class LeaseManager:
+    """
+    Tracks the leases this worker holds and renews them with a heartbeat, so a crashed
+    worker's items expire after the TTL and are picked up by the others.
+    """
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name='lease-heartbeat', daemon=True)
+        self._thread.start()
+
+    def claim(self, key):
+        try:
+            claimed = self.store.claim(key)
+        except Exception as e:
+            logging.error(f"Error claiming {key}: {e}")
+            return False
+
+        if claimed:
+            with self._lock:
+                self._held.add(key)
+        else:
+            logging.info(f"{key} is leased by another worker, skipping.")
+        return claimed
+
+    def release(self, key):
+        with self._lock:
+            if key not in self._held:
+                return
+            self._held.discard(key)
+        try:
+            self.store.release(key)
+        except Exception as e:
+            # The lease simply expires after the TTL
+            logging.error(f"Error releasing {key}: {e}")
+
+    def release_all(self, prefix=''):
+        with self._lock:
+            keys = [key for key in self._held if key.startswith(prefix)]
+        for key in keys:
+            self.release(key)
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            with self._lock:
+                keys = list(self._held)
+            if not keys:
+                continue
+            try:
+                self.store.renew(keys)
+            except Exception as e:
+                logging.error(f"Error renewing {len(keys)} leases: {e}")
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_lease_manager():
+    """
+    Return the shared LeaseManager, or None when LEASE_BACKEND is 'none'.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None and LEASE_BACKEND != 'none':
+            if LEASE_BACKEND == 'sqlite':
+                store = SqliteLeaseStore(LEASE_DB_PATH, WORKER_ID, LEASE_TTL)
+            elif LEASE_BACKEND == 'drive':
+                store = DriveLeaseStore(WORKER_ID, LEASE_TTL)
+            else:
+                raise ValueError(f"Unknown LEASE_BACKEND: {LEASE_BACKEND}")
+            _manager = LeaseManager(store, LEASE_TTL)
+            logging.info(f"Worker {WORKER_ID} using {LEASE_BACKEND} leases.")
+        return _manager